@@ -0,0 +1,458 @@
+import argparse
+import contextlib
+import itertools
+import json
+import statistics
+import sys
+
+
+from modules.file.operation import fileExists, folderExists, iteratePathTree
+from modules.file.reader import isImageFile
+from modules.util.command import loadModelConfig, loadConfig
+from modules.util.configuration import setConfigurationFileName
+from modules.util.configuration import setConfig, getConfig
+from modules.util.output import setOutput, flushOutput
+from modules.util.pipeline import newImageToTextRecord, identifyImageSubject
+from modules.util.pipeline import finishImageToTextRecord, getPipelineModes
+from modules.util.pipeline import normalizeObjectName
+from modules.util.span import span, exportSpans
+from modules.util.util import mapStagesInOrder, printError, printInfo
+from modules.util.strings.paths import WATCH_LEDGER_FILE_PATH
+from modules.util.warmup import startWarmup, stopKeepWarm
+from modules.util.watch import loadLedger, openLedger, writeLedgerEntry
+from modules.util.watch import iterateFolderChanges, openInotify, closeInotify
+
+
+EXIT_SUCCESS = 0
+EXIT_FAILURES = 1  # at least one input could not be processed
+EXIT_USAGE = 2  # bad arguments, manifest or configuration
+EXIT_INTERRUPTED = 130
+
+
+##########################
+""" BEGIN BATCH INPUTS """
+##########################
+
+
+def getArguments():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Run the image-to-text -> size/weight pipeline without prompts "
+            "and write one JSON record per input."
+        )
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        help="image files or folders (folders are searched recursively)"
+    )
+    parser.add_argument(
+        "-m", "--manifest",
+        help="file with one input path per line (\"-\" to read stdin)"
+    )
+    parser.add_argument(
+        "-o", "--output",
+        help="JSONL file to write the records to (default: stdout)"
+    )
+    parser.add_argument(
+        "-c", "--config",
+        help="configuration file name in the config folder"
+    )
+    parser.add_argument(
+        "-d", "--debug-level",
+        type=int,
+        help="override debug_level (all logs are written to stderr)"
+    )
+    parser.add_argument(
+        "-l", "--log",
+        help="append the logs to this file instead of stderr (output_log_file)"
+    )
+    parser.add_argument(
+        "-w", "--window",
+        type=int,
+        help="override pipeline_window (inputs in progress at once)"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=getPipelineModes() + ["compare"],
+        help=(
+            "override pipeline_mode, or \"compare\" to run both modes on "
+            "every input and report their latency and agreement"
+        )
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help=(
+            "keep running and process new or changed images in the given "
+            "folders as they appear (stop with Ctrl+C)"
+        )
+    )
+    parser.add_argument(
+        "--ledger",
+        default=WATCH_LEDGER_FILE_PATH,
+        help=(
+            "JSONL file of the files already processed in --watch mode, so "
+            "a restart only processes what changed (default: "
+            "" + WATCH_LEDGER_FILE_PATH + ")"
+        )
+    )
+    parser.add_argument(
+        "--warmup",
+        action="store_true",
+        help="warm up the models before the first input (model_warmup)"
+    )
+    return parser.parse_args()
+
+
+def iterateInputs(inputsIn, manifestIn):
+    # inputs are expanded lazily so memory does not grow with their number
+    for inputPath in iterateInputPaths(inputsIn, manifestIn):
+        if folderExists(inputPath):
+            for filePath in iteratePathTree(inputPath):
+                if isImageFile(filePath):
+                    yield filePath
+        else:
+            yield inputPath
+    return
+
+
+def iterateInputPaths(inputsIn, manifestIn):
+    for inputPath in inputsIn:
+        yield inputPath
+    if manifestIn is not None:
+        if manifestIn == "-":
+            manifest = sys.stdin
+        else:
+            manifest = open(manifestIn, "r")
+        with manifest:
+            for line in manifest:
+                line = line.strip()
+                if len(line) > 0 and not line.startswith("#"):
+                    yield line
+    return
+
+
+###########################
+""" BEGIN BATCH RECORDS """
+###########################
+
+
+def startInput(filePathIn, modeIn=None):
+    # stage 1 - checks the input and identifies the image subject
+    record = newImageToTextRecord(filePathIn, modeIn)
+    with span("input_stage_1", file=filePathIn):
+        if not fileExists(filePathIn):
+            record["error"] = "File does not exist!"
+        elif not isImageFile(filePathIn):
+            record["error"] = "Unsupported file type."
+        else:
+            try:
+                identifyImageSubject("", record)
+            except Exception as e:
+                record["error"] = str(e)
+    return record
+
+
+def finishInput(recordIn):
+    # stage 2 - estimates size/weight and builds the output record
+    with span("input_stage_2", file=recordIn["file"]):
+        try:
+            finishImageToTextRecord(recordIn)
+        except Exception as e:
+            recordIn["error"] = str(e)
+    return formatRecord(recordIn)
+
+
+def formatRecord(recordIn):
+    return {
+        "file": recordIn["file"],
+        "mode": recordIn["mode"],
+        "status": "ok" if recordIn["error"] is None else "error",
+        "object": recordIn["object"],
+        "result": recordIn["result"],
+        "error": recordIn["error"],
+        "cached": recordIn["cached"],
+        "near_duplicate": recordIn["nearDuplicate"],
+        "size_cm": (
+            recordIn["measures"][0:3] if recordIn["measures"] else None
+        ),
+        "weight_g": (
+            recordIn["measures"][3] if recordIn["measures"] else None
+        ),
+        "timings": recordIn["timings"]
+    }
+
+
+def getInputStages(compareIn):
+    if compareIn:
+        return [[compareInput, 1]]
+    return [
+        [startInput, getConfig("stage_one_workers")],
+        [finishInput, getConfig("stage_two_workers")]
+    ]
+
+
+def runBatch(inputsIn, manifestIn, outputIn, compareIn):
+    total = 0
+    failures = 0
+    comparisons = []
+    for record in mapStagesInOrder(
+        getInputStages(compareIn),
+        iterateInputs(inputsIn, manifestIn),
+        getConfig("pipeline_window")
+    ):
+        outputIn.write(json.dumps(record) + "\n")
+        outputIn.flush()
+        total += 1
+        if record["status"] != "ok":
+            failures += 1
+        elif compareIn:
+            comparisons.append(record["comparison"])
+    if compareIn:
+        printComparisonSummary(comparisons)
+    return [total, failures]
+
+
+def runWatch(foldersIn, ledgerPathIn, outputIn):
+    # runs until interrupted - every scan that finds new or changed files
+    # sends just those through the pipeline, and each result is appended to
+    # the ledger before the next one so a restart resumes where it stopped
+    total = 0
+    failures = 0
+    ledger = loadLedger(ledgerPathIn)
+    printInfo(
+        "\nWatching " + ("with inotify" if openInotify() else "by polling")
+        + ", " + str(len(ledger)) + " file(s) already processed."
+    )
+    try:
+        with openLedger(ledgerPathIn) as ledgerFile:
+            for changes in iterateFolderChanges(foldersIn, ledger):
+                for change, record in zip(changes, mapStagesInOrder(
+                    getInputStages(False),
+                    [filePath for filePath, stat in changes],
+                    getConfig("pipeline_window")
+                )):
+                    writeLedgerEntry(ledgerFile, ledger, change[1], record)
+                    outputIn.write(json.dumps(record) + "\n")
+                    outputIn.flush()
+                    total += 1
+                    if record["status"] != "ok":
+                        failures += 1
+    except KeyboardInterrupt:
+        printInfo("\nStopped watching.")
+    finally:
+        closeInotify()
+    return [total, failures]
+
+
+###############################
+""" BEGIN MODE COMPARISON """
+###############################
+
+
+# --mode compare sends every input through both pipeline modes with the
+# caches off - one input and one mode at a time so nothing else competes for
+# the server, and the mode that goes first alternates so neither one always
+# gets the server-side caches warmed up by the other
+__agreementTolerance = 0.2  # relative difference still counted as agreeing
+__compareTurns = itertools.count()
+
+
+def compareInput(filePathIn):
+    modes = getPipelineModes()
+    order = modes if next(__compareTurns) % 2 == 0 else modes[::-1]
+    records = {}
+    for mode in order:
+        records[mode] = finishInput(startInput(filePathIn, mode))
+    records = [records[mode] for mode in modes]
+    comparison = None
+    if all(record["status"] == "ok" for record in records):
+        comparison = compareRecords(records[0], records[1])
+    return {
+        "file": filePathIn,
+        "status": "ok" if comparison is not None else "error",
+        "first_mode": order[0],
+        "comparison": comparison,
+        "records": records
+    }
+
+
+def compareRecords(recordIn, otherRecordIn):
+    # seconds of work per mode (time spent waiting between the stages is
+    # left out), and how far the answers are apart - size and weight as the
+    # relative difference, the dimensions compared largest to smallest
+    comparison = {
+        "seconds": [getWorkSeconds(recordIn), getWorkSeconds(otherRecordIn)],
+        "object_match": (
+            normalizeObjectName(recordIn["object"]) == (
+                normalizeObjectName(otherRecordIn["object"])
+            )
+        ),
+        "size_difference": None,
+        "weight_difference": None
+    }
+    if recordIn["size_cm"] is not None and (
+        otherRecordIn["size_cm"] is not None
+    ):
+        comparison["size_difference"] = max(
+            getRelativeDifference(a, b) for a, b in zip(
+                sorted(recordIn["size_cm"]),
+                sorted(otherRecordIn["size_cm"])
+            )
+        )
+        comparison["weight_difference"] = getRelativeDifference(
+            recordIn["weight_g"],
+            otherRecordIn["weight_g"]
+        )
+    return comparison
+
+
+def getWorkSeconds(recordIn):
+    return sum(
+        seconds for name, seconds in recordIn["timings"].items()
+        if name != "total"
+    )
+
+
+def getRelativeDifference(valueIn, otherValueIn):
+    largest = max(abs(valueIn), abs(otherValueIn))
+    if largest == 0:
+        return 0.0
+    return abs(valueIn - otherValueIn) / largest
+
+
+def printComparisonSummary(comparisonsIn):
+    if len(comparisonsIn) == 0:
+        printInfo("\nNo inputs were processed by both modes.")
+        return
+    modes = getPipelineModes()
+    seconds = [
+        statistics.median(c["seconds"][i] for c in comparisonsIn)
+        for i in range(len(modes))
+    ]
+    printInfo(
+        "\nMedian seconds per input: "
+        "" + ", ".join(
+            f"{mode} {s:0.3f}" for mode, s in zip(modes, seconds)
+        ) + (
+            f" - {modes[1]} {seconds[0] / seconds[1]:0.2f}x as fast"
+            if seconds[1] > 0 else ""
+        )
+    )
+    matches = sum(1 for c in comparisonsIn if c["object_match"])
+    printInfo(
+        "Same object: " + str(matches) + " of "
+        "" + str(len(comparisonsIn)) + " input(s)"
+    )
+    for name in ["size_difference", "weight_difference"]:
+        differences = [
+            c[name] for c in comparisonsIn if c[name] is not None
+        ]
+        if len(differences) > 0:
+            printInfo(
+                name.replace("_", " ").capitalize() + ": median "
+                f"{statistics.median(differences) * 100:0.1f}%, within "
+                f"{__agreementTolerance * 100:0.0f}% for "
+                "" + str(sum(
+                    1 for d in differences if d <= __agreementTolerance
+                )) + " of " + str(len(differences)) + " input(s)"
+            )
+    return
+
+
+##################
+""" BEGIN MAIN """
+##################
+
+
+def main():
+    arguments = getArguments()
+    if len(arguments.inputs) == 0 and arguments.manifest is None:
+        printError("No inputs - pass files, folders or --manifest.")
+        return EXIT_USAGE
+    if arguments.watch and (
+        arguments.manifest is not None or (
+            not all(folderExists(i) for i in arguments.inputs)
+        )
+    ):
+        printError("--watch only takes folders.")
+        return EXIT_USAGE
+    if arguments.watch and arguments.mode == "compare":
+        printError("--watch cannot be used with --mode compare.")
+        return EXIT_USAGE
+    if arguments.manifest not in [None, "-"] and (
+        not fileExists(arguments.manifest)
+    ):
+        printError("Manifest does not exist: " + arguments.manifest)
+        return EXIT_USAGE
+
+    output = sys.stdout
+    # the pipeline prints to sys.stdout, keep that off the record stream
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            if arguments.config is not None:
+                setConfigurationFileName(arguments.config)
+            loadModelConfig()
+            loadConfig()
+        except (OSError, ValueError, KeyError) as e:
+            printError("Cannot load configuration: " + str(e))
+            return EXIT_USAGE
+        if arguments.debug_level is not None:
+            setConfig("debug_level", arguments.debug_level)
+        if arguments.log is not None:
+            setConfig("output_log_file", arguments.log)
+            setOutput()
+        if arguments.window is not None:
+            setConfig("pipeline_window", arguments.window)
+        if arguments.warmup:
+            setConfig("model_warmup", True)
+        compare = arguments.mode == "compare"
+        if compare:
+            # every input is sent to the server in both modes, and these
+            # results are not kept (nor any result from the caches used)
+            setConfig("result_cache_enabled", False)
+            setConfig("object_cache_enabled", False)
+            setConfig("result_store_enabled", False)
+            setConfig("pipeline_window", 1)
+        elif arguments.mode is not None:
+            setConfig("pipeline_mode", arguments.mode)
+
+        startWarmup()
+        if arguments.output is not None:
+            # a restarted watch adds to the records of the previous run
+            output = open(arguments.output, "a" if arguments.watch else "w")
+        try:
+            if arguments.watch:
+                total, failures = runWatch(
+                    arguments.inputs,
+                    arguments.ledger,
+                    output
+                )
+            else:
+                total, failures = runBatch(
+                    arguments.inputs,
+                    arguments.manifest,
+                    output,
+                    compare
+                )
+        except KeyboardInterrupt:
+            printError("\nInterrupted.")
+            return EXIT_INTERRUPTED
+        finally:
+            stopKeepWarm()
+            if output is not sys.stdout:
+                output.close()
+            exportSpans(getConfig("span_trace_format"))
+        printInfo(
+            "\nProcessed " + str(total) + " input(s), "
+            "" + str(failures) + " failed."
+        )
+        flushOutput()
+    if failures > 0:
+        return EXIT_FAILURES
+    return EXIT_SUCCESS
+
+
+if __name__ == "__main__":
+    sys.exit(main())
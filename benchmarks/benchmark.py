@@ -0,0 +1,338 @@
+# offline microbenchmarks for the local (cpu-side) hot paths
+#
+# run from the repository root:
+#     python -m benchmarks.benchmark [--repeat N] [--filter NAME]
+#                                    [--compare output/benchmarks/<file>.json]
+
+
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+
+from modules.file.operation import getPathTree, deleteFilesWithPrefix
+from modules.util.command import loadModelConfig, loadConfig
+from modules.util.configuration import resetModelConfig, setModelConfig
+from modules.util.configuration import setConfig
+from modules.util.conversation import getLastConversationTurns
+from modules.util.conversation import getConversationFilePath
+from modules.util.image import getImageDataUrl, preprocessImage
+from modules.util.model import getModelByNameAndType, buildModelIndex
+from modules.util.output import setOutput
+from modules.util.strings.paths import BENCHMARKS_FILE_PATH
+from modules.util.strings.paths import CONVERSATIONS_FILE_PATH
+from modules.util.util import getPromptHistoryFromConversation
+from modules.util.util import trimTextBySentenceLength, cleanupString
+from modules.util.util import getDateTimeString, printDebug
+
+
+__seed = 1234
+__conversationPrefix = "poc-benchmark-"
+__words = [
+    "apple", "chair", "table", "model", "server", "image", "weight",
+    "size", "object", "llava", "nous", "hermes", "gguf", "q4", "k", "m"
+]
+
+
+############################
+""" BEGIN BENCHMARK DATA """
+############################
+
+
+def getRandom():
+    return random.Random(__seed)
+
+
+def getSentences(randomIn, countIn):
+    sentences = []
+    for i in range(countIn):
+        length = randomIn.randrange(3, 24)
+        sentence = " ".join(randomIn.choice(__words) for j in range(length))
+        sentences.append(
+            sentence.capitalize() + randomIn.choice([".", "!", "?", " 1.5."])
+        )
+    return " ".join(sentences)
+
+
+def getMessyText(randomIn, lengthIn):
+    pieces = []
+    for i in range(lengthIn // 8):
+        pieces.append(randomIn.choice(__words))
+        pieces.append(randomIn.choice([" ", "  ", "\t", "\n", " \r\n", "é"]))
+    return "".join(pieces)
+
+
+def getConversationLines(randomIn, turnsIn):
+    lines = []
+    for i in range(turnsIn):
+        role = ["SYSTEM: ", "USER: ", "ASSISTANT: "][min(i, 1 + i % 2)]
+        lines.append(role + getSentences(randomIn, 2))
+        for j in range(randomIn.randrange(0, 3)):
+            lines.append(getSentences(randomIn, 1))
+    return lines
+
+
+def loadSyntheticModels(randomIn, countIn):
+    resetModelConfig()
+    for i in range(countIn):
+        modelType = randomIn.choice(["image_to_text", "text_to_text"])
+        name = "_".join([
+            modelType,
+            randomIn.choice(__words),
+            randomIn.choice(__words) + "-" + str(randomIn.randrange(1, 70)),
+            str(i)
+        ])
+        setModelConfig(name, {"model_type": modelType})
+    buildModelIndex()
+    return
+
+
+def createPathTree(rootIn, depthIn, fanOutIn, filesIn):
+    if depthIn == 0:
+        return
+    for i in range(filesIn):
+        open(os.path.join(rootIn, "file" + str(i) + ".txt"), "w").close()
+    for i in range(fanOutIn):
+        folder = os.path.join(rootIn, "folder" + str(i))
+        os.mkdir(folder)
+        createPathTree(folder, depthIn - 1, fanOutIn, filesIn)
+    return
+
+
+#############################
+""" BEGIN BENCHMARK CASES """
+#############################
+
+
+def getBenchmarks(workFolderIn):
+    # name -> [setup function, benchmarked function(data)]
+    benchmarks = {}
+
+    for fileName in sorted(os.listdir("tests")):
+        if fileName.split(".")[-1] in ["png", "jpg", "jpeg"]:
+            def setupImage(fileName=fileName):
+                with open("tests/" + fileName, "rb") as f:
+                    return [f.read(), fileName.split(".")[-1]]
+
+            def runImage(data):
+                imageBytes, codec, sizes = preprocessImage(data[0], data[1])
+                return getImageDataUrl(imageBytes, codec)
+            benchmarks["image_preprocess[" + fileName + "]"] = [
+                setupImage,
+                runImage
+            ]
+
+    for count in [1000, 20000]:
+        def setupModels(count=count):
+            loadSyntheticModels(getRandom(), count)
+            return None
+        benchmarks["model_lookup_exact[" + str(count) + "]"] = [
+            setupModels,
+            lambda data: getModelByNameAndType(
+                "text_to_text_apple_chair-7_7", "text_to_text",
+                True, True, True
+            )
+        ]
+        benchmarks["model_lookup_fuzzy[" + str(count) + "]"] = [
+            setupModels,
+            lambda data: getModelByNameAndType(
+                "llava 13b", "image_to_text", True, False, True
+            )
+        ]
+
+    for turns in [100, 5000]:
+        benchmarks["prompt_history[" + str(turns) + " turns]"] = [
+            lambda turns=turns: getConversationLines(getRandom(), turns),
+            lambda data: getPromptHistoryFromConversation(data, "chatml")
+        ]
+
+    for turns in [100, 5000]:
+        def setupConversation(turns=turns):
+            name = __conversationPrefix + str(turns)
+            with open(getConversationFilePath(name), "w") as f:
+                for line in getConversationLines(getRandom(), turns):
+                    f.write(line + "\n")
+            getLastConversationTurns(name, 1)  # builds the index
+            return name
+        benchmarks["conversation_tail[" + str(turns) + " turns]"] = [
+            setupConversation,
+            lambda data: getPromptHistoryFromConversation(
+                getLastConversationTurns(data, 8), "chatml"
+            )
+        ]
+
+    for sentences in [100, 5000]:
+        benchmarks["trim_text[" + str(sentences) + " sentences]"] = [
+            lambda sentences=sentences: getSentences(getRandom(), sentences),
+            lambda data: trimTextBySentenceLength(data, 10 ** 9)
+        ]
+
+    for length in [1000, 1000000]:
+        benchmarks["cleanup_string[" + str(length) + " chars]"] = [
+            lambda length=length: getMessyText(getRandom(), length),
+            cleanupString
+        ]
+
+    for depth in [3, 6]:
+        def setupPathTree(depth=depth):
+            root = os.path.join(workFolderIn, "tree" + str(depth))
+            if not os.path.isdir(root):
+                os.mkdir(root)
+                createPathTree(root, depth, 3, 4)
+            return root
+        benchmarks["path_tree[depth " + str(depth) + "]"] = [
+            setupPathTree,
+            getPathTree
+        ]
+
+    # these change the output configuration, main() reloads it afterwards
+    for bufferBytes in [None, 0, 16384]:
+        def setupLog(bufferBytes=bufferBytes):
+            setConfig("debug_level", 0 if bufferBytes is None else 3)
+            setConfig("output_log_file", os.path.join(workFolderIn, "log"))
+            setConfig("output_buffer_bytes", bufferBytes or 0)
+            setOutput()
+            return getSentences(getRandom(), 1000).split(". ")
+        name = "buffer " + str(bufferBytes)
+        if bufferBytes is None:
+            name = "disabled"
+        benchmarks["log_lines[" + name + "]"] = [
+            setupLog,
+            lambda data: [printDebug(lambda: "\n" + line) for line in data]
+        ]
+
+    return benchmarks
+
+
+##############################
+""" BEGIN BENCHMARK RUNNER """
+##############################
+
+
+def runBenchmark(functionIn, dataIn, repeatIn, minimumTimeIn):
+    # calibrate the number of calls per sample so each sample is measurable
+    number = 1
+    while True:
+        timeStart = time.perf_counter()
+        for i in range(number):
+            functionIn(dataIn)
+        elapsed = time.perf_counter() - timeStart
+        if elapsed >= minimumTimeIn or number >= 2 ** 20:
+            break
+        number *= 2
+    samples = []
+    for i in range(repeatIn):
+        timeStart = time.perf_counter()
+        for j in range(number):
+            functionIn(dataIn)
+        samples.append((time.perf_counter() - timeStart) / number)
+    tracemalloc.start()
+    functionIn(dataIn)
+    currentBytes, peakBytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "calls_per_sample": number,
+        "samples": repeatIn,
+        "min_seconds": min(samples),
+        "median_seconds": statistics.median(samples),
+        "mean_seconds": statistics.mean(samples),
+        "stdev_seconds": (
+            statistics.stdev(samples) if len(samples) > 1 else 0.0
+        ),
+        "peak_memory_bytes": peakBytes
+    }
+
+
+def formatSeconds(secondsIn):
+    for unit, factor in [["s", 1], ["ms", 1e3], ["us", 1e6]]:
+        if secondsIn * factor >= 1:
+            return f"{secondsIn * factor:0.3f} {unit}"
+    return f"{secondsIn * 1e9:0.1f} ns"
+
+
+def compareResults(resultsIn, previousFileIn):
+    with open(previousFileIn, "r") as f:
+        previous = json.load(f)["results"]
+    print("\nCompared to " + previousFileIn + " (median, new / old):")
+    for name, result in resultsIn.items():
+        if name in previous:
+            ratio = result["median_seconds"] / (
+                previous[name]["median_seconds"]
+            )
+            print(f"  {name:<44} {ratio:0.2f}x")
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline microbenchmarks.")
+    parser.add_argument("-r", "--repeat", type=int, default=7)
+    parser.add_argument(
+        "-t", "--min-time",
+        type=float,
+        default=0.05,
+        help="minimum seconds per sample"
+    )
+    parser.add_argument(
+        "-f", "--filter",
+        default="",
+        help="only run benchmarks whose name contains this text"
+    )
+    parser.add_argument("-o", "--output", help="result JSON file")
+    parser.add_argument("-c", "--compare", help="previous result JSON file")
+    arguments = parser.parse_args()
+
+    loadModelConfig()
+    loadConfig()
+
+    workFolder = tempfile.mkdtemp(prefix="poc-benchmark-")
+    results = {}
+    try:
+        for name, benchmark in getBenchmarks(workFolder).items():
+            if arguments.filter not in name:
+                continue
+            setup, function = benchmark
+            data = setup()
+            results[name] = runBenchmark(
+                function,
+                data,
+                arguments.repeat,
+                arguments.min_time
+            )
+            print(
+                f"{name:<46} "
+                f"{formatSeconds(results[name]['median_seconds']):>12} "
+                f"(min {formatSeconds(results[name]['min_seconds'])}, "
+                f"peak {results[name]['peak_memory_bytes'] / 1024:0.0f} KiB)"
+            )
+    finally:
+        loadModelConfig()
+        loadConfig()
+        shutil.rmtree(workFolder, ignore_errors=True)
+        deleteFilesWithPrefix(CONVERSATIONS_FILE_PATH, __conversationPrefix)
+
+    outputFile = arguments.output
+    if outputFile is None:
+        os.makedirs(BENCHMARKS_FILE_PATH, exist_ok=True)
+        outputFile = BENCHMARKS_FILE_PATH + getDateTimeString() + ".json"
+    with open(outputFile, "w") as f:
+        json.dump({
+            "timestamp": getDateTimeString(),
+            "seed": __seed,
+            "repeat": arguments.repeat,
+            "results": results
+        }, f, indent=4)
+    print("\nSaved results to " + outputFile)
+
+    if arguments.compare is not None:
+        compareResults(results, arguments.compare)
+    return
+
+
+if __name__ == "__main__":
+    main()
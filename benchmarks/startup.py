@@ -0,0 +1,170 @@
+# cold-start benchmark for the entry points, one fresh interpreter per run
+#
+# run from the repository root:
+#     python -m benchmarks.startup [--repeat N] [--target MS] [--top N]
+#
+# exits with 1 when an entry point takes longer than the target (measured
+# over a bare "python -c pass"), or when a lazily imported module is
+# imported at startup
+
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+from modules.util.strings.paths import BENCHMARKS_FILE_PATH
+from modules.util.util import getDateTimeString
+
+
+__entryPoints = {
+    "import main": "import main",
+    "import batch": "import batch",
+    "batch ready": (
+        "import batch; batch.loadModelConfig(); batch.loadConfig()"
+    )
+}
+
+
+# imported on first use, so none of these should show up at startup
+__lazyModules = ["requests", "PIL", "difflib", "numpy", "pynput"]
+
+
+############################
+""" BEGIN STARTUP RUNNER """
+############################
+
+
+def runPython(codeIn, importTimeIn=False):
+    # returns [seconds, stderr]
+    command = [sys.executable]
+    if importTimeIn:
+        command += ["-X", "importtime"]
+    command += ["-c", codeIn]
+    timeStart = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True)
+    seconds = time.perf_counter() - timeStart
+    if result.returncode != 0:
+        raise RuntimeError(codeIn + " failed:\n" + result.stderr)
+    return [seconds, result.stderr]
+
+
+def getMedianSeconds(codeIn, repeatIn):
+    runPython(codeIn)  # warm-up, also leaves the bytecode cache behind
+    return statistics.median(runPython(codeIn)[0] for i in range(repeatIn))
+
+
+def getImportTimes(codeIn):
+    # module -> [self microseconds, cumulative microseconds]
+    importTimes = {}
+    for line in runPython(codeIn, True)[1].splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        selfTime, cumulativeTime, moduleName = line[12:].split("|")
+        if not selfTime.strip().isdigit():
+            continue  # header line
+        importTimes[moduleName.strip()] = [
+            int(selfTime),
+            int(cumulativeTime)
+        ]
+    return importTimes
+
+
+def getEagerModules(codeIn):
+    checkCode = (
+        codeIn + "\nimport sys\n"
+        "print(','.join(m for m in " + repr(__lazyModules) + " "
+        "if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", checkCode],
+        capture_output=True,
+        text=True
+    )
+    lines = result.stdout.strip().splitlines()
+    if len(lines) == 0 or len(lines[-1]) == 0:
+        return []
+    return lines[-1].split(",")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start benchmark.")
+    parser.add_argument("-r", "--repeat", type=int, default=9)
+    parser.add_argument(
+        "-t", "--target",
+        type=float,
+        default=150.0,
+        help="maximum milliseconds over a bare interpreter per entry point"
+    )
+    parser.add_argument(
+        "-n", "--top",
+        type=int,
+        default=8,
+        help="number of slowest imports to list per entry point"
+    )
+    parser.add_argument("-o", "--output", help="result JSON file")
+    arguments = parser.parse_args()
+
+    baseline = getMedianSeconds("pass", arguments.repeat)
+    baselineModules = getImportTimes("pass")  # site, .pth files etc.
+    print(f"{'python -c pass':<24} {baseline * 1000:8.1f} ms (baseline)")
+    results = {}
+    failed = False
+    for name, code in __entryPoints.items():
+        seconds = getMedianSeconds(code, arguments.repeat)
+        overhead = (seconds - baseline) * 1000
+        eagerModules = getEagerModules(code)
+        importTimes = getImportTimes(code)
+        slowest = sorted(
+            [i for i in importTimes.items() if i[0] not in baselineModules],
+            key=lambda item: item[1][0],
+            reverse=True
+        )[0:arguments.top]
+        status = "ok"
+        if overhead > arguments.target:
+            status = "over target"
+            failed = True
+        if len(eagerModules) > 0:
+            status = "imports " + ", ".join(eagerModules)
+            failed = True
+        print(
+            f"{name:<24} {seconds * 1000:8.1f} ms "
+            f"(+{overhead:0.1f} ms, target {arguments.target:0.0f} ms) "
+            "" + status
+        )
+        for moduleName, times in slowest:
+            print(
+                f"    {moduleName:<36} self {times[0] / 1000:6.1f} ms, "
+                f"cumulative {times[1] / 1000:6.1f} ms"
+            )
+        results[name] = {
+            "median_seconds": seconds,
+            "overhead_ms": overhead,
+            "eager_modules": eagerModules,
+            "slowest_imports": dict(slowest)
+        }
+
+    outputFile = arguments.output
+    if outputFile is None:
+        os.makedirs(BENCHMARKS_FILE_PATH, exist_ok=True)
+        outputFile = (
+            BENCHMARKS_FILE_PATH + "startup-" + getDateTimeString() + ".json"
+        )
+    with open(outputFile, "w") as f:
+        json.dump({
+            "timestamp": getDateTimeString(),
+            "repeat": arguments.repeat,
+            "target_ms": arguments.target,
+            "baseline_seconds": baseline,
+            "results": results
+        }, f, indent=4)
+    print("\nSaved results to " + outputFile)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
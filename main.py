@@ -1,10 +1,15 @@
-from pynput import keyboard
+import asyncio
+import readline  # unused, but fixes keyboard arrow keys for inputs
+import threading
 
 
 from modules.util.command import loadModelConfig, loadConfig, handlePrompt
 from modules.util.command import commandExit, commandHelp, commandSettings
+from modules.util.command import printJobNotices
 from modules.util.conversation import setConversation, getConversationName
+from modules.util.job import setJobListener
 from modules.util.util import printInput, printGeneric
+from modules.util.warmup import startWarmup
 from modules.util.util import printSeparator, clearWindow, checkEmptyString
 
 
@@ -13,17 +18,20 @@ from modules.util.util import printSeparator, clearWindow, checkEmptyString
 ###########################
 
 
-clearWindow()
+def initialize():
+    clearWindow()
 
-loadModelConfig()
-loadConfig()
+    loadModelConfig()
+    loadConfig()
 
+    setConversation(getConversationName())
 
-setConversation(getConversationName())
+    startWarmup()
 
-printSeparator()
+    printSeparator()
 
-commandSettings()
+    commandSettings()
+    return
 
 
 ##################
@@ -31,19 +39,64 @@ commandSettings()
 ##################
 
 
-def main():
-    printSeparator()
-    prompt = printInput("Enter a prompt (\"/help\" for list of commands)")
-    printSeparator()
-    if not checkEmptyString(prompt):
-        if prompt == "exit" or prompt == "0" or prompt.startswith("/exit"):
-            commandExit()
+async def main():
+    # one iteration per prompt - input() runs on its own daemon thread so
+    # the loop is not blocked on the terminal, Ctrl+C exits right away and
+    # background jobs are reported as soon as they finish
+    loop = asyncio.get_running_loop()
+    prompts = asyncio.Queue()
+    promptReady = threading.Event()
+    setJobListener(lambda job: loop.call_soon_threadsafe(printJobNotices))
+    threading.Thread(
+        target=readPrompts,
+        args=(loop, prompts, promptReady),
+        name="input",
+        daemon=True
+    ).start()
+    try:
+        while True:
+            printJobNotices()
+            printSeparator()
+            promptReady.set()
+            prompt = await prompts.get()
+            printSeparator()
+            if prompt is None:  # end of input
+                commandExit()
+                break
+            if not checkEmptyString(prompt):
+                if prompt == "exit" or prompt == "0" or (
+                    prompt.startswith("/exit")
+                ):
+                    commandExit()
+                    break
+                else:
+                    handlePrompt(prompt)
+            else:
+                commandHelp()
+    finally:
+        setJobListener(None)
+    return
+
+
+def readPrompts(loopIn, promptsIn, promptReadyIn):
+    # asks for the next prompt once the previous one was handled
+    while True:
+        promptReadyIn.wait()
+        promptReadyIn.clear()
+        try:
+            prompt = printInput(
+                "Enter a prompt (\"/help\" for list of commands)"
+            )
+        except EOFError:
+            prompt = None
+        try:
+            loopIn.call_soon_threadsafe(promptsIn.put_nowait, prompt)
+        except RuntimeError:
+            return  # the loop was closed meanwhile
+        if prompt is None:
             return
-        else:
-            handlePrompt(prompt)
-    else:
-        commandHelp()
-    main()
 
 
-main()
+if __name__ == "__main__":
+    initialize()
+    asyncio.run(main())
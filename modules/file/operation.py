@@ -73,3 +73,16 @@ def getPathTree(pathIn):
         if not folderExists(fileName) and fileExists(fileName):
             fileTree.append(fileName)
     return fileTree
+
+
+def iteratePathTree(pathIn):
+    # same files as getPathTree, yielded one at a time in a stable order -
+    # like glob, hidden files and folders are skipped; symlinked folders
+    # are not followed (a link loop would never end)
+    for root, folders, files in os.walk(pathIn):
+        folders[:] = sorted(f for f in folders if not f.startswith("."))
+        for fileName in sorted(files):
+            filePath = os.path.join(root, fileName)
+            if not fileName.startswith(".") and fileExists(filePath):
+                yield filePath
+    return
@@ -3,14 +3,22 @@ import subprocess
 
 
 from modules.file.operation import readFile
+from modules.util.configuration import getConfig
+from modules.util.pipeline import createImageToTextRequest
+from modules.util.pipeline import newImageToTextRecord, identifyImageSubject
+from modules.util.pipeline import finishImageToTextRecord
+from modules.util.span import span
 from modules.util.util import printDump, printError
-from modules.util.util import createImageToTextRequest
 
 
 def getImageText(filePath):
     return createImageToTextRequest("", filePath)
 
 
+def isImageFile(filePath):
+    return getFileExtension(filePath).lower() in getFileMap()[getImageText]
+
+
 def getFileExtension(filePath):
     f = filePath.split(".")
     return f[len(f) - 1]
@@ -29,11 +37,48 @@ def getFileContents(filePath):
                 else:
                     printError("\nFile content is none or empty.")
                     return None
-    content = readFile(filePath, None)
-    printDump("\n" + content)
+    with span("file_read", file=filePath):
+        content = readFile(filePath, None)
+    printDump(lambda: "\n" + content)
     return content
 
 
+def getFileContentsStages():
+    # splits getFileContents in two for mapStagesInOrder, so that the next
+    # image can be identified while the previous one is being estimated
+    return [
+        [startFileContents, getConfig("stage_one_workers")],
+        [finishFileContents, getConfig("stage_two_workers")]
+    ]
+
+
+def startFileContents(filePath):
+    item = {"file": filePath, "record": None, "content": None, "error": None}
+    try:
+        if isImageFile(filePath):
+            item["record"] = identifyImageSubject(
+                "",
+                newImageToTextRecord(filePath)
+            )
+        else:
+            item["content"] = getFileContents(filePath)
+    except Exception as e:
+        item["error"] = str(e)
+    return item
+
+
+def finishFileContents(item):
+    # returns [content, error]
+    try:
+        if item["record"] is not None:
+            record = finishImageToTextRecord(item["record"])
+            item["content"] = record["result"]
+            item["error"] = record["error"]
+    except Exception as e:
+        item["error"] = str(e)
+    return [item["content"], item["error"]]
+
+
 # only support linux
 
 
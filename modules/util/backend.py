@@ -0,0 +1,196 @@
+# this file holds the routing of requests over one or more servers
+# ("address" in the configuration may be a list)
+
+
+import itertools
+import threading
+import time
+
+
+from modules.util.configuration import getConfig
+from modules.util.session import sendRequest, isCircuitOpen
+from modules.util.session import isRecordingLatencies, getRequestDeadline
+from modules.util.session import isIdempotentRequest
+
+
+__backends = {}  # address -> backend state
+__backendsLock = threading.Lock()
+__backendTurns = itertools.count()  # rotates ties between servers
+__latencyWeight = 0.2  # of the newest sample in the moving average
+__backendStats = {
+    "failovers": 0
+}
+
+
+def getBackend(addressIn):
+    backend = __backends.get(addressIn)
+    if backend is None:
+        with __backendsLock:
+            backend = __backends.setdefault(addressIn, {
+                "outstanding": 0,
+                "requests": 0,
+                "failures": 0,
+                "latencies": {},  # endpoint -> moving average seconds
+                "models": None  # model ids, None until the server is asked
+            })
+    return backend
+
+
+def getBackendAddresses():
+    return getConfig("addresses")
+
+
+def getBackendUrl(addressIn, endpointIn):
+    return addressIn.replace("/v1", "/") + endpointIn
+
+
+def setBackendModels(addressIn, modelIdsIn):
+    getBackend(addressIn)["models"] = set(modelIdsIn)
+    return
+
+
+def getBackendsWithModel(modelIn):
+    # servers known to have the model, and those not asked yet
+    addresses = []
+    for address in getBackendAddresses():
+        models = getBackend(address)["models"]
+        if models is None or modelIn in models:
+            addresses.append(address)
+    return addresses
+
+
+def isBackendHealthy(addressIn):
+    return not isCircuitOpen(addressIn)
+
+
+def getBackendOrder(endpointIn, modelIn):
+    # servers to try, best first - healthy servers known to have the model
+    # come first, then healthy ones that were not asked yet, and only when
+    # there are none of those the ones with an open circuit
+    addresses = getBackendAddresses()
+    if len(addresses) == 1:
+        return addresses
+    turn = next(__backendTurns) % len(addresses)
+    addresses = addresses[turn:] + addresses[0:turn]
+    healthy = [a for a in addresses if isBackendHealthy(a)]
+    if len(healthy) == 0:
+        healthy = addresses
+    if modelIn is not None:
+        withModel = [
+            a for a in healthy
+            if getBackend(a)["models"] is not None and (
+                modelIn in getBackend(a)["models"]
+            )
+        ]
+        unknown = [a for a in healthy if getBackend(a)["models"] is None]
+        if len(withModel) + len(unknown) > 0:
+            healthy = withModel + unknown
+    return sorted(
+        healthy,
+        key=lambda a: getBackendScore(a, endpointIn)
+    )
+
+
+def getBackendScore(addressIn, endpointIn):
+    backend = getBackend(addressIn)
+    if getConfig("backend_routing") == "latency":
+        # servers without a measurement yet are tried first
+        latency = backend["latencies"].get(endpointIn, 0.0)
+        return latency * (backend["outstanding"] + 1)
+    return backend["outstanding"]
+
+
+def sendBackendRequest(
+    endpointIn,
+    modelIn=None,
+    addressIn=None,
+    dataIn=None,
+    fileIn=None,
+    streamIn=False
+):
+    # sends to addressIn, or to the best server for the model - requests
+    # that are safe to repeat fail over to the next server on an error or a
+    # 5xx response, all servers within one request_deadline
+    addresses = [addressIn]
+    if addressIn is None:
+        addresses = getBackendOrder(endpointIn, modelIn)
+    deadline = getRequestDeadline()
+    for i in range(len(addresses)):
+        url = getBackendUrl(addresses[i], endpointIn)
+        backend = getBackend(addresses[i])
+        with __backendsLock:
+            backend["outstanding"] += 1
+            backend["requests"] += 1
+        timeStart = time.monotonic()
+        try:
+            response = sendRequest(
+                url,
+                dataIn=dataIn,
+                fileIn=fileIn,
+                streamIn=streamIn,
+                deadlineIn=deadline
+            )
+        except OSError as e:
+            with __backendsLock:
+                backend["failures"] += 1
+            if i + 1 == len(addresses) or isinstance(e, TimeoutError) or (
+                not isIdempotentRequest(url, fileIn)
+            ):
+                # last server, unsafe to repeat, or the deadline is spent
+                raise
+            with __backendsLock:
+                __backendStats["failovers"] += 1
+            continue
+        finally:
+            with __backendsLock:
+                backend["outstanding"] -= 1
+        if isRecordingLatencies():
+            addBackendLatency(
+                backend,
+                endpointIn,
+                time.monotonic() - timeStart
+            )
+        if response.status_code >= 500:
+            with __backendsLock:
+                backend["failures"] += 1
+            if i + 1 < len(addresses) and isIdempotentRequest(url, fileIn):
+                with __backendsLock:
+                    __backendStats["failovers"] += 1
+                response.close()
+                continue
+        return response
+
+
+def addBackendLatency(backendIn, endpointIn, secondsIn):
+    with __backendsLock:
+        latency = backendIn["latencies"].get(endpointIn)
+        if latency is None:
+            latency = secondsIn
+        else:
+            latency += (secondsIn - latency) * __latencyWeight
+        backendIn["latencies"][endpointIn] = latency
+    return
+
+
+def getBackendStats():
+    # address -> state, for the servers in the current configuration
+    stats = {}
+    for address in getBackendAddresses():
+        backend = getBackend(address)
+        with __backendsLock:
+            stats[address] = {
+                "healthy": isBackendHealthy(address),
+                "outstanding": backend["outstanding"],
+                "requests": backend["requests"],
+                "failures": backend["failures"],
+                "latencies": dict(backend["latencies"]),
+                "models": (
+                    None if backend["models"] is None
+                    else len(backend["models"])
+                )
+            }
+    return stats
+
+
+def getBackendFailovers():
+    return __backendStats["failovers"]
@@ -0,0 +1,169 @@
+# this file holds the content-addressed result caches (memory + disk)
+
+
+import hashlib
+import json
+import os
+import threading
+
+
+from collections import OrderedDict
+
+
+from modules.util.configuration import getConfig
+from modules.util.strings.paths import CACHE_FILE_PATH
+
+
+__caches = {}  # namespace -> cache state
+__cachesLock = threading.Lock()
+
+
+def getCache(namespaceIn):
+    cache = __caches.get(namespaceIn)
+    if cache is None:
+        with __cachesLock:
+            cache = __caches.get(namespaceIn)
+            if cache is None:
+                cache = {
+                    "memory": OrderedDict(),
+                    "lock": threading.Lock(),
+                    "diskBytes": None,  # computed on first write
+                    "stats": {
+                        "memoryHits": 0,
+                        "diskHits": 0,
+                        "misses": 0,
+                        "writes": 0,
+                        "evictions": 0
+                    }
+                }
+                __caches[namespaceIn] = cache
+    return cache
+
+
+def getCacheKey(partsIn):
+    # parts are length-prefixed so ("ab", "c") and ("a", "bc") differ
+    digest = hashlib.sha256()
+    for part in partsIn:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(str(len(part)).encode("ascii") + b":")
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def getCacheFolder(namespaceIn):
+    return CACHE_FILE_PATH + namespaceIn + "/"
+
+
+def getCacheFilePath(namespaceIn, keyIn):
+    return getCacheFolder(namespaceIn) + keyIn[0:2] + "/" + keyIn + ".json"
+
+
+def isCacheEnabled():
+    return getConfig("result_cache_enabled")
+
+
+def getCachedResult(namespaceIn, keyIn):
+    if not isCacheEnabled() or getConfig("result_cache_refresh"):
+        return None
+    cache = getCache(namespaceIn)
+    with cache["lock"]:
+        if keyIn in cache["memory"]:
+            cache["memory"].move_to_end(keyIn)
+            cache["stats"]["memoryHits"] += 1
+            return cache["memory"][keyIn]
+    filePath = getCacheFilePath(namespaceIn, keyIn)
+    try:
+        with open(filePath, "r") as f:
+            result = json.load(f)
+        os.utime(filePath)  # mtime doubles as the disk lru timestamp
+    except (OSError, ValueError):
+        with cache["lock"]:
+            cache["stats"]["misses"] += 1
+        return None
+    with cache["lock"]:
+        cache["stats"]["diskHits"] += 1
+        setMemoryResult(cache, keyIn, result)
+    return result
+
+
+def setCachedResult(namespaceIn, keyIn, resultIn):
+    if not isCacheEnabled():
+        return
+    cache = getCache(namespaceIn)
+    with cache["lock"]:
+        setMemoryResult(cache, keyIn, resultIn)
+        cache["stats"]["writes"] += 1
+    filePath = getCacheFilePath(namespaceIn, keyIn)
+    os.makedirs(os.path.dirname(filePath), exist_ok=True)
+    data = json.dumps(resultIn).encode("utf-8")
+    tempFilePath = filePath + "." + str(threading.get_ident()) + ".tmp"
+    with open(tempFilePath, "wb") as f:
+        f.write(data)
+    os.replace(tempFilePath, filePath)
+    with cache["lock"]:
+        if cache["diskBytes"] is None:
+            cache["diskBytes"] = getDiskUsage(namespaceIn)[0]
+        else:
+            cache["diskBytes"] += len(data)
+        if cache["diskBytes"] > getConfig("result_cache_max_bytes"):
+            evictDiskResults(namespaceIn, cache)
+    return
+
+
+def setMemoryResult(cacheIn, keyIn, resultIn):
+    memory = cacheIn["memory"]
+    memory[keyIn] = resultIn
+    memory.move_to_end(keyIn)
+    while len(memory) > getConfig("result_cache_memory_entries"):
+        memory.popitem(last=False)
+    return
+
+
+def getDiskUsage(namespaceIn):
+    totalBytes = 0
+    entries = []
+    for root, folders, files in os.walk(getCacheFolder(namespaceIn)):
+        for fileName in files:
+            if fileName.endswith(".json"):
+                filePath = os.path.join(root, fileName)
+                try:
+                    stat = os.stat(filePath)
+                except OSError:
+                    continue
+                totalBytes += stat.st_size
+                entries.append((stat.st_mtime, stat.st_size, filePath))
+    return [totalBytes, entries]
+
+
+def evictDiskResults(namespaceIn, cacheIn):
+    # drop the least recently used files until 90% of the budget is left
+    totalBytes, entries = getDiskUsage(namespaceIn)
+    targetBytes = getConfig("result_cache_max_bytes") * 0.9
+    for mtime, size, filePath in sorted(entries):
+        if totalBytes <= targetBytes:
+            break
+        try:
+            os.remove(filePath)
+        except OSError:
+            continue
+        cacheIn["memory"].pop(os.path.basename(filePath)[0:-5], None)
+        cacheIn["stats"]["evictions"] += 1
+        totalBytes -= size
+    cacheIn["diskBytes"] = totalBytes
+    return
+
+
+def getCacheStats(namespaceIn):
+    cache = getCache(namespaceIn)
+    with cache["lock"]:
+        return cache["stats"] | {"memoryEntries": len(cache["memory"])}
+
+
+def getCacheHitRate(namespaceIn):
+    stats = getCacheStats(namespaceIn)
+    hits = stats["memoryHits"] + stats["diskHits"]
+    lookups = hits + stats["misses"]
+    if lookups == 0:
+        return None
+    return hits / lookups
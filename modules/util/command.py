@@ -2,27 +2,41 @@ import json
 import os
 
 
-from modules.file.operation import readFile, deleteFile
+from modules.util.backend import getBackendStats, getBackendFailovers
+from modules.util.cache import getCacheHitRate
 from modules.util.configuration import setConfigurationFileName
 from modules.util.configuration import getConfigurationFileName
 from modules.util.configuration import loadConfiguration
 from modules.util.configuration import loadModelConfiguration
 from modules.util.configuration import setConfig, getConfig
 from modules.util.conversation import getConversationName, setConversation
+from modules.util.conversation import getConversationCatalog
+from modules.util.conversation import searchConversations
+from modules.util.conversation import deleteEmptyConversations
+from modules.util.job import submitJob, getJobs, getJobSeconds
+from modules.util.job import getFinishedJobNotices, isJobFinished
+from modules.util.job import waitForJobs, clearFinishedJobs, cancelJobs
 from modules.util.model import getModelFromConfiguration
 from modules.util.model import getModelByNameAndType, getModelsWithType
-from modules.util.model import modelScanner, getModelTypes
-from modules.util.strings.paths import CONFIGS_PATH, CONVERSATIONS_FILE_PATH
+from modules.util.model import modelScanner, getModelTypes, buildModelIndex
+from modules.util.output import setOutput
+from modules.util.pipeline import getPipelineModes
+from modules.util.session import resetSessions, getRequestStats
+from modules.util.span import setSpansEnabled
+from modules.util.strings.paths import CONFIGS_PATH
 from modules.util.strings.endpoints import MODELS_APPLY_ENDPOINT
 from modules.util.strings.endpoints import MODELS_AVAILABLE_ENDPOINT
-from modules.util.strings.endpoints import MODELS_ENDPOINT
-from modules.util.trigger import checkTriggers
+from modules.util.strings.endpoints import TEXT_ENDPOINT
+from modules.util.trigger import checkTriggers, getTriggerToCall, callTrigger
 from modules.util.util import printGeneric, printMenu, getStringMatchPercentage
 from modules.util.util import printError, printSeparator, clearWindow
 from modules.util.util import printGreen, printRed, printDebug
-from modules.util.util import checkEmptyString
+from modules.util.util import printResponse
 from modules.util.util import printInput, sendCurlCommand
-from modules.util.util import getRandomSeed
+from modules.util.util import getRandomSeed, getModelsFromServer
+from modules.util.util import getModelCatalogStats, invalidateModelCatalog
+from modules.util.util import getStreamingStats
+from modules.util.warmup import stopKeepWarm
 
 
 def getCommandMap():
@@ -32,6 +46,7 @@ def getCommandMap():
         commandConfig:          ["/config",         "General",      "Reload the configuration files."],
         commandSettings:        ["/settings",       "General",      "Prints all current settings."],
         commandExit:            ["/exit",           "General",      "Exits the program."],
+        commandJobs:            ["/jobs",           "General",      "List background prompts and show their results."],
 
         commandConvo:           ["/convo",          "Settings",     "Change the conversation file."],
         commandModel:           ["/model",          "Settings",     "Change models."],
@@ -82,10 +97,10 @@ def commandConfig():
         "Reload"
     ]
 
-    def menu():
+    while True:
         selection = printMenu("Configuration menu", "", choices)
         if selection is None:
-            return
+            break
         elif selection == "Load":
             submenuConfigLoad()
         elif selection == "Reload":
@@ -93,9 +108,6 @@ def commandConfig():
         else:
             printError("\nInvalid selection.\n")
         printSeparator()
-        menu()
-        return
-    menu()
     printGeneric("\nReturning to main menu.\n")
     return
 
@@ -139,12 +151,15 @@ def submenuConfigLoad():
         if len(selection) > 0:
             nextConfiguration = config_verifier(selection)
             if nextConfiguration[1]:
+                previousConfiguration = getConfigurationFileName()
                 setConfigurationFileName(nextConfiguration[0])
-                printGreen(
-                    "\nConfiguration set to " + nextConfiguration[0] + "\n"
-                )
                 loadModelConfig()
-                loadConfig()
+                if tryLoadConfig():
+                    printGreen(
+                        "\nConfiguration set to " + nextConfiguration[0] + "\n"
+                    )
+                else:
+                    setConfigurationFileName(previousConfiguration)
             else:
                 printError(
                     "\nCannot find configuration - "
@@ -161,11 +176,25 @@ def submenuConfigLoad():
 
 def submenuConfigReload():
     loadModelConfig()
-    loadConfig()
-    printGreen("\nConfiguration reloaded.\n")
+    if tryLoadConfig():
+        printGreen("\nConfiguration reloaded.\n")
     return
 
 
+def tryLoadConfig():
+    # for the menus - a bad configuration file is reported and the current
+    # configuration kept, returns whether the file was loaded
+    try:
+        loadConfig()
+    except ValueError as e:
+        printError(
+            "\nCannot load configuration: " + str(e) + "\n"
+            "Keeping the current configuration.\n"
+        )
+        return False
+    return True
+
+
 def commandSettings():
     printGeneric("\nConfiguration File:")
     printGeneric(getConfigurationFileName())
@@ -180,49 +209,187 @@ def commandSettings():
 
     printGeneric("\nConversation file: " + getConversationName() + ".convo")
 
+    printGeneric("\nResult caches (hit rate):")
+    for cacheName in ["image_to_text", "object_estimate"]:
+        hitRate = getCacheHitRate(cacheName)
+        printGeneric(
+            cacheName + ": " + (
+                "-" if hitRate is None else f"{hitRate * 100:0.1f}%"
+            )
+        )
+
+    requestStats = getRequestStats()
+    printGeneric(
+        "\nRequests: " + str(requestStats["requests"]) + " sent, "
+        "" + str(requestStats["retries"]) + " retries, "
+        "" + str(requestStats["hedges"]) + " hedged "
+        "(" + str(requestStats["hedgeWins"]) + " won), "
+        "" + str(requestStats["deadlinesExceeded"]) + " past the deadline"
+    )
+    for hostKey in requestStats["openCircuits"]:
+        printRed("Circuit open: " + hostKey)
+
+    printGeneric(
+        "\nServers (" + getConfig("backend_routing") + ", "
+        "" + str(getBackendFailovers()) + " failovers):"
+    )
+    for address, stats in getBackendStats().items():
+        latency = stats["latencies"].get(TEXT_ENDPOINT)
+        printGeneric(
+            address + ": " + ("up" if stats["healthy"] else "DOWN") + ", "
+            "" + str(stats["outstanding"]) + " in flight, "
+            "" + str(stats["requests"]) + " requests, "
+            "" + str(stats["failures"]) + " failed, "
+            "" + ("-" if stats["models"] is None else str(stats["models"]))
+            + " models, chat latency " + (
+                "-" if latency is None else f"{latency:0.2f}s"
+            )
+        )
+
+    streamingStats = getStreamingStats()
+    if len(streamingStats) > 0:
+        printGeneric("\nStreaming (mean time to first token, tokens/second):")
+        for modelName, stats in streamingStats.items():
+            printGeneric(
+                modelName + ": "
+                f"{stats['meanFirstTokenSeconds']:0.3f}s, " + (
+                    "n/a" if stats["tokensPerSecond"] is None
+                    else f"{stats['tokensPerSecond']:0.1f}"
+                )
+            )
+
     printGeneric("")
     return
 
 
 def commandExit():
-    for conversation in os.listdir(CONVERSATIONS_FILE_PATH):
-        if conversation.endswith(".convo"):
-            if checkEmptyString(
-                readFile(
-                    CONVERSATIONS_FILE_PATH + conversation,
-                    None
-                )
-            ):
-                deleteFile(CONVERSATIONS_FILE_PATH + conversation)
-                printDebug(
-                    "\nDeleted empty conversation file: " + conversation
-                )
+    # queued prompts are dropped, running ones are waited for
+    stopKeepWarm()
+    cancelJobs()
+    if len([job for job in getJobs() if not isJobFinished(job)]) > 0:
+        printGeneric("\nWaiting for running jobs to finish...")
+        waitForJobs()
+    printJobNotices()
+
+    for conversation in deleteEmptyConversations():
+        printDebug(
+            "\nDeleted empty conversation file: " + conversation + ".convo"
+        )
 
     printGeneric("")
     return
 
 
-# Settings Commands
+def commandJobs():
+    choices = [
+        "List",
+        "Result",
+        "Wait",
+        "Clear"
+    ]
 
+    while True:
+        selection = printMenu("Jobs menu", "", choices)
+        if selection is None:
+            break
+        elif selection == "List":
+            submenuJobsList()
+        elif selection == "Result":
+            submenuJobsResult()
+        elif selection == "Wait":
+            printGeneric("\nWaiting for all jobs to finish...")
+            waitForJobs()
+            printJobNotices()
+        elif selection == "Clear":
+            clearFinishedJobs()
+            printGreen("\nCleared finished jobs.\n")
+        else:
+            printError("\nInvalid selection.\n")
+        printSeparator()
+    printGeneric("\nReturning to main menu.\n")
+    return
 
-def commandConvo():
-    convoList = []
 
-    for conversation in os.listdir(CONVERSATIONS_FILE_PATH):
-        if conversation.endswith(".convo"):
-            convoName = conversation.replace(".convo", "")
-            convoList.append(convoName)
+def submenuJobsList():
+    jobs = getJobs()
+    if len(jobs) == 0:
+        printGeneric("\nNo jobs.\n")
+        return
+    printGeneric("\nJobs:\n")
+    for job in jobs:
+        printGeneric(" - " + formatJob(job))
+    printGeneric("")
+    return
 
-    choices = convoList
+
+def submenuJobsResult():
+    jobs = [job for job in getJobs() if isJobFinished(job)]
+    choices = [formatJob(job) for job in jobs]
+    selection = printMenu("Finished jobs", "", choices)
+    if selection is not None:
+        for job, choice in zip(jobs, choices):
+            if selection == choice or selection == str(job["id"]):
+                job["notified"] = True
+                printJobResult(job)
+                return
+        printError("\nInvalid selection - returning to jobs menu.\n")
+    return
+
+
+def formatJob(jobIn):
+    description = jobIn["description"]
+    if len(description) > 60:
+        description = description[0:57] + "..."
+    return (
+        "Job " + str(jobIn["id"]) + " [" + jobIn["state"] + ", "
+        f"{getJobSeconds(jobIn):0.1f}s]: " + description
+    )
+
+
+def printJobResult(jobIn):
+    if jobIn["state"] == "failed":
+        printError("\nJob " + str(jobIn["id"]) + " failed: " + jobIn["error"])
+    elif jobIn["result"] is None:
+        printRed("\nJob " + str(jobIn["id"]) + " returned no result.")
+    else:
+        printGreen("\nJob " + str(jobIn["id"]) + ": " + jobIn["description"])
+        printResponse("\n" + jobIn["result"] + "\n")
+    return
+
+
+def printJobNotices():
+    for job in getFinishedJobNotices():
+        printJobResult(job)
+    return
+
+
+# Settings Commands
+
+
+def commandConvo():
+    catalog = getConversationCatalog()
+    choices = [
+        convoName + " (" + str(entry["turns"]) + " turns)"
+        "" + (": " + entry["preview"] if len(entry["preview"]) > 0 else "")
+        for convoName, entry in catalog.items()
+    ]
 
     def convo_verifier(convoNameIn):
         if len(convoNameIn) > 0:
-            for conversation in convoList:
-                if convoNameIn in conversation:
-                    return conversation
+            # a listed choice, or (part of) a conversation name
+            for convoName, choice in zip(catalog.keys(), choices):
+                if convoNameIn == choice:
+                    return convoName
+            matches = searchConversations(convoNameIn)
+            if len(matches) > 0:
+                return matches[0]
         return convoNameIn
 
-    selection = printMenu("Conversations available", "", choices)
+    selection = printMenu(
+        "Conversations available",
+        "(Newest first - type a name, or part of one, to search)",
+        choices
+    )
     if selection is not None:
         if len(selection) > 0:
             conversationName = convo_verifier(selection)
@@ -241,7 +408,7 @@ def commandConvo():
 def commandModel():
     choices = list(getModelTypes().values())
 
-    def menu():
+    while True:
         selection = printMenu(
             "Model menu",
             "(Tip: You can use spaces to match for long model names!)",
@@ -249,7 +416,7 @@ def commandModel():
         )
         matched = False
         if selection is None:
-            return
+            break
         else:
             for k, v in getModelTypes().items():
                 if selection == v:
@@ -259,9 +426,6 @@ def commandModel():
             if not matched:
                 printError("\nInvalid selection.\n")
         printSeparator()
-        menu()
-        return
-    menu()
     printGeneric("\nReturning to main menu.\n")
     return
 
@@ -317,28 +481,42 @@ def commandCurl():
         "Raw"
     ]
 
-    def menu():
+    while True:
         selection = printMenu("cURL menu", "", choices)
         if selection is None:
-            return
+            break
         elif selection == "Apply":
             sendCurlCommand(MODELS_APPLY_ENDPOINT)
         elif selection == "Available":
             sendCurlCommand(MODELS_AVAILABLE_ENDPOINT)
         elif selection == "Models":
-            sendCurlCommand(MODELS_ENDPOINT)
+            submenuCurlModels()
         elif selection == "Raw":
             submenuCurlRaw()
         else:
             printError("\nInvalid selection.\n")
         printSeparator()
-        menu()
-        return
-    menu()
     printGeneric("\nReturning to main menu.\n")
     return
 
 
+def submenuCurlModels():
+    modelList = getModelsFromServer(True)
+    if modelList is not None:
+        printGeneric("\nModels on the server:\n")
+        for model in modelList:
+            printGeneric(" - " + model["id"])
+        stats = getModelCatalogStats()
+        printDebug(
+            "\nModel catalog: " + str(stats["hits"]) + " hits, "
+            "" + str(stats["misses"]) + " misses, "
+            "" + str(stats["refreshes"]) + " refreshes, "
+            "" + str(stats["invalidations"]) + " invalidations"
+        )
+        printGeneric("")
+    return
+
+
 def submenuCurlRaw():
     dest = printInput("Enter the endpoint (eg. v1/chat/completions)")
     printSeparator()
@@ -355,11 +533,27 @@ def commandModelScanner():
 
 def loadModelConfig():
     loadModelConfiguration()
+    buildModelIndex()
+    return
+
+
+def checkConfig(configIn):
+    # raises ValueError for a bad configuration, before it is applied
+    if configIn.get("pipeline_mode") not in getPipelineModes():
+        # a typo would otherwise run two-stage but be recorded as given
+        raise ValueError(
+            "pipeline_mode must be one of " + ", ".join(getPipelineModes())
+            + ", not \"" + str(configIn.get("pipeline_mode")) + "\""
+        )
     return
 
 
 def loadConfig():
-    loadConfiguration()
+    loadConfiguration(checkConfig)
+    setOutput()
+    setSpansEnabled(getConfig("span_tracing"))
+    resetSessions()
+    invalidateModelCatalog()
 
     for modelType in list(getModelTypes()):
         setConfig(
@@ -377,7 +571,25 @@ def loadConfig():
 def handlePrompt(promptIn):
     if not checkCommands(promptIn):
         seed = getRandomSeed()
-        checkTriggers(promptIn, seed)
+        if getConfig("background_jobs"):
+            submitPrompt(promptIn, seed)
+        else:
+            checkTriggers(promptIn, seed)
+    return
+
+
+def submitPrompt(promptIn, seedIn):
+    # runs the trigger as a background job, the result is printed at the
+    # next prompt (or through /jobs)
+    triggerToCall = getTriggerToCall(promptIn)
+    if triggerToCall is None:
+        printDebug("\nNo triggers detected.")
+        return
+    job = submitJob(promptIn, callTrigger, triggerToCall, promptIn, seedIn)
+    printGreen(
+        "\nSubmitted job " + str(job["id"]) + " - "
+        "keep prompting, or use /jobs to follow it.\n"
+    )
     return
 
 
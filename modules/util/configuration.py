@@ -11,8 +11,10 @@ from modules.util.strings.paths import MODELS_CONFIG_FILE_NAME
 
 __configs = {}  # main configuration
 __modelConfigs = {}  # model configuration
+__modelConfigVersion = 0  # bumped on every change, see model.py index
 __configurationFileName = CONFIGS_FILE_NAME
 __defaultModelName = ""
+__debugLevel = 0  # cached, it is checked on every print
 
 
 def getConfig(keyIn):
@@ -20,14 +22,21 @@ def getConfig(keyIn):
 
 
 def setConfig(keyIn, settingIn):
-    global __configs
+    global __configs, __debugLevel
     __configs[keyIn] = settingIn
+    if keyIn == "debug_level":
+        __debugLevel = settingIn
     return
 
 
+def getDebugLevel():
+    return __debugLevel
+
+
 def resetConfig():
-    global __configs
+    global __configs, __debugLevel
     __configs = {}
+    __debugLevel = 0
     return
 
 
@@ -41,31 +50,50 @@ def getModelConfigAll():
 
 
 def setModelConfig(keyIn, settingIn):
-    global __modelConfigs
+    global __modelConfigs, __modelConfigVersion
     __modelConfigs[keyIn] = settingIn
+    __modelConfigVersion += 1
     return
 
 
 def resetModelConfig():
-    global __modelConfigs
+    global __modelConfigs, __modelConfigVersion
     __modelConfigs = {}
+    __modelConfigVersion += 1
     return
 
 
-def loadConfiguration():
-    resetConfig()
+def getModelConfigVersion():
+    return __modelConfigVersion
+
+
+def loadConfiguration(checkConfigIn=None):
+    # checkConfigIn(newConfig) raises on a bad file before anything is
+    # applied, the current configuration is then kept as it was
     newConfig = json.loads(
         readFile(CONFIGS_PATH + __configurationFileName, None)
     )
+    if checkConfigIn is not None:
+        checkConfigIn(newConfig)
+    resetConfig()
     for k, v in newConfig.items():
         if not k.endswith("_desc") and not k.endswith("_section"):
             setConfig(k, v)
 
-    if not getConfig("address").endswith("/v1"):
-        newAddress = getConfig("address")
-        if not newAddress.endswith("/"):
-            newAddress += "/"
-        setConfig("address", newAddress + "v1")
+    # "address" may also be a list of servers - "addresses" always holds
+    # the list, and "address" the first one
+    addresses = getConfig("address")
+    if isinstance(addresses, str):
+        addresses = [addresses]
+    newAddresses = []
+    for newAddress in addresses:
+        if not newAddress.endswith("/v1"):
+            if not newAddress.endswith("/"):
+                newAddress += "/"
+            newAddress += "v1"
+        newAddresses.append(newAddress)
+    setConfig("addresses", newAddresses)
+    setConfig("address", newAddresses[0])
     return
 
 
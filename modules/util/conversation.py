@@ -1,27 +1,344 @@
+import json
+import os
+import struct
+import threading
+
+
 from modules.file.operation import appendFile, readFile, writeFile
+from modules.file.operation import deleteFile
 from modules.util.strings.paths import CONVERSATIONS_FILE_PATH
-from modules.util.util import getDateTimeString
+from modules.util.strings.paths import CONVERSATIONS_CATALOG_FILE_PATH
+from modules.util.util import getDateTimeString, checkEmptyString
 
 
 __strConvoTimestamp = getDateTimeString()
 __strConvoName = __strConvoTimestamp
 
 
+# the .convo file stays plain text, a turn being a "ROLE: " line followed
+# by any continuation lines - the .convo.index sidecar holds the byte offset
+# and role of every turn, so turns can be read without reading the file:
+#
+#     header: magic, .convo bytes indexed so far, turns indexed so far
+#     record: turn start offset, role
+__indexHeader = struct.Struct("<4sQQ")
+__indexRecord = struct.Struct("<QB")
+__indexMagic = b"CVI2"
+__roles = [b"SYSTEM: ", b"USER: ", b"ASSISTANT: "]
+__roleNames = ["SYSTEM", "USER", "ASSISTANT"]
+__roleNone = 255  # text before the first role line
+__conversationLock = threading.RLock()
+__catalog = None  # name -> entry, loaded on first use
+__catalogDirty = False
+__catalogPreviewLength = 80
+
+
 def writeConversation(convoNameIn, strIn):
-    appendFile(CONVERSATIONS_FILE_PATH + convoNameIn + ".convo", strIn + "\n")
+    with __conversationLock:
+        appendFile(getConversationFilePath(convoNameIn), strIn + "\n")
+        turns = updateConversationIndex(convoNameIn)
+        updateCatalogEntry(convoNameIn, turns)
     return
 
 
 def getConversation(convoNameIn):
-    return readFile(CONVERSATIONS_FILE_PATH + convoNameIn + ".convo", "\n")
+    return readFile(getConversationFilePath(convoNameIn), "\n")
 
 
 def setConversation(fileNameIn):
     global __strConvoName
-    writeFile(CONVERSATIONS_FILE_PATH + fileNameIn + ".convo")
+    writeFile(getConversationFilePath(fileNameIn))
     __strConvoName = fileNameIn
     return
 
 
+def deleteConversation(convoNameIn):
+    global __catalogDirty
+    with __conversationLock:
+        deleteFile(getConversationFilePath(convoNameIn))
+        deleteFile(getConversationIndexFilePath(convoNameIn))
+        if __catalog is not None and convoNameIn in __catalog:
+            del __catalog[convoNameIn]
+            __catalogDirty = True
+    return
+
+
 def getConversationName():
     return __strConvoName
+
+
+def getConversationFilePath(convoNameIn):
+    return CONVERSATIONS_FILE_PATH + convoNameIn + ".convo"
+
+
+def getConversationIndexFilePath(convoNameIn):
+    return getConversationFilePath(convoNameIn) + ".index"
+
+
+###################################
+""" BEGIN CONVERSATION INDEXING """
+###################################
+
+
+def updateConversationIndex(convoNameIn):
+    # indexes whatever was appended since the last call, or everything when
+    # the index is missing or does not match the .convo file (returns the
+    # number of turns)
+    convoPath = getConversationFilePath(convoNameIn)
+    indexPath = getConversationIndexFilePath(convoNameIn)
+    if not os.path.isfile(convoPath):
+        return 0
+    convoBytes = os.path.getsize(convoPath)
+    if not os.path.isfile(indexPath):
+        open(indexPath, "wb").close()
+    with open(indexPath, "r+b") as f:
+        indexedBytes, turns = readIndexHeader(f, convoBytes)
+        if indexedBytes == convoBytes:
+            return turns
+        f.seek(__indexHeader.size + turns * __indexRecord.size)
+        with open(convoPath, "rb") as c:
+            c.seek(indexedBytes)
+            offset = indexedBytes
+            for line in c:
+                if not line.endswith(b"\n"):
+                    break  # still being written, indexed next time
+                role = getLineRole(line)
+                if role is not None or offset == 0:
+                    f.write(__indexRecord.pack(
+                        offset,
+                        role if role is not None else __roleNone
+                    ))
+                    turns += 1
+                offset += len(line)
+        f.truncate()
+        f.seek(0)
+        f.write(__indexHeader.pack(__indexMagic, offset, turns))
+    return turns
+
+
+def readIndexHeader(fileIn, convoBytesIn):
+    # returns [indexed bytes, turns] and drops records the header does not
+    # cover (left over from an interrupted update)
+    header = fileIn.read(__indexHeader.size)
+    fileIn.seek(0, os.SEEK_END)
+    records = (fileIn.tell() - __indexHeader.size) / __indexRecord.size
+    if len(header) < __indexHeader.size:
+        return resetIndex(fileIn)
+    magic, indexedBytes, turns = __indexHeader.unpack(header)
+    if magic != __indexMagic or indexedBytes > convoBytesIn or (
+        records < turns
+    ):
+        # unknown format, the file was rewritten, or the index was cut short
+        return resetIndex(fileIn)
+    fileIn.truncate(__indexHeader.size + turns * __indexRecord.size)
+    return [indexedBytes, turns]
+
+
+def resetIndex(fileIn):
+    fileIn.seek(0)
+    fileIn.truncate()
+    fileIn.write(__indexHeader.pack(__indexMagic, 0, 0))
+    return [0, 0]
+
+
+def readIndexRecord(fileIn, turnIn):
+    fileIn.seek(__indexHeader.size + turnIn * __indexRecord.size)
+    return __indexRecord.unpack(fileIn.read(__indexRecord.size))
+
+
+def getLineRole(lineIn):
+    for i in range(len(__roles)):
+        if lineIn.startswith(__roles[i]):
+            return i
+    return None
+
+
+################################
+""" BEGIN CONVERSATION READS """
+################################
+
+
+def getConversationTurnCount(convoNameIn):
+    with __conversationLock:
+        return updateConversationIndex(convoNameIn)
+
+
+def getConversationTurns(convoNameIn, startIn, endIn=None):
+    # lines of turns [start, end), like getConversation - negative values
+    # count from the last turn, so (name, -n) are the last n turns
+    turns = getConversationTurnRange(convoNameIn, startIn, endIn)
+    return [line for role, lines in turns for line in lines]
+
+
+def getLastConversationTurns(convoNameIn, countIn):
+    if countIn <= 0:
+        return []
+    return getConversationTurns(convoNameIn, -countIn)
+
+
+def getConversationTurn(convoNameIn, turnIn):
+    # returns [role, lines] for one turn, or None when it does not exist
+    end = turnIn + 1 if turnIn != -1 else None
+    turns = getConversationTurnRange(convoNameIn, turnIn, end)
+    if len(turns) == 0:
+        return None
+    return turns[0]
+
+
+def getConversationTurnRange(convoNameIn, startIn, endIn):
+    with __conversationLock:
+        turns = updateConversationIndex(convoNameIn)
+        start, end, step = slice(startIn, endIn).indices(turns)
+        if start >= end:
+            return []
+        with open(getConversationIndexFilePath(convoNameIn), "rb") as f:
+            indexedBytes = __indexHeader.unpack(
+                f.read(__indexHeader.size)
+            )[1]
+            f.seek(__indexHeader.size + start * __indexRecord.size)
+            records = list(__indexRecord.iter_unpack(
+                f.read((end - start) * __indexRecord.size)
+            ))
+            endOffset = indexedBytes
+            if end < turns:
+                endOffset = readIndexRecord(f, end)[0]
+        with open(getConversationFilePath(convoNameIn), "rb") as f:
+            f.seek(records[0][0])
+            data = f.read(endOffset - records[0][0])
+    result = []
+    for i in range(len(records)):
+        turnEnd = endOffset if i + 1 == len(records) else records[i + 1][0]
+        text = data[records[i][0] - records[0][0]:turnEnd - records[0][0]]
+        lines = text.decode("utf-8", errors="replace").split("\n")[0:-1]
+        role = records[i][1]
+        result.append([
+            __roleNames[role] if role != __roleNone else None,
+            [line.removesuffix("\r") for line in lines]
+        ])
+    return result
+
+
+#################################
+""" BEGIN CONVERSATION CATALOG """
+#################################
+
+
+# the catalog keeps name, size, mtime, turns, preview and emptiness of every
+# .convo file in catalog.json - entries are updated on write, and any file
+# whose size or mtime does not match its entry (written by something else,
+# added, removed) is re-read through its index on the next catalog scan
+
+
+def getConversationCatalog():
+    # returns name -> entry, most recently modified first
+    with __conversationLock:
+        scanCatalog()
+        saveCatalog()
+        return dict(sorted(
+            __catalog.items(),
+            key=lambda item: item[1]["mtime"],
+            reverse=True
+        ))
+
+
+def searchConversations(queryIn):
+    # exact name first, then names containing the query, newest first
+    catalog = getConversationCatalog()
+    if queryIn in catalog:
+        return [queryIn] + [
+            n for n in catalog if n != queryIn and queryIn in n
+        ]
+    return [n for n in catalog if queryIn in n]
+
+
+def deleteEmptyConversations():
+    # returns the names of the deleted conversations
+    deleted = []
+    for convoName, entry in getConversationCatalog().items():
+        if entry["empty"]:
+            deleteConversation(convoName)
+            deleted.append(convoName)
+    with __conversationLock:
+        saveCatalog()
+    return deleted
+
+
+def loadCatalog():
+    global __catalog
+    if __catalog is not None:
+        return
+    try:
+        with open(CONVERSATIONS_CATALOG_FILE_PATH, "r") as f:
+            __catalog = json.load(f)
+    except (OSError, ValueError):
+        __catalog = {}  # rebuilt by the next scan
+    return
+
+
+def saveCatalog():
+    global __catalogDirty
+    if __catalog is None or not __catalogDirty:
+        return
+    tempFilePath = CONVERSATIONS_CATALOG_FILE_PATH + ".tmp"
+    with open(tempFilePath, "w") as f:
+        json.dump(__catalog, f)
+    os.replace(tempFilePath, CONVERSATIONS_CATALOG_FILE_PATH)
+    __catalogDirty = False
+    return
+
+
+def scanCatalog():
+    # only stats the files, entries are refreshed when they are out of date
+    global __catalogDirty
+    loadCatalog()
+    found = set()
+    with os.scandir(CONVERSATIONS_FILE_PATH) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".convo") or not entry.is_file():
+                continue
+            convoName = entry.name[0:-len(".convo")]
+            found.add(convoName)
+            stat = entry.stat()
+            catalogEntry = __catalog.get(convoName)
+            if catalogEntry is None or (
+                catalogEntry["size"] != stat.st_size or (
+                    catalogEntry["mtime"] != stat.st_mtime
+                )
+            ):
+                turns = updateConversationIndex(convoName)
+                updateCatalogEntry(convoName, turns)
+    for convoName in list(__catalog.keys()):
+        if convoName not in found:
+            del __catalog[convoName]
+            __catalogDirty = True
+    return
+
+
+def updateCatalogEntry(convoNameIn, turnsIn):
+    global __catalogDirty
+    loadCatalog()
+    stat = os.stat(getConversationFilePath(convoNameIn))
+    lastTurn = getConversationTurnRange(convoNameIn, -1, None)
+    preview = " ".join(lastTurn[0][1]) if len(lastTurn) > 0 else ""
+    __catalog[convoNameIn] = {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "turns": turnsIn,
+        "preview": " ".join(preview.split())[0:__catalogPreviewLength],
+        "empty": isConversationEmpty(convoNameIn, stat.st_size, turnsIn)
+    }
+    __catalogDirty = True
+    return
+
+
+def isConversationEmpty(convoNameIn, sizeIn, turnsIn):
+    if sizeIn == 0:
+        return True
+    if turnsIn > 1:
+        return False
+    if turnsIn == 1 and getConversationTurnRange(convoNameIn, 0, 1)[0][0]:
+        return False  # starts with a role line
+    # no role lines at all - the only case where the text has to be read
+    return checkEmptyString(
+        readFile(getConversationFilePath(convoNameIn), None)
+    )
@@ -0,0 +1,144 @@
+# this file holds the in-memory image preprocessing (no temporary files)
+
+
+import base64
+import io
+
+
+from modules.util.configuration import getConfig
+
+
+__imageCodecs = {
+    "png": "PNG",
+    "jpeg": "JPEG",
+    "webp": "WEBP"
+}
+
+
+# PIL is imported on first use, it is one of the slowest startup imports
+__resampleFilters = {
+    "nearest": "NEAREST",
+    "box": "BOX",
+    "bilinear": "BILINEAR",
+    "hamming": "HAMMING",
+    "bicubic": "BICUBIC",
+    "lanczos": "LANCZOS"
+}
+
+
+__minimumLongEdge = 64  # never shrink below this to meet the byte budget
+__maximumBudgetPasses = 5
+
+
+def getImageCodec():
+    codec = getConfig("image_codec").lower()
+    if codec == "jpg":
+        codec = "jpeg"
+    if codec not in __imageCodecs:
+        codec = "png"
+    return codec
+
+
+def getResampleFilter():
+    from PIL import Image
+    return getattr(Image.Resampling, __resampleFilters.get(
+        getConfig("image_resample_filter").lower(),
+        "LANCZOS"
+    ))
+
+
+def getImagePolicy():
+    # the settings the model input depends on, as strings for the result
+    # cache keys
+    return [
+        getImageCodec(),
+        str(getConfig("image_quality")),
+        str(getConfig("image_max_long_edge")),
+        str(getConfig("image_max_pixels")),
+        str(getConfig("image_target_bytes")),
+        getConfig("image_resample_filter").lower()
+    ]
+
+
+def openImage(imageBytesIn):
+    # only the header is read here - pixels are decoded on first use
+    from PIL import Image
+    return Image.open(io.BytesIO(imageBytesIn))
+
+
+def getImageScale(widthIn, heightIn):
+    scale = 1.0
+    maxLongEdge = getConfig("image_max_long_edge")
+    if maxLongEdge > 0:
+        scale = min(scale, maxLongEdge / max(widthIn, heightIn))
+    maxPixels = getConfig("image_max_pixels")
+    if maxPixels > 0:
+        scale = min(scale, (maxPixels / (widthIn * heightIn)) ** 0.5)
+    return scale
+
+
+def resizeImage(imageIn, scaleIn):
+    width, height = imageIn.size
+    newSize = (
+        max(1, int(width * scaleIn)),
+        max(1, int(height * scaleIn))
+    )
+    return imageIn.resize(newSize, getResampleFilter())
+
+
+def encodeImage(imageIn, codecIn):
+    buffer = io.BytesIO()
+    match codecIn:
+        case "png":
+            imageIn.save(buffer, __imageCodecs[codecIn], optimize=True)
+        case _:
+            # lossy codecs used here do not keep palettes or (for jpeg) alpha
+            if imageIn.mode not in ["RGB", "L"]:
+                imageIn = imageIn.convert("RGB")
+            imageIn.save(
+                buffer,
+                __imageCodecs[codecIn],
+                quality=getConfig("image_quality")
+            )
+    return buffer.getvalue()
+
+
+def preprocessImage(imageBytesIn, fileExtensionIn, imageIn=None):
+    # returns [image bytes, codec, [before, after]] as [width, height, bytes]
+    # - imageIn is the image already opened from the bytes, if any
+    fileExtensionIn = fileExtensionIn.lower()
+    if fileExtensionIn == "jpg":
+        fileExtensionIn = "jpeg"
+    codec = getImageCodec()
+    targetBytes = getConfig("image_target_bytes")
+    image = imageIn if imageIn is not None else openImage(imageBytesIn)
+    width, height = image.size
+    before = [width, height, len(imageBytesIn)]
+    scale = getImageScale(width, height)
+    if scale >= 1.0 and fileExtensionIn == codec and (
+        targetBytes <= 0 or len(imageBytesIn) <= targetBytes
+    ):
+        return [imageBytesIn, codec, [before, before]]
+    resized = image if scale >= 1.0 else resizeImage(image, scale)
+    imageBytes = encodeImage(resized, codec)
+    passes = 0
+    while targetBytes > 0 and len(imageBytes) > targetBytes and (
+        passes < __maximumBudgetPasses and (
+            max(resized.size) > __minimumLongEdge
+        )
+    ):
+        # encoded size grows roughly with the pixel count
+        scale *= min(0.9, (targetBytes / len(imageBytes)) ** 0.5)
+        scale = max(scale, __minimumLongEdge / max(width, height))
+        resized = resizeImage(image, scale)
+        imageBytes = encodeImage(resized, codec)
+        passes += 1
+    after = [resized.size[0], resized.size[1], len(imageBytes)]
+    return [imageBytes, codec, [before, after]]
+
+
+def getImageDataUrl(imageBytesIn, codecIn):
+    return (
+        "data:image/" + codecIn + ";base64,"
+        "" + base64.b64encode(imageBytesIn).decode("utf-8")
+    )
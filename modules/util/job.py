@@ -0,0 +1,139 @@
+# this file holds the background jobs the prompt loop submits prompts as
+
+
+import contextvars
+import itertools
+import threading
+import time
+
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+from modules.util.configuration import getConfig
+
+
+__jobs = OrderedDict()  # id -> job, in submission order
+__jobIds = itertools.count(1)
+__jobsLock = threading.Lock()
+__jobExecutor = None
+__jobExecutorWorkers = 0
+__jobListener = None  # called with every job that finished running
+
+
+def getJobExecutor():
+    # recreated when job_workers changes, running jobs keep their threads
+    global __jobExecutor, __jobExecutorWorkers
+    workers = max(1, getConfig("job_workers"))
+    if __jobExecutor is None or __jobExecutorWorkers != workers:
+        if __jobExecutor is not None:
+            __jobExecutor.shutdown(wait=False)
+        __jobExecutor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="job"
+        )
+        __jobExecutorWorkers = workers
+    return __jobExecutor
+
+
+def submitJob(descriptionIn, functionIn, *argsIn):
+    job = {
+        "id": next(__jobIds),
+        "description": descriptionIn,
+        "state": "queued",
+        "result": None,
+        "error": None,
+        "timeSubmitted": time.perf_counter(),
+        "timeStart": None,
+        "timeEnd": None,
+        "notified": False,
+        "future": None
+    }
+    with __jobsLock:
+        __jobs[job["id"]] = job
+        job["future"] = getJobExecutor().submit(
+            contextvars.copy_context().run,
+            runJob,
+            job,
+            functionIn,
+            argsIn
+        )
+    return job
+
+
+def runJob(jobIn, functionIn, argsIn):
+    jobIn["timeStart"] = time.perf_counter()
+    jobIn["state"] = "running"
+    try:
+        jobIn["result"] = functionIn(*argsIn)
+        jobIn["state"] = "done"
+    except Exception as e:
+        jobIn["error"] = str(e)
+        jobIn["state"] = "failed"
+    finally:
+        jobIn["timeEnd"] = time.perf_counter()
+        listener = __jobListener
+        if listener is not None:
+            listener(jobIn)
+    return jobIn["result"]
+
+
+def setJobListener(listenerIn):
+    # listenerIn is called on the job thread, None to stop listening
+    global __jobListener
+    __jobListener = listenerIn
+    return
+
+
+def getJobs():
+    with __jobsLock:
+        return list(__jobs.values())
+
+
+def getJob(jobIdIn):
+    with __jobsLock:
+        return __jobs.get(jobIdIn)
+
+
+def isJobFinished(jobIn):
+    return jobIn["state"] in ["done", "failed", "cancelled"]
+
+
+def getJobSeconds(jobIn):
+    # seconds spent running, or waiting when the job has not started yet
+    if jobIn["timeStart"] is None:
+        return time.perf_counter() - jobIn["timeSubmitted"]
+    if jobIn["timeEnd"] is None:
+        return time.perf_counter() - jobIn["timeStart"]
+    return jobIn["timeEnd"] - jobIn["timeStart"]
+
+
+def getFinishedJobNotices():
+    # finished jobs that have not been reported yet
+    notices = []
+    for job in getJobs():
+        if isJobFinished(job) and not job["notified"]:
+            job["notified"] = True
+            notices.append(job)
+    return notices
+
+
+def waitForJobs():
+    wait([job["future"] for job in getJobs()])
+    return
+
+
+def clearFinishedJobs():
+    with __jobsLock:
+        for jobId in [i for i, j in __jobs.items() if isJobFinished(j)]:
+            del __jobs[jobId]
+    return
+
+
+def cancelJobs():
+    # queued jobs are cancelled, running ones are left to finish
+    for job in getJobs():
+        if job["future"].cancel():
+            job["state"] = "cancelled"
+    return
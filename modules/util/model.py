@@ -4,8 +4,9 @@ import json
 from modules.file.operation import appendFile, deleteFile
 from modules.util.configuration import getConfig, getModelConfigAll
 from modules.util.configuration import loadModelConfiguration
+from modules.util.configuration import getModelConfigVersion
 from modules.util.strings.paths import CONFIGS_PATH, MODELS_CONFIG_FILE_NAME
-from modules.util.util import getStringMatchPercentage, checkEmptyString
+from modules.util.util import checkEmptyString
 from modules.util.util import printError, getModelsFromServer, printDump
 from modules.util.util import printDebug, printGreen
 
@@ -19,82 +20,194 @@ def getModelTypes():
     return __modelTypes
 
 
-def getModelByName(modelNameIn):
-    modelNameIn = modelNameIn.lower()
+__modelIndex = None
+__trigramLength = 3
+
+
+def buildModelIndex():
+    # by type, by lowercase name, and a trigram -> names index per type
+    global __modelIndex
+    index = {
+        "version": getModelConfigVersion(),
+        "byName": {},  # lowercase name -> name
+        "byType": {},  # type -> {name: data}
+        "byTypeName": {},  # type -> {lowercase name: name}
+        "trigrams": {},  # type -> {trigram: set of lowercase names}
+        "byLength": {},  # type -> {length: [lowercase names]}
+        "order": {}  # lowercase name -> position in models.json
+    }
     for model, data in getModelConfigAll().items():
         m = model.lower()
-        if modelNameIn == m:
-            return model
-    return None
+        modelType = data["model_type"].lower()
+        index["byName"].setdefault(m, model)
+        index["order"].setdefault(m, len(index["order"]))
+        index["byType"].setdefault(modelType, {})[model] = data
+        if m not in index["byTypeName"].setdefault(modelType, {}):
+            index["byTypeName"][modelType][m] = model
+            index["byLength"].setdefault(modelType, {}).setdefault(
+                len(m),
+                []
+            ).append(m)
+        trigrams = index["trigrams"].setdefault(modelType, {})
+        for trigram in getTrigrams(m):
+            trigrams.setdefault(trigram, set()).add(m)
+    __modelIndex = index
+    return
+
+
+def getModelIndex():
+    if __modelIndex is None or (
+        __modelIndex["version"] != getModelConfigVersion()
+    ):
+        buildModelIndex()
+    return __modelIndex
+
+
+def getTrigrams(stringIn):
+    return set(
+        stringIn[i:i + __trigramLength]
+        for i in range(len(stringIn) - __trigramLength + 1)
+    )
+
+
+def getModelByName(modelNameIn):
+    return getModelIndex()["byName"].get(modelNameIn.lower())
 
 
 def getModelByNameAndType(nameIn, typeIn, modelOnly, strictMatching, silent):
     modelNameIn = nameIn.lower()
-    outModel = ""
-    outModelData = None
-    modelNames = None
-    if " " in modelNameIn:
-        modelNames = modelNameIn.split(" ")
-    for model, data in getModelConfigAll().items():  # L1
-        if data["model_type"].lower() == typeIn:
-            m = model.lower()
-            if strictMatching:
-                if modelNameIn == m:
-                    outModel = model
-                    outModelData = data
-                    break  # L1
-            else:
-                if modelNames is not None:
-                    matchesNames = True
-                    for part in modelNames:  # L2
-                        if part not in m:
-                            matchesNames = False
-                            break  # L2
-                    if matchesNames and (
-                        len(outModel) == 0 or (
-                            getStringMatchPercentage(m, modelNameIn) > (
-                                getStringMatchPercentage(m, list(outModel)[0])
-                            )
-                        )
-                    ):
-                        outModel = model
-                        outModelData = data
-                elif modelNameIn in m or m in modelNameIn:
-                    if len(outModel) == 0 or (
-                        getStringMatchPercentage(m, modelNameIn) > (
-                            getStringMatchPercentage(m, list(outModel)[0])
-                        )
-                    ):
-                        outModel = model
-                        outModelData = data
-    if len(outModel) > 0:
+    index = getModelIndex()
+    typeNames = index["byTypeName"].get(typeIn, {})
+    outModel = None
+    if strictMatching or modelNameIn in typeNames:
+        # an exact name is also the best fuzzy match (100%)
+        outModel = typeNames.get(modelNameIn)
+    else:
+        if " " in modelNameIn:
+            modelNames = modelNameIn.split(" ")
+        else:
+            modelNames = [modelNameIn]
+        candidates = getCandidatesContaining(index, typeIn, modelNames)
+        if candidates is not None and len(modelNames) == 1:
+            # model names that are part of the given name also match
+            for i in range(len(modelNameIn)):
+                for j in range(i + 1, len(modelNameIn) + 1):
+                    if modelNameIn[i:j] in typeNames:
+                        candidates.add(modelNameIn[i:j])
+        best = getBestMatch(index, typeIn, modelNameIn, candidates)
+        if best is not None:
+            outModel = typeNames[best]
+    if outModel is not None:
         if modelOnly:
             return outModel
         else:
-            return {outModel: outModelData}
+            return {outModel: index["byType"][typeIn][outModel]}
     else:
         if not silent:
             printError("\nNo model found with name: " + modelNameIn)
         return None
 
 
+def getCandidatesContaining(indexIn, typeIn, partsIn):
+    # lowercase names of typeIn containing every part, or None when no part
+    # is long enough to narrow the search down (every name is a candidate)
+    trigrams = indexIn["trigrams"].get(typeIn, {})
+    partTrigrams = set().union(*[getTrigrams(part) for part in partsIn])
+    if len(partTrigrams) == 0:
+        return None
+    candidates = None
+    for trigram in sorted(
+        partTrigrams,
+        key=lambda t: len(trigrams.get(t, ()))
+    ):
+        matches = trigrams.get(trigram)
+        if matches is None:
+            return set()
+        candidates = set(matches) if candidates is None else (
+            candidates & matches
+        )
+        if len(candidates) == 0:
+            return candidates
+    return set(m for m in candidates if all(part in m for part in partsIn))
+
+
+def getBestMatch(indexIn, typeIn, modelNameIn, candidatesIn):
+    # highest getStringMatchPercentage wins, earlier models win ties
+    # - the match percentage can never exceed 2 * min(a, b) / (a + b) for
+    # lengths a and b, so candidates are visited in order of that bound
+    # and the search stops once no remaining one can beat the best
+    parts = modelNameIn.split(" ")
+    order = indexIn["order"]
+    best = None
+    bestScore = -1.0
+    # same score as getStringMatchPercentage(m, modelNameIn), but the
+    # lookup table for the given name is only built once
+    from difflib import SequenceMatcher
+    matcher = SequenceMatcher(None, "", modelNameIn)
+    for bound, m in iterateByMatchBound(
+        indexIn,
+        typeIn,
+        modelNameIn,
+        candidatesIn
+    ):
+        if bound < bestScore or (
+            bound == bestScore and order[m] > order[best]
+        ):
+            break
+        if candidatesIn is None:
+            if len(parts) > 1:
+                if not all(part in m for part in parts):
+                    continue
+            elif modelNameIn not in m and m not in modelNameIn:
+                continue
+        matcher.set_seq1(m)
+        score = matcher.ratio() * 100
+        if score > bestScore or (
+            score == bestScore and order[m] < order[best]
+        ):
+            best = m
+            bestScore = score
+    return best
+
+
+def iterateByMatchBound(indexIn, typeIn, modelNameIn, candidatesIn):
+    # yields [bound, lowercase name], highest bound first, then by order
+    def getBound(lengthIn):
+        total = lengthIn + len(modelNameIn)
+        if total == 0:
+            return 100.0
+        return 200.0 * min(lengthIn, len(modelNameIn)) / total
+
+    order = indexIn["order"]
+    if candidatesIn is not None and len(candidatesIn) <= 1024:
+        for m in sorted(
+            candidatesIn,
+            key=lambda m: (-getBound(len(m)), order[m])
+        ):
+            yield [getBound(len(m)), m]
+        return
+    byLength = indexIn["byLength"].get(typeIn, {})
+    for length in sorted(byLength, key=lambda length: -getBound(length)):
+        bound = getBound(length)
+        for m in byLength[length]:
+            if candidatesIn is None or m in candidatesIn:
+                yield [bound, m]
+    return
+
+
 def getModelsWithType(modelTypeIn):
-    out = {}
-    for model, data in getModelConfigAll().items():
-        if data["model_type"].lower() == modelTypeIn:
-            out[model] = data
-    return out
+    # a copy, the index itself must not be changed by callers
+    return dict(getModelIndex()["byType"].get(modelTypeIn, {}))
 
 
 def getModelDataIfExists(dataNameIn, modelNameIn):
-    modelNameIn = modelNameIn.lower()
-    for model, data in getModelConfigAll().items():
-        if modelNameIn == model.lower():
-            if data.get(dataNameIn) is not None and not (
-                checkEmptyString(data[dataNameIn])
-            ):
-                return data[dataNameIn]
-            break
+    model = getModelByName(modelNameIn)
+    if model is not None:
+        data = getModelConfigAll()[model]
+        if data.get(dataNameIn) is not None and not (
+            checkEmptyString(data[dataNameIn])
+        ):
+            return data[dataNameIn]
     return None
 
 
@@ -134,11 +247,12 @@ def modelScanner():
         newModelsJson = getModelConfigAll() | addModels
         outputFileString = json.dumps(newModelsJson, indent=4)
 
-        printDump("\nNew models.json:\n" + outputFileString)
+        printDump(lambda: "\nNew models.json:\n" + outputFileString)
 
         deleteFile(CONFIGS_PATH + MODELS_CONFIG_FILE_NAME)
         appendFile(CONFIGS_PATH + MODELS_CONFIG_FILE_NAME, outputFileString)
         loadModelConfiguration()
+        buildModelIndex()
 
         printGreen("\nSuccessfully updated your models.json!\n")
     else:
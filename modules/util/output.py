@@ -0,0 +1,134 @@
+# this file holds the output layer behind the print functions in util.py -
+# log lines (info, debug, dump) may be buffered, written by a background
+# thread and sent to a file instead of the terminal, everything else is
+# written to the terminal right away
+
+
+import atexit
+import queue
+import sys
+import threading
+
+
+from termcolor import colored  # https://pypi.org/project/termcolor/
+
+
+from modules.util.configuration import getConfig
+
+
+__logFile = None  # open output_log_file, None for the terminal
+__logFilePath = ""
+__logBuffer = []
+__logBufferBytes = 0
+__logQueue = None  # chunks for the writer thread, None when synchronous
+__logWriter = None
+__outputLock = threading.RLock()
+
+
+def setOutput():
+    # applies output_log_file and output_async, on every configuration load
+    global __logFile, __logFilePath, __logQueue, __logWriter
+    with __outputLock:
+        flushLogs(True)
+        filePath = getConfig("output_log_file")
+        if filePath != __logFilePath:
+            if __logFile is not None:
+                __logFile.close()
+            __logFile = None
+            if len(filePath) > 0:
+                __logFile = open(filePath, "a")
+            __logFilePath = filePath
+        if getConfig("output_async") and __logWriter is None:
+            __logQueue = queue.Queue()
+            __logWriter = threading.Thread(
+                target=writeLogQueue,
+                args=(__logQueue,),
+                name="output",
+                daemon=True
+            )
+            __logWriter.start()
+        elif not getConfig("output_async") and __logWriter is not None:
+            __logQueue.put(None)
+            __logWriter.join()
+            __logQueue = None
+            __logWriter = None
+    return
+
+
+def getLogStream():
+    # sys.stdout is looked up on every write, batch.py redirects it
+    return __logFile if __logFile is not None else sys.stdout
+
+
+def writeOutput(stringIn, colorIn, endIn="\n"):
+    # anything logged to the terminal before it is written first
+    text = stringIn if colorIn is None else colored(stringIn, colorIn)
+    with __outputLock:
+        if __logFile is None:
+            flushLogs(True)
+        sys.stdout.write(text + endIn)
+        sys.stdout.flush()
+    return
+
+
+def writeLog(stringIn, colorIn, bufferIn):
+    # a buffered line waits for output_buffer_bytes of lines, the next
+    # output on the terminal or flushOutput(), whichever comes first
+    global __logBufferBytes
+    if __logFile is None:
+        stringIn = colored(stringIn, colorIn)
+    with __outputLock:
+        __logBuffer.append(stringIn + "\n")
+        __logBufferBytes += len(stringIn) + 1
+        if not bufferIn or (
+            __logBufferBytes >= getConfig("output_buffer_bytes")
+        ):
+            flushLogs(False)
+    return
+
+
+def flushLogs(waitIn):
+    # waitIn also waits for the writer thread to write everything
+    global __logBufferBytes
+    with __outputLock:
+        if len(__logBuffer) > 0:
+            text = "".join(__logBuffer)
+            __logBuffer.clear()
+            __logBufferBytes = 0
+            if __logQueue is not None:
+                __logQueue.put(text)
+            else:
+                stream = getLogStream()
+                stream.write(text)
+                stream.flush()
+        if waitIn and __logQueue is not None:
+            __logQueue.join()
+    return
+
+
+def flushOutput():
+    flushLogs(True)
+    return
+
+
+def writeLogQueue(queueIn):
+    # writes whatever was queued meanwhile in one go, until None is queued
+    while True:
+        chunks = [queueIn.get()]
+        while True:
+            try:
+                chunks.append(queueIn.get_nowait())
+            except queue.Empty:
+                break
+        text = "".join(c for c in chunks if c is not None)
+        if len(text) > 0:
+            stream = getLogStream()
+            stream.write(text)
+            stream.flush()
+        for c in chunks:
+            queueIn.task_done()
+        if None in chunks:
+            return
+
+
+atexit.register(flushOutput)
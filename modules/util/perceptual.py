@@ -0,0 +1,158 @@
+# this file holds the perceptual hash index used to reuse results for
+# re-encoded or resized copies of an image already processed
+
+
+import json
+import os
+import threading
+
+
+from modules.util.cache import getCacheFolder
+from modules.util.configuration import getConfig
+
+
+# a dHash is 64 bits, one per pair of horizontally neighbouring pixels of a
+# 9x8 grayscale thumbnail (set when the left one is brighter) - resizing,
+# re-encoding and small color changes only flip a few bits, so near
+# duplicates are hashes a short Hamming distance apart
+__hashWidth = 9
+__hashHeight = 8
+
+
+# hashes are kept in one BK-tree per context (models, prompts, grammars),
+# a node being [hash, entries, {distance: child node}] - a lookup only
+# visits children whose distance to their parent is within the threshold
+# of the distance between the parent and the hash looked up
+__trees = None  # context -> root node, loaded on first use
+__treesLock = threading.Lock()
+
+
+def isPerceptualIndexEnabled():
+    return getConfig("result_cache_enabled") and (
+        getConfig("perceptual_cache_enabled")
+    )
+
+
+def getPerceptualIndexFilePath():
+    return getCacheFolder("perceptual") + "index.jsonl"
+
+
+def getImageHash(imageIn):
+    from PIL import Image
+    image = imageIn
+    if image.mode not in ["L", "RGB", "RGBA"]:
+        image = image.convert("RGB")
+    pixels = image.resize(
+        (__hashWidth, __hashHeight),
+        Image.Resampling.BOX
+    ).convert("L").tobytes()
+    imageHash = 0
+    for y in range(__hashHeight):
+        row = pixels[y * __hashWidth:(y + 1) * __hashWidth]
+        for x in range(__hashWidth - 1):
+            imageHash = (imageHash << 1) | (row[x] > row[x + 1])
+    return imageHash
+
+
+def getHammingDistance(hashIn, otherHashIn):
+    return (hashIn ^ otherHashIn).bit_count()
+
+
+##############################
+""" BEGIN PERCEPTUAL INDEX """
+##############################
+
+
+def loadPerceptualIndex():
+    global __trees
+    if __trees is not None:
+        return
+    __trees = {}
+    try:
+        with open(getPerceptualIndexFilePath(), "r+b") as f:
+            offset = 0
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError
+                    entry = json.loads(line)
+                except ValueError:
+                    # cut short by a crash while writing, later entries
+                    # would be appended to it
+                    f.truncate(offset)
+                    break
+                addToTree(entry)
+                offset += len(line)
+    except OSError:
+        pass  # nothing indexed yet
+    return
+
+
+def addToTree(entryIn):
+    # returns False when the entry was already in the tree
+    node = __trees.get(entryIn["context"])
+    if node is None:
+        __trees[entryIn["context"]] = [entryIn["hash"], [entryIn], {}]
+        return True
+    while True:
+        distance = getHammingDistance(node[0], entryIn["hash"])
+        if distance == 0:
+            if any(e["key"] == entryIn["key"] for e in node[1]):
+                return False
+            node[1].append(entryIn)
+            return True
+        child = node[2].get(distance)
+        if child is None:
+            node[2][distance] = [entryIn["hash"], [entryIn], {}]
+            return True
+        node = child
+
+
+def searchTree(contextIn, hashIn, thresholdIn):
+    # returns [distance, entry] for every entry within the threshold,
+    # closest (then most recently added) first
+    matches = []
+    node = __trees.get(contextIn)
+    nodes = [node] if node is not None else []
+    while len(nodes) > 0:
+        node = nodes.pop()
+        distance = getHammingDistance(node[0], hashIn)
+        if distance <= thresholdIn:
+            for entry in reversed(node[1]):
+                matches.append([distance, entry])
+        for childDistance, child in node[2].items():
+            if abs(childDistance - distance) <= thresholdIn:
+                nodes.append(child)
+    return sorted(matches, key=lambda match: match[0])
+
+
+def getNearDuplicates(contextIn, hashIn):
+    if not isPerceptualIndexEnabled():
+        return []
+    with __treesLock:
+        loadPerceptualIndex()
+        return searchTree(
+            contextIn,
+            hashIn,
+            getConfig("perceptual_cache_threshold")
+        )
+
+
+def addPerceptualHash(contextIn, hashIn, keyIn, filePathIn):
+    # keyIn is the result cache key of the image the hash was taken from
+    if not isPerceptualIndexEnabled():
+        return
+    entry = {
+        "context": contextIn,
+        "hash": hashIn,
+        "key": keyIn,
+        "file": filePathIn
+    }
+    with __treesLock:
+        loadPerceptualIndex()
+        if addToTree(entry):
+            filePath = getPerceptualIndexFilePath()
+            os.makedirs(os.path.dirname(filePath), exist_ok=True)
+            with open(filePath, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+    return
@@ -0,0 +1,394 @@
+# this file holds the image-to-text -> size/weight pipeline
+
+
+import time
+
+
+from modules.file.operation import fileExists
+from modules.util.cache import getCacheKey, getCachedResult, setCachedResult
+from modules.util.configuration import getConfig
+from modules.util.image import getImageDataUrl, preprocessImage, openImage
+from modules.util.image import getImagePolicy
+from modules.util.perceptual import getImageHash, getNearDuplicates
+from modules.util.perceptual import addPerceptualHash
+from modules.util.perceptual import isPerceptualIndexEnabled
+from modules.util.span import span
+from modules.util.store import parseSizeWeight, appendResult
+from modules.util.util import printDebug, printError, sendChatCompletion
+from modules.util.util import cleanupString, cleanupServerResponseTokens
+
+
+__textToTextModel = "text_to_text_nous-13b"
+
+
+def getTextToTextSystemPrompt(objectIn):
+    return ("What is the average size (in centimeters), as well as the average weight (in grams (g)), of the following object: " + objectIn)
+
+
+__imagetotextSystemPromptNew = (
+    "What is the single main subject, and the main subject only, in the given image?"
+)
+
+
+# the grammars are put together from these, so both pipeline modes always
+# constrain the answers the same way
+__subjectGrammar = '"The single main subject in the given image is " string "."'
+__subjectGrammarRules = """string ::= [a-zA-Z ]*"""
+__sizeWeightGrammar = '"Size: " number "cm by " number "cm by " number "cm, weight: " weight "g"'
+__sizeWeightGrammarRules = """number ::= [0-9]+["."]?[0-9]{1}
+weight ::= [0-9]+["."]?[0-9]{1}[mk]{0,1}"""
+
+
+__grammarStringNew = (
+    "root ::= (" + __subjectGrammar + ")\n" + __subjectGrammarRules
+)
+
+
+__grammarString = (
+    "root ::= (" + __sizeWeightGrammar + ")\n" + __sizeWeightGrammarRules
+)
+
+
+# pipeline_mode "fused" - the image-to-text model answers both questions in
+# one request, in the form of __grammarStringNew followed by __grammarString
+__fusedPrompt = (
+    "What is the single main subject, and the main subject only, in the given image, and what is the average size (in centimeters), as well as the average weight (in grams (g)), of that subject?"
+)
+
+
+__fusedGrammarString = (
+    "root ::= (" + __subjectGrammar + ' " " ' + __sizeWeightGrammar + ")\n"
+    "" + __subjectGrammarRules + "\n" + __sizeWeightGrammarRules
+)
+
+
+__pipelineModes = ["two_stage", "fused"]
+
+
+def getTextToTextModel():
+    return __textToTextModel
+
+
+def getPipelineModes():
+    return __pipelineModes
+
+
+def createImageToTextRequest(promptIn, filePathIn):
+    record = getImageToTextRecord(promptIn, filePathIn)
+    if record["error"] is not None:
+        printError("\n" + record["error"] + "\n")
+    return record["result"]
+
+
+def getImageToTextRecord(promptIn, filePathIn):
+    record = newImageToTextRecord(filePathIn)
+    identifyImageSubject(promptIn, record)
+    return finishImageToTextRecord(record)
+
+
+def newImageToTextRecord(filePathIn, modeIn=None):
+    # modeIn is one of getPipelineModes(), pipeline_mode by default
+    return {
+        "file": filePathIn,
+        "mode": modeIn if modeIn is not None else getConfig("pipeline_mode"),
+        "object": None,
+        "result": None,
+        "error": None,
+        "cached": False,
+        "nearDuplicate": None,  # [file, distance] the result was reused from
+        "measures": None,  # [length, width, height] cm and weight g
+        "timings": {},
+        "timeStart": time.perf_counter()
+    }
+
+
+def finishImageToTextRecord(recordIn):
+    if recordIn["error"] is None and recordIn["result"] is None:
+        estimateObjectSize(recordIn)
+    if recordIn["error"] is None:
+        recordIn["measures"] = parseSizeWeight(recordIn["result"])
+        if recordIn["measures"] is not None and (
+            getConfig("result_store_enabled")
+        ):
+            appendResult(
+                normalizeObjectName(recordIn["object"]),
+                recordIn["measures"],
+                recordIn["cached"]
+            )
+    recordIn["timings"]["total"] = time.perf_counter() - recordIn["timeStart"]
+    return recordIn
+
+
+def identifyImageSubject(promptIn, recordIn):
+    # stage 1 - fills "object" (and "result" when cached or fused) into the
+    # record
+    if len(getConfig("default_image_to_text_model")) == 0:
+        recordIn["error"] = (
+            "Img2Text is disabled because the Img2Text model is not set."
+        )
+        return recordIn
+
+    filePathIn = recordIn["file"]
+    if not fileExists(filePathIn):
+        recordIn["error"] = "File does not exist!"
+        return recordIn
+
+    timeStart = time.perf_counter()
+    with span("file_read", file=filePathIn):
+        with open(filePathIn, "rb") as f:
+            imageBytes = f.read()
+    recordIn["cacheKey"] = getImageToTextCacheKey(
+        promptIn,
+        imageBytes,
+        recordIn["mode"]
+    )
+    cachedResult = getCachedResult("image_to_text", recordIn["cacheKey"])
+    if cachedResult is not None:
+        printDebug("Using cached result for: " + filePathIn)
+        recordIn["object"] = cachedResult["object"]
+        recordIn["result"] = cachedResult["result"]
+        recordIn["cached"] = True
+        return recordIn
+    fileExtension = filePathIn.split(".")
+    fileExtension = fileExtension[len(fileExtension) - 1]
+    with span("preprocess", file=filePathIn):
+        image = openImage(imageBytes)
+        if isPerceptualIndexEnabled() and (
+            not getConfig("result_cache_refresh")
+        ):
+            with span("perceptual_hash"):
+                recordIn["perceptualHash"] = getImageHash(image)
+            recordIn["perceptualContext"] = getImageToTextContextKey(
+                promptIn,
+                recordIn["mode"]
+            )
+            if useNearDuplicateResult(recordIn):
+                recordIn["timings"]["preprocess"] = (
+                    time.perf_counter() - timeStart
+                )
+                return recordIn
+        imageBytes, codec, sizes = preprocessImage(
+            imageBytes,
+            fileExtension,
+            image
+        )
+    printDebug(
+        "Image size: " + formatImageSize(sizes[0]) + " -> "
+        "" + formatImageSize(sizes[1]) + " (" + codec + ")"
+    )
+    with span("encode", codec=codec):
+        imageUrl = getImageDataUrl(imageBytes, codec)
+    fused = recordIn["mode"] == "fused"
+    systemMessageBody = {
+        "role": "USER",
+        "content": [
+            {
+                "type": "text",
+                "text": __fusedPrompt if fused else __imagetotextSystemPromptNew
+            },
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": imageUrl
+                }
+            }
+        ]
+    }
+    dataIn = {
+        "grammar": __fusedGrammarString if fused else __grammarStringNew,
+        "model": getConfig("default_image_to_text_model"),
+        "messages": [systemMessageBody],
+    }
+    recordIn["timings"]["preprocess"] = time.perf_counter() - timeStart
+
+    timeStart = time.perf_counter()
+    with span("stage_1_request", model=dataIn["model"]):
+        result = sendChatCompletion(dataIn)
+    recordIn["timings"]["identify"] = time.perf_counter() - timeStart
+    if result is None:
+        recordIn["error"] = "No image response from server!"
+        return recordIn
+    with span("parse"):
+        message = result["choices"][0]["message"]["content"]
+        message = cleanupString(message)
+        message = cleanupServerResponseTokens(message)
+        result = None
+        if fused:
+            message, separator, result = message.partition(". Size: ")
+            result = "Size: " + result if len(separator) > 0 else None
+        message = message.replace("The single main subject in the given image is ", "")
+        message = message.replace(".", "")
+    printDebug("Object: " + message)
+
+    if ' ' in message:
+        message = message.replace(" ","_")
+    recordIn["object"] = message
+    if fused:
+        if result is None:
+            recordIn["error"] = "No size/weight in the image response!"
+            return recordIn
+        printDebug("Result: " + result)
+        setImageToTextResult(recordIn, result)
+    return recordIn
+
+
+def useNearDuplicateResult(recordIn):
+    # reuses the result of the closest image already processed that is
+    # within perceptual_cache_threshold bits of this one, if any
+    for distance, entry in getNearDuplicates(
+        recordIn["perceptualContext"],
+        recordIn["perceptualHash"]
+    ):
+        cachedResult = getCachedResult("image_to_text", entry["key"])
+        if cachedResult is None:
+            continue  # evicted from the result cache
+        printDebug(
+            "Using result of near-duplicate " + entry["file"] + " "
+            "(distance " + str(distance) + ") for: " + recordIn["file"]
+        )
+        recordIn["object"] = cachedResult["object"]
+        recordIn["result"] = cachedResult["result"]
+        recordIn["cached"] = True
+        recordIn["nearDuplicate"] = [entry["file"], distance]
+        # the exact copy is found by its bytes from now on
+        setCachedResult("image_to_text", recordIn["cacheKey"], cachedResult)
+        return True
+    return False
+
+
+def estimateObjectSize(recordIn):
+    # stage 2 - fills "result" from the object found in stage 1
+    objectKey = getObjectEstimateCacheKey(recordIn["object"])
+    # an image whose subject was not named would share one estimate with
+    # every other such image
+    memoize = getConfig("object_cache_enabled") and (
+        len(normalizeObjectName(recordIn["object"])) > 0
+    )
+    if memoize:
+        cachedResult = getCachedResult("object_estimate", objectKey)
+        if cachedResult is not None:
+            printDebug("Using cached estimate for: " + recordIn["object"])
+            recordIn["timings"]["estimate"] = 0.0
+            recordIn["estimateCached"] = True
+            setImageToTextResult(recordIn, cachedResult["result"])
+            return recordIn
+    systemMessageBody = {"role":"USER","content":getTextToTextSystemPrompt(recordIn["object"])}
+    dataIn = {
+        "grammar": __grammarString,
+        "model": __textToTextModel,
+        "messages": [systemMessageBody],
+    }
+    timeStart = time.perf_counter()
+    with span("stage_2_request", model=dataIn["model"]):
+        result = sendChatCompletion(dataIn)
+    recordIn["timings"]["estimate"] = time.perf_counter() - timeStart
+    if result is None:
+        recordIn["error"] = "No text response from server!"
+        return recordIn
+    with span("parse"):
+        message = result["choices"][0]["message"]["content"]
+        message = cleanupString(message)
+        message = cleanupServerResponseTokens(message)
+    if memoize:
+        setCachedResult(
+            "object_estimate",
+            objectKey,
+            {
+                "object": normalizeObjectName(recordIn["object"]),
+                "result": message
+            }
+        )
+    setImageToTextResult(recordIn, message)
+    return recordIn
+
+
+def setImageToTextResult(recordIn, resultIn):
+    recordIn["result"] = resultIn
+    setCachedResult(
+        "image_to_text",
+        recordIn["cacheKey"],
+        {"object": recordIn["object"], "result": resultIn}
+    )
+    if recordIn.get("perceptualHash") is not None:
+        addPerceptualHash(
+            recordIn["perceptualContext"],
+            recordIn["perceptualHash"],
+            recordIn["cacheKey"],
+            recordIn["file"]
+        )
+    return
+
+
+__objectArticles = ["a", "an", "the", "some"]
+
+
+def normalizeObjectName(objectIn):
+    # "A_Red  Apples" -> "red apple"
+    words = objectIn.lower().replace("_", " ").split()
+    while len(words) > 1 and words[0] in __objectArticles:
+        words = words[1:]
+    if len(words) > 0:
+        words[-1] = getSingularWord(words[-1])
+    return " ".join(words)
+
+
+def getSingularWord(wordIn):
+    if len(wordIn) > 4 and wordIn.endswith("ies"):
+        return wordIn[0:-3] + "y"
+    for suffix in ["sses", "xes", "zes", "ches", "shes"]:
+        if wordIn.endswith(suffix):
+            return wordIn[0:-2]
+    if len(wordIn) > 3 and wordIn.endswith("s") and not (
+        wordIn.endswith("ss") or wordIn.endswith("us") or (
+            wordIn.endswith("is")
+        )
+    ):
+        return wordIn[0:-1]
+    return wordIn
+
+
+def formatImageSize(sizeIn):
+    return (
+        str(sizeIn[0]) + "x" + str(sizeIn[1]) + ", "
+        "" + str(sizeIn[2]) + " bytes"
+    )
+
+
+def getObjectEstimateCacheKey(objectIn):
+    return getCacheKey([
+        normalizeObjectName(objectIn),
+        __textToTextModel,
+        getTextToTextSystemPrompt(""),
+        __grammarString
+    ])
+
+
+def getImageToTextCacheKey(promptIn, imageBytesIn, modeIn):
+    return getCacheKey(
+        [imageBytesIn] + getImageToTextContext(promptIn, modeIn)
+    )
+
+
+def getImageToTextContextKey(promptIn, modeIn):
+    return getCacheKey(getImageToTextContext(promptIn, modeIn))
+
+
+def getImageToTextContext(promptIn, modeIn):
+    # everything besides the image that the result depends on
+    if modeIn == "fused":
+        return [
+            getConfig("default_image_to_text_model"),
+            modeIn,
+            promptIn,
+            __fusedPrompt,
+            __fusedGrammarString
+        ] + getImagePolicy()
+    return [
+        getConfig("default_image_to_text_model"),
+        __textToTextModel,
+        promptIn,
+        __imagetotextSystemPromptNew,
+        getTextToTextSystemPrompt(""),
+        __grammarStringNew,
+        __grammarString
+    ] + getImagePolicy()
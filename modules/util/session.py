@@ -0,0 +1,458 @@
+# this file holds the shared, pooled http sessions (one per host)
+
+
+import contextlib
+import contextvars
+import random
+import threading
+import time
+
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+
+from modules.util.configuration import getConfig
+from modules.util.strings.endpoints import MODELS_AVAILABLE_ENDPOINT
+from modules.util.strings.endpoints import MODELS_ENDPOINT, TEXT_ENDPOINT
+
+
+__sessions = {}  # scheme://host:port -> requests.Session
+__sessionsLock = threading.Lock()
+
+
+# requests to these can be sent again without side effects (retries and
+# hedging), anything else (eg. models/apply) is only ever sent once
+__idempotentEndpoints = [
+    MODELS_AVAILABLE_ENDPOINT,
+    MODELS_ENDPOINT,
+    TEXT_ENDPOINT
+]
+__retryStatusCodes = [500, 502, 503, 504]
+__circuits = {}  # scheme://host:port -> circuit breaker state
+__latencies = {}  # scheme://host:port/path -> recent attempt seconds
+__latencySamples = 200
+# False while sending requests that would skew the latencies, see
+# untimedRequests
+__latencyRecording = contextvars.ContextVar("latencyRecording", default=True)
+__requestStats = {
+    "requests": 0,
+    "retries": 0,
+    "hedges": 0,
+    "hedgeWins": 0,
+    "deadlinesExceeded": 0,
+    "circuitOpens": 0,
+    "circuitRejections": 0
+}
+__requestLock = threading.Lock()
+__attemptExecutor = None
+
+
+def getHostKey(urlIn):
+    url = urlsplit(urlIn)
+    return url.scheme + "://" + url.netloc
+
+
+def getSession(urlIn):
+    hostKey = getHostKey(urlIn)
+    session = __sessions.get(hostKey)
+    if session is None:
+        with __sessionsLock:
+            session = __sessions.get(hostKey)
+            if session is None:
+                session = createSession()
+                __sessions[hostKey] = session
+    return session
+
+
+def createSession():
+    # requests is the slowest import at startup, so it waits for the first
+    # request (batch runs served from the cache never need it)
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=getConfig("connection_pool_count"),
+        pool_maxsize=getConfig("connection_pool_size"),
+        pool_block=getConfig("connection_pool_block")
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not getConfig("connection_keep_alive"):
+        session.headers["Connection"] = "close"
+    return session
+
+
+def getTimeouts(deadlineIn=None):
+    # per-attempt timeouts, never longer than what is left of the deadline
+    connectTimeout = getConfig("connection_connect_timeout")
+    readTimeout = getConfig("connection_read_timeout")
+    remaining = getRemainingSeconds(deadlineIn)
+    if remaining is not None:
+        remaining = max(remaining, 0.001)
+        connectTimeout = remaining if connectTimeout is None else (
+            min(connectTimeout, remaining)
+        )
+        readTimeout = remaining if readTimeout is None else (
+            min(readTimeout, remaining)
+        )
+    return (connectTimeout, readTimeout)
+
+
+def resetSessions():
+    global __sessions
+    with __sessionsLock:
+        for session in __sessions.values():
+            session.close()
+        __sessions = {}
+    with __requestLock:
+        __circuits.clear()  # the configuration (address) may have changed
+    return
+
+
+def getRequestDeadline():
+    # the time.monotonic() the request_deadline passes at, or None
+    if getConfig("request_deadline") is None:
+        return None
+    return time.monotonic() + getConfig("request_deadline")
+
+
+def sendRequest(
+    urlIn,
+    dataIn=None,
+    fileIn=None,
+    streamIn=False,
+    deadlineIn=None
+):
+    # raises TimeoutError when the request_deadline passes, ConnectionError
+    # when the circuit of the host is open, or the last requests exception
+    # once the retries are used up - a 5xx response is returned as is after
+    # the last retry
+    # - deadlineIn is a getRequestDeadline() shared with other sends of the
+    # same request (see sendBackendRequest), a new one by default
+    hostKey = getHostKey(urlIn)
+    deadline = deadlineIn
+    if deadline is None:
+        deadline = getRequestDeadline()
+    if getRemainingSeconds(deadline) is not None and (
+        getRemainingSeconds(deadline) <= 0
+    ):
+        countRequestStat("deadlinesExceeded")
+        raise TimeoutError("Request deadline exceeded: " + urlIn)
+    idempotent = isIdempotentRequest(urlIn, fileIn)
+    attempts = 1
+    if idempotent:
+        attempts += max(0, getConfig("request_retries"))
+    countRequestStat("requests")
+    attempt = 0
+    while True:
+        trial = checkCircuit(hostKey)
+        try:
+            if streamIn or (deadline is None and not (
+                idempotent and getConfig("request_hedging")
+            )):
+                response = sendAttempt(
+                    urlIn,
+                    dataIn,
+                    fileIn,
+                    streamIn,
+                    deadline
+                )
+            else:
+                response = sendBoundedAttempts(
+                    urlIn,
+                    dataIn,
+                    fileIn,
+                    deadline,
+                    idempotent and getConfig("request_hedging")
+                )
+        except OSError as e:  # requests exceptions are OSErrors as well
+            addCircuitResult(hostKey, False)
+            if isinstance(e, TimeoutError) or attempt + 1 >= attempts:
+                raise
+        else:
+            if response.status_code not in __retryStatusCodes:
+                addCircuitResult(hostKey, True)
+                return response
+            addCircuitResult(hostKey, False)
+            if attempt + 1 >= attempts:
+                return response
+            response.close()
+        finally:
+            if trial:
+                # any other error would leave the circuit half-open for good
+                endCircuitTrial(hostKey)
+        delay = getRetryDelay(attempt)
+        remaining = getRemainingSeconds(deadline)
+        if remaining is not None and remaining <= delay:
+            countRequestStat("deadlinesExceeded")
+            raise TimeoutError("Request deadline exceeded: " + urlIn)
+        attempt += 1
+        countRequestStat("retries")
+        time.sleep(delay)
+
+
+def sendAttempt(urlIn, dataIn, fileIn, streamIn, deadlineIn):
+    session = getSession(urlIn)
+    timeouts = getTimeouts(deadlineIn)
+    timeStart = time.monotonic()
+    if dataIn is not None:
+        response = session.post(
+            urlIn,
+            json=dataIn,
+            timeout=timeouts,
+            stream=streamIn
+        )
+    elif fileIn is not None:
+        response = session.post(
+            urlIn,
+            files=fileIn,
+            timeout=timeouts,
+            stream=streamIn
+        )
+    else:
+        response = session.get(urlIn, timeout=timeouts, stream=streamIn)
+    if isRecordingLatencies() and not streamIn and (
+        response.status_code not in __retryStatusCodes
+    ):
+        addLatency(
+            getLatencyKey(urlIn, dataIn),
+            time.monotonic() - timeStart
+        )
+    return response
+
+
+def sendBoundedAttempts(urlIn, dataIn, fileIn, deadlineIn, hedgeIn):
+    # sends the attempt from a worker thread so the deadline holds even when
+    # the server keeps trickling data in - with hedging, a second attempt is
+    # sent once the first one is slower than the usual (p95) latency and
+    # whichever returns first is used
+    timeStart = time.monotonic()
+    hedgeDelay = None
+    if hedgeIn:
+        hedgeDelay = getHedgeDelay(getLatencyKey(urlIn, dataIn))
+    attempts = {
+        submitAttempt(urlIn, dataIn, fileIn, deadlineIn): False
+    }
+    error = None
+    while len(attempts) > 0:
+        timeout = getRemainingSeconds(deadlineIn)
+        if timeout is not None and timeout <= 0:
+            break
+        if hedgeDelay is not None:
+            untilHedge = max(0.0, timeStart + hedgeDelay - time.monotonic())
+            timeout = untilHedge if timeout is None else min(
+                timeout,
+                untilHedge
+            )
+        done, pending = wait(
+            list(attempts.keys()),
+            timeout=timeout,
+            return_when=FIRST_COMPLETED
+        )
+        for future in done:
+            isHedge = attempts.pop(future)
+            if future.exception() is None:
+                if isHedge:
+                    countRequestStat("hedgeWins")
+                abandonAttempts(attempts)
+                return future.result()
+            error = future.exception()
+        if len(attempts) == 0:
+            raise error
+        if hedgeDelay is not None and (
+            time.monotonic() >= timeStart + hedgeDelay
+        ):
+            hedgeDelay = None
+            countRequestStat("hedges")
+            attempts[submitAttempt(urlIn, dataIn, fileIn, deadlineIn)] = True
+    abandonAttempts(attempts)
+    countRequestStat("deadlinesExceeded")
+    raise TimeoutError("Request deadline exceeded: " + urlIn)
+
+
+def submitAttempt(urlIn, dataIn, fileIn, deadlineIn):
+    global __attemptExecutor
+    if __attemptExecutor is None:
+        with __requestLock:
+            if __attemptExecutor is None:
+                __attemptExecutor = ThreadPoolExecutor(
+                    max_workers=getConfig("connection_pool_size") * 2,
+                    thread_name_prefix="request"
+                )
+    return __attemptExecutor.submit(
+        contextvars.copy_context().run,
+        sendAttempt,
+        urlIn,
+        dataIn,
+        fileIn,
+        False,
+        deadlineIn
+    )
+
+
+def abandonAttempts(attemptsIn):
+    # responses of attempts nobody waits for anymore are closed on arrival
+    def closeResponse(futureIn):
+        if futureIn.exception() is None:
+            futureIn.result().close()
+        return
+    for future in attemptsIn:
+        future.add_done_callback(closeResponse)
+    return
+
+
+def isIdempotentRequest(urlIn, fileIn):
+    if fileIn is not None:
+        return False  # file objects cannot be read twice
+    path = urlsplit(urlIn).path.strip("/")
+    return path in __idempotentEndpoints
+
+
+def getRemainingSeconds(deadlineIn):
+    if deadlineIn is None:
+        return None
+    return deadlineIn - time.monotonic()
+
+
+def getRetryDelay(attemptIn):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(
+        getConfig("request_retry_backoff_max"),
+        getConfig("request_retry_backoff") * (2 ** attemptIn)
+    ))
+
+
+def countRequestStat(statIn):
+    with __requestLock:
+        __requestStats[statIn] += 1
+    return
+
+
+def getRequestStats():
+    with __requestLock:
+        return dict(__requestStats) | {
+            "openCircuits": [
+                hostKey for hostKey, circuit in __circuits.items()
+                if circuit["openUntil"] is not None
+            ]
+        }
+
+
+#############################
+""" BEGIN CIRCUIT BREAKER """
+#############################
+
+
+def getCircuit(hostKeyIn):
+    circuit = __circuits.get(hostKeyIn)
+    if circuit is None:
+        with __requestLock:
+            circuit = __circuits.setdefault(hostKeyIn, {
+                "failures": 0,  # in a row
+                "openUntil": None,
+                "trial": False  # a request is testing a half-open circuit
+            })
+    return circuit
+
+
+def checkCircuit(hostKeyIn):
+    # open: fail fast until the cooldown is over, then let one request
+    # through (half-open) - its result closes or re-opens the circuit,
+    # returns True for that request
+    circuit = getCircuit(hostKeyIn)
+    with __requestLock:
+        if circuit["openUntil"] is None:
+            return False
+        if time.monotonic() >= circuit["openUntil"] and not circuit["trial"]:
+            circuit["trial"] = True
+            return True
+        __requestStats["circuitRejections"] += 1
+    raise ConnectionError(
+        "Circuit open for " + hostKeyIn + " after "
+        "" + str(circuit["failures"]) + " failures in a row"
+    )
+
+
+def isCircuitOpen(urlIn):
+    # true while requests to the host would be rejected
+    circuit = __circuits.get(getHostKey(urlIn))
+    if circuit is None or circuit["openUntil"] is None:
+        return False
+    return circuit["trial"] or time.monotonic() < circuit["openUntil"]
+
+
+def endCircuitTrial(hostKeyIn):
+    circuit = getCircuit(hostKeyIn)
+    with __requestLock:
+        circuit["trial"] = False
+    return
+
+
+def addCircuitResult(hostKeyIn, successIn):
+    circuit = getCircuit(hostKeyIn)
+    with __requestLock:
+        circuit["trial"] = False
+        if successIn:
+            circuit["failures"] = 0
+            circuit["openUntil"] = None
+            return
+        circuit["failures"] += 1
+        threshold = getConfig("circuit_breaker_failures")
+        if threshold > 0 and circuit["failures"] >= threshold:
+            if circuit["openUntil"] is None:
+                __requestStats["circuitOpens"] += 1
+            circuit["openUntil"] = (
+                time.monotonic() + getConfig("circuit_breaker_cooldown")
+            )
+    return
+
+
+######################
+""" BEGIN LATENCIES """
+######################
+
+
+def getLatencyKey(urlIn, dataIn):
+    # per model as well, models on the same endpoint differ a lot in speed
+    url = urlsplit(urlIn)
+    key = url.scheme + "://" + url.netloc + url.path
+    if dataIn is not None and dataIn.get("model") is not None:
+        key += " " + str(dataIn["model"])
+    return key
+
+
+def addLatency(keyIn, secondsIn):
+    with __requestLock:
+        latencies = __latencies.get(keyIn)
+        if latencies is None:
+            latencies = deque(maxlen=__latencySamples)
+            __latencies[keyIn] = latencies
+        latencies.append(secondsIn)
+    return
+
+
+@contextlib.contextmanager
+def untimedRequests():
+    # requests sent inside are left out of the latencies used for hedging
+    # and routing (eg. the tiny warm-up pings)
+    token = __latencyRecording.set(False)
+    try:
+        yield
+    finally:
+        __latencyRecording.reset(token)
+    return
+
+
+def isRecordingLatencies():
+    return __latencyRecording.get()
+
+
+def getHedgeDelay(keyIn):
+    # the p95 latency, or None until there are enough samples to tell
+    with __requestLock:
+        latencies = sorted(__latencies.get(keyIn, []))
+    if len(latencies) < getConfig("request_hedging_min_samples"):
+        return None
+    return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
@@ -0,0 +1,156 @@
+# this file holds the hierarchical timing spans
+#
+#     with span("preprocess", file=filePath):
+#         ...
+#
+#     @traced("parse")
+#     def parse(...):
+#         ...
+#
+# spans nest through a context variable, so they follow threads (see
+# mapStagesInOrder) and asyncio tasks; when tracing is disabled span()
+# returns a shared no-op context manager
+
+
+import contextlib
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+
+from modules.util.strings.paths import TRACES_FILE_PATH
+
+
+__enabled = False
+__noSpan = contextlib.nullcontext()
+__currentSpan = contextvars.ContextVar("currentSpan", default=None)
+__spanIds = itertools.count(1)
+__spans = []  # finished spans, waiting to be exported
+__spansLock = threading.Lock()
+
+
+def setSpansEnabled(enabledIn):
+    global __enabled
+    __enabled = enabledIn
+    return
+
+
+def isSpansEnabled():
+    return __enabled
+
+
+def span(nameIn, **attributesIn):
+    if not __enabled:
+        return __noSpan
+    return recordSpan(nameIn, attributesIn)
+
+
+def traced(nameIn):
+    def decorator(functionIn):
+        @functools.wraps(functionIn)
+        def wrapper(*args, **kwargs):
+            if not __enabled:
+                return functionIn(*args, **kwargs)
+            with recordSpan(nameIn, {}):
+                return functionIn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def recordSpan(nameIn, attributesIn):
+    parent = __currentSpan.get()
+    item = {
+        "id": next(__spanIds),
+        "parent": parent["id"] if parent is not None else None,
+        "root": parent["root"] if parent is not None else None,
+        "name": nameIn,
+        "thread": threading.get_ident(),
+        "start": time.perf_counter(),
+        "duration": None,
+        "attributes": attributesIn
+    }
+    if item["root"] is None:
+        item["root"] = item["id"]
+    token = __currentSpan.set(item)
+    try:
+        yield item
+    except BaseException as e:
+        item["attributes"]["error"] = type(e).__name__
+        raise
+    finally:
+        item["duration"] = time.perf_counter() - item["start"]
+        __currentSpan.reset(token)
+        with __spansLock:
+            __spans.append(item)
+    return
+
+
+def getSpans(rootIn=None):
+    with __spansLock:
+        if rootIn is None:
+            return list(__spans)
+        return [s for s in __spans if s["root"] == rootIn]
+
+
+def formatSpanTree(rootIn):
+    # one line per span, indented by depth, in start order
+    spans = sorted(getSpans(rootIn), key=lambda s: s["start"])
+    depths = {}
+    lines = []
+    for s in spans:
+        depth = depths.get(s["parent"], -1) + 1
+        depths[s["id"]] = depth
+        lines.append(
+            "  " * depth + s["name"] + f": {s['duration'] * 1000:0.1f} ms"
+        )
+    return "\n".join(lines)
+
+
+def exportSpans(formatIn, rootIn=None):
+    # writes the finished spans of rootIn (all of them when None) to
+    # output/traces/ and forgets them - the spans of other prompts still
+    # running are left for their own export
+    global __spans
+    with __spansLock:
+        if rootIn is None:
+            spans = __spans
+            __spans = []
+        else:
+            spans = [s for s in __spans if s["root"] == rootIn]
+            __spans = [s for s in __spans if s["root"] != rootIn]
+    if len(spans) == 0:
+        return None
+    os.makedirs(TRACES_FILE_PATH, exist_ok=True)
+    if formatIn == "chrome":
+        # chrome://tracing or https://ui.perfetto.dev
+        filePath = TRACES_FILE_PATH + "trace-" + str(os.getpid()) + "-"
+        filePath += str(spans[0]["id"]) + ".json"
+        events = [
+            {
+                "name": s["name"],
+                "ph": "X",
+                "ts": s["start"] * 1e6,
+                "dur": s["duration"] * 1e6,
+                "pid": os.getpid(),
+                "tid": s["thread"],
+                "args": s["attributes"] | {
+                    "id": s["id"],
+                    "parent": s["parent"]
+                }
+            }
+            for s in spans
+        ]
+        with open(filePath, "w") as f:
+            json.dump({"traceEvents": events}, f, default=str)
+    else:
+        filePath = TRACES_FILE_PATH + "spans.jsonl"
+        with open(filePath, "a") as f:
+            for s in spans:
+                f.write(json.dumps(s, default=str) + "\n")
+    return filePath
+
@@ -0,0 +1,226 @@
+# this file holds the columnar store of the size/weight results - every
+# result is parsed into numbers and appended to one binary file per column,
+# which NumPy maps into memory for the aggregate queries
+
+
+import array
+import os
+import re
+import threading
+import time
+
+
+from modules.util.strings.paths import RESULTS_FILE_PATH
+
+
+# [name, array typecode, NumPy dtype] - the files hold the raw values in
+# native byte order, so a column is also numpy.fromfile(path, dtype)
+__columns = [
+    ["object", "I", "=u4"],  # index into objects.txt
+    ["length", "d", "=f8"],  # centimeters
+    ["width", "d", "=f8"],
+    ["height", "d", "=f8"],
+    ["weight", "d", "=f8"],  # grams
+    ["time", "d", "=f8"],  # unix seconds
+    ["cached", "B", "=u1"]  # 1 when the result was reused
+]
+__measureColumns = ["length", "width", "height", "weight"]
+
+
+# "Size: 8.0cm by 8.0cm by 7.5cm, weight: 1.5kg", see __grammarString in
+# pipeline.py - the weight may be in mg or kg
+__number = r"([0-9]+\.?[0-9]*)"
+__resultPattern = re.compile(
+    "Size: " + __number + "cm by " + __number + "cm by " + __number + "cm, "
+    "weight: " + __number + "([mk]?)g"
+)
+__weightUnits = {"": 1.0, "k": 1000.0, "m": 0.001}
+
+
+__storeLock = threading.Lock()
+__objectIds = None  # name -> id, loaded on first append
+__rows = None  # rows in every column, checked on first append
+
+
+def parseSizeWeight(resultIn):
+    # returns [length, width, height, grams], or None when it does not parse
+    if resultIn is None:
+        return None
+    match = __resultPattern.search(resultIn)
+    if match is None:
+        return None
+    return [
+        float(match.group(1)),
+        float(match.group(2)),
+        float(match.group(3)),
+        float(match.group(4)) * __weightUnits[match.group(5)]
+    ]
+
+
+def getColumnFilePath(columnIn):
+    return RESULTS_FILE_PATH + columnIn + ".bin"
+
+
+def getObjectsFilePath():
+    return RESULTS_FILE_PATH + "objects.txt"
+
+
+##########################
+""" BEGIN STORE WRITES """
+##########################
+
+
+def appendResult(objectIn, measuresIn, cachedIn):
+    # objectIn is the normalized object name, measuresIn from parseSizeWeight
+    global __rows
+    with __storeLock:
+        openStore()
+        objectId = __objectIds.get(objectIn)
+        if objectId is None:
+            objectId = len(__objectIds)
+            with open(getObjectsFilePath(), "a") as f:
+                f.write(objectIn + "\n")
+            __objectIds[objectIn] = objectId
+        values = {
+            "object": objectId,
+            "time": time.time(),
+            "cached": 1 if cachedIn else 0
+        }
+        values |= dict(zip(__measureColumns, measuresIn))
+        for name, typecode, dtype in __columns:
+            with open(getColumnFilePath(name), "ab") as f:
+                array.array(typecode, [values[name]]).tofile(f)
+        __rows += 1
+    return
+
+
+def openStore():
+    # loads the object names and cuts every column to the same number of
+    # rows, in case the last append was interrupted
+    global __objectIds, __rows
+    if __rows is not None:
+        return
+    os.makedirs(RESULTS_FILE_PATH, exist_ok=True)
+    __objectIds = {}
+    for name in readObjectNames():
+        __objectIds[name] = len(__objectIds)
+    __rows = getStoreRows()
+    for name, typecode, dtype in __columns:
+        filePath = getColumnFilePath(name)
+        if os.path.isfile(filePath):
+            os.truncate(filePath, __rows * array.array(typecode).itemsize)
+    return
+
+
+def readObjectNames():
+    # drops a name cut short by an interrupted append
+    filePath = getObjectsFilePath()
+    if not os.path.isfile(filePath):
+        return []
+    with open(filePath, "rb") as f:
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    if end < len(data):
+        os.truncate(filePath, end)
+    return data[0:end].decode("utf-8").split("\n")[0:-1]
+
+
+def getStoreRows():
+    rows = None
+    for name, typecode, dtype in __columns:
+        filePath = getColumnFilePath(name)
+        size = os.path.getsize(filePath) if os.path.isfile(filePath) else 0
+        columnRows = size // array.array(typecode).itemsize
+        rows = columnRows if rows is None else min(rows, columnRows)
+    return rows
+
+
+###########################
+""" BEGIN STORE QUERIES """
+###########################
+
+
+def loadResultColumns():
+    # returns [name -> NumPy array, object names] - the arrays are mapped
+    # from the column files, so only the parts a query touches are read
+    import numpy
+    with __storeLock:
+        rows = getStoreRows()
+        objects = readObjectNames()
+    columns = {}
+    for name, typecode, dtype in __columns:
+        if rows == 0:
+            columns[name] = numpy.zeros(0, dtype)
+        else:
+            columns[name] = numpy.memmap(
+                getColumnFilePath(name),
+                dtype=dtype,
+                mode="r",
+                shape=(rows,)
+            )
+    return [columns, objects]
+
+
+def getResultMask(
+    columnsIn,
+    objectsIn,
+    objectIn=None,
+    minWeightIn=None,
+    maxWeightIn=None,
+    sinceIn=None,
+    freshOnlyIn=False
+):
+    # rows to keep - objectIn matches every object name containing it,
+    # sinceIn is in unix seconds, freshOnlyIn drops reused results
+    import numpy
+    mask = numpy.ones(len(columnsIn["object"]), dtype=bool)
+    if objectIn is not None:
+        objectIds = [i for i, n in enumerate(objectsIn) if objectIn in n]
+        mask &= numpy.isin(columnsIn["object"], objectIds)
+    if minWeightIn is not None:
+        mask &= columnsIn["weight"] >= minWeightIn
+    if maxWeightIn is not None:
+        mask &= columnsIn["weight"] <= maxWeightIn
+    if sinceIn is not None:
+        mask &= columnsIn["time"] >= sinceIn
+    if freshOnlyIn:
+        mask &= columnsIn["cached"] == 0
+    return mask
+
+
+def getResultAggregates(columnsIn, objectsIn, maskIn):
+    # returns object name -> {"count", "mean": {...}, "median": {...}} over
+    # length, width, height and weight, most results first
+    import numpy
+    objectIds = numpy.asarray(columnsIn["object"][maskIn])
+    if len(objectIds) == 0:
+        return {}
+    counts = numpy.bincount(objectIds, minlength=len(objectsIn))
+    groups = numpy.flatnonzero(counts)
+    counts = counts[groups]
+    ends = numpy.cumsum(counts)
+    starts = ends - counts
+    # rows of the same object next to each other, for the medians
+    order = numpy.argsort(objectIds, kind="stable")
+    means = {}
+    medians = {}
+    for name in __measureColumns:
+        values = numpy.asarray(columnsIn[name][maskIn])
+        means[name] = numpy.bincount(
+            objectIds,
+            weights=values,
+            minlength=len(objectsIn)
+        )[groups] / counts
+        values = values[order]
+        medians[name] = [
+            numpy.median(values[start:end])
+            for start, end in zip(starts, ends)
+        ]
+    aggregates = {}
+    for i in numpy.argsort(-counts, kind="stable"):
+        aggregates[objectsIn[groups[i]]] = {
+            "count": int(counts[i]),
+            "mean": {n: float(means[n][i]) for n in __measureColumns},
+            "median": {n: float(medians[n][i]) for n in __measureColumns}
+        }
+    return aggregates
@@ -3,6 +3,12 @@
 
 # output paths
 CONVERSATIONS_FILE_PATH = "output/conversations/"
+CONVERSATIONS_CATALOG_FILE_PATH = "output/conversations/catalog.json"
+CACHE_FILE_PATH = "output/cache/"
+BENCHMARKS_FILE_PATH = "output/benchmarks/"
+TRACES_FILE_PATH = "output/traces/"
+RESULTS_FILE_PATH = "output/results/"
+WATCH_LEDGER_FILE_PATH = "output/watch/ledger.jsonl"
 
 
 # configs paths
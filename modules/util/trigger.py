@@ -1,12 +1,29 @@
+import time
+
+
 from modules.file.operation import folderExists, getPathTree
-from modules.file.reader import getFileContents
+from modules.file.reader import getFileContents, getFileContentsStages
+from modules.util.configuration import getConfig
 from modules.util.util import printDebug, printError, getStringMatchPercentage
-from modules.util.util import startTimer, endTimer, errorBlankEmptyText
+from modules.util.span import span, formatSpanTree, exportSpans
+from modules.util.util import errorBlankEmptyText
 from modules.util.util import getFilePathFromPrompt, checkEmptyString
 from modules.util.util import formatArrayToString, printResponse
+from modules.util.util import mapStagesInOrder
 
 
 def checkTriggers(promptIn, seedIn):
+    triggerToCall = getTriggerToCall(promptIn)
+    if triggerToCall is not None:
+        result = callTrigger(triggerToCall, promptIn, seedIn)
+        if result is not None:
+            printResponse("\n\n" + result + "\n")
+            return True
+    printDebug("\nNo triggers detected.")
+    return False
+
+
+def getTriggerToCall(promptIn):
     potentialTriggers = {}
     for key, value in getTriggerMap().items():
         for v in value:
@@ -15,12 +32,7 @@ def checkTriggers(promptIn, seedIn):
     if len(potentialTriggers) == 1:
         triggerToCall = list(potentialTriggers)[0]
         printDebug("\nCalling trigger: " + str(triggerToCall))
-        startTimer(0)
-        result = triggerToCall(promptIn, seedIn)
-        endTimer(0)
-        if result is not None:
-            printResponse("\n\n" + result + "\n")
-            return True
+        return triggerToCall
     elif len(potentialTriggers) > 1:
         triggerToCall = None
         for trigger, percentage in potentialTriggers.items():
@@ -30,14 +42,22 @@ def checkTriggers(promptIn, seedIn):
                 triggerToCall = trigger
         if triggerToCall is not None:
             printDebug("\nCalling best-matched trigger: " + str(triggerToCall))
-            startTimer(0)
-            result = triggerToCall(promptIn, seedIn)
-            endTimer(0)
-            if result is not None:
-                printResponse("\n\n" + result + "\n")
-                return True
-    printDebug("\nNo triggers detected.")
-    return False
+        return triggerToCall
+    return None
+
+
+def callTrigger(triggerIn, promptIn, seedIn):
+    timeStart = time.perf_counter()
+    with span("prompt", trigger=triggerIn.__name__) as promptSpan:
+        result = triggerIn(promptIn, seedIn)
+    printDebug(
+        f"\nPrompt processing time: {time.perf_counter() - timeStart:0.3f}"
+        " seconds"
+    )
+    if promptSpan is not None:
+        printDebug(lambda: "\n" + formatSpanTree(promptSpan["id"]))
+        exportSpans(getConfig("span_trace_format"), promptSpan["id"])
+    return result
 
 
 def triggerOpenFile(promptIn, seedIn):
@@ -62,33 +82,65 @@ def triggerOpenFile(promptIn, seedIn):
                     formattedFilePath,
                     ""
                 )
-            filePaths = []
             if folderExists(filePath):
                 pathTree = getPathTree(filePath)
-                filePaths = pathTree
                 printDebug("\nOpening folder: " + filePath)
                 printDebug("\nFiles in folder:")
-                printDebug(formatArrayToString(pathTree, "\n"))
+                printDebug(lambda: formatArrayToString(pathTree, "\n"))
+                fileContents += getFolderContents(pathTree)
             else:
-                filePaths = [filePath]
-            for f in filePaths:
-                fullFileName = f.split("/")
-                fileName = fullFileName[len(fullFileName) - 1]
-                printDebug("\nParsing file: " + fileName)
-                fileContent = getFileContents(f)
-                if fileContent is not None:
-                    if checkEmptyString(fileContent):
-                        fileContent = errorBlankEmptyText("file")
-                    fileContents.append(fileContent)
-                else:
-                    printError("\nCannot get file contents.\n")
-                    return None
+                printDebug("\nParsing file: " + getFileName(filePath))
+                try:
+                    result = [getFileContents(filePath), None]
+                except Exception as e:
+                    # e.g. an image that cannot be decoded, reported like a
+                    # file in a folder (see startFileContents)
+                    result = [None, str(e)]
+                # labelled like the files of a folder, also on failure so
+                # the other files are still returned
+                fileContents.append(
+                    getFileName(filePath) + ": "
+                    "" + getFolderFileContents(filePath, result)
+                )
         else:
             printDebug(
                 "\nSkipped \"" + filePath + "\" because it did not "
                 "contain \"/\" - assuming invalid file path."
             )
-    return fileContents[0]
+    if len(fileContents) == 0:
+        return None
+    return formatArrayToString(fileContents, "\n\n")
+
+
+def getFolderContents(filePathsIn):
+    results = mapStagesInOrder(
+        getFileContentsStages(),
+        filePathsIn,
+        getConfig("pipeline_window")
+    )
+    return [
+        getFileName(filePath) + ": " + getFolderFileContents(filePath, result)
+        for filePath, result in zip(filePathsIn, results)
+    ]
+
+
+def getFolderFileContents(filePathIn, resultIn):
+    # errors are kept per file so one bad file does not stop the folder
+    fileContent, error = resultIn
+    if error is not None:
+        printError("\n" + getFileName(filePathIn) + ": " + error)
+        return "Cannot get file contents: " + error
+    if fileContent is None:
+        printError("\nCannot get file contents: " + filePathIn + "\n")
+        return "Cannot get file contents."
+    if checkEmptyString(fileContent):
+        return errorBlankEmptyText("file")
+    return fileContent
+
+
+def getFileName(filePathIn):
+    fullFileName = filePathIn.split("/")
+    return fullFileName[len(fullFileName) - 1]
 
 
 def getTriggerMap():
@@ -1,42 +1,24 @@
-import base64
+import collections
+import contextvars
 import datetime
 import json
+import os
 import random
 import re
-import readline  # unused, but fixes keyboard arrow keys for inputs
-import requests
+import sys
+import threading
 import time
 
 
-from difflib import SequenceMatcher
-from PIL import Image
-from termcolor import colored  # https://pypi.org/project/termcolor/
-
-
-from modules.file.operation import fileExists, deleteFile
-from modules.util.configuration import getConfig
+from concurrent.futures import Future, ThreadPoolExecutor
+from modules.util.configuration import getConfig, getDebugLevel
+from modules.util.output import writeOutput, writeLog, flushOutput
+from modules.util.backend import sendBackendRequest, getBackendAddresses
+from modules.util.backend import setBackendModels
 from modules.util.strings.endpoints import MODELS_ENDPOINT
 from modules.util.strings.endpoints import TEXT_ENDPOINT
 
 
-def getTextToTextSystemPrompt(objectIn):
-    return ("What is the average size (in centimeters), as well as the average weight (in grams (g)), of the following object: " + objectIn)
-
-
-__imagetotextSystemPromptNew = (
-    "What is the single main subject, and the main subject only, in the given image?"
-)
-
-
-__grammarStringNew = """root ::= ("The single main subject in the given image is " string ".")
-string ::= [a-zA-Z ]*"""
-
-
-__grammarString = """root ::= ("Size: " number "cm by " number "cm by " number "cm, weight: " weight "g")
-number ::= [0-9]+["."]?[0-9]{1}
-weight ::= [0-9]+["."]?[0-9]{1}[mk]{0,1}"""
-
-
 __serverResponseTokens = [
     "</s>",
     "<|end_of_sentence|>",
@@ -50,62 +32,85 @@ def getServerResponseTokens():
     return __serverResponseTokens
 
 
-__tic = time.perf_counter()
-__tick = time.perf_counter()
-
-
 ####################
 """ BEGIN PRINTS """
 ####################
 
 
+__inputPending = b""  # read from stdin but not returned yet
+
+
 def printInput(string):
-    return input(string + ": ")
+    flushOutput()
+    if sys.stdin.isatty() and sys.stdout.isatty():
+        return input(string + ": ")
+    # otherwise input() reads through sys.stdin, whose lock a read left
+    # waiting on the prompt thread would hold at interpreter shutdown
+    writeOutput(string + ": ", None, "")
+    return readInputLine()
+
+
+def readInputLine():
+    # like input(), raises EOFError at the end of the input
+    global __inputPending
+    while b"\n" not in __inputPending:
+        data = os.read(sys.stdin.fileno(), 4096)
+        if len(data) == 0:
+            if len(__inputPending) == 0:
+                raise EOFError
+            break
+        __inputPending += data
+    line, separator, __inputPending = __inputPending.partition(b"\n")
+    return line.decode("utf-8", "replace").rstrip("\r")
 
 
 def printResponse(string, endIn="\n"):
-    print(colored(string, "green"), end=endIn)
+    writeOutput(string, "green", endIn)
     return
 
 
 def printGeneric(string, repeats=0):
     if repeats == 0:
-        print(colored(string, "light_grey"))
+        writeOutput(string, "light_grey")
     else:
-        print(colored(string, "light_grey") * repeats)
+        writeOutput(string * repeats, "light_grey")
     return
 
 
 def printGreen(string):
-    print(colored(string, "light_green"))
+    writeOutput(string, "light_green")
     return
 
 
 def printRed(string):
-    print(colored(string, "light_red"))
+    writeOutput(string, "light_red")
     return
 
 
 def printError(string):
-    print(colored(string, "red"))
+    writeOutput(string, "red")
     return
 
 
+# the log levels below also take a function returning the string, so that
+# messages which are expensive to build are only built when they are shown
+
+
 def printInfo(string):
-    if getConfig("debug_level") >= 1:
-        print(colored(string, "yellow"))
+    if getDebugLevel() >= 1:
+        writeLog(string() if callable(string) else string, "yellow", False)
     return
 
 
 def printDebug(string):
-    if getConfig("debug_level") >= 2:
-        print(colored(string, "light_grey"))
+    if getDebugLevel() >= 2:
+        writeLog(string() if callable(string) else string, "light_grey", True)
     return
 
 
 def printDump(string):
-    if getConfig("debug_level") >= 3:
-        print(colored(string, "dark_grey"))
+    if getDebugLevel() >= 3:
+        writeLog(string() if callable(string) else string, "dark_grey", True)
     return
 
 
@@ -116,8 +121,9 @@ def printSeparator():
 
 def printPromptHistory(promptHistory):
     printDump("\nCurrent conversation:")
-    for item in promptHistory:
-        printDump("\n" + item["content"])
+    if getDebugLevel() >= 3:
+        for item in promptHistory:
+            printDump("\n" + item["content"])
     return
 
 
@@ -288,34 +294,33 @@ def getRandomSeed():
 
 def getPromptHistoryFromConversation(conversationIn, chatFormat):
     promptHistory = []
-    stringBuilder = ""
+    turn = []  # lines of the current turn, joined once it is complete
     for line in conversationIn:
         if line.startswith("SYSTEM: ") or (
             line.startswith("USER: ") or line.startswith("ASSISTANT: ")
         ):
-            if len(stringBuilder) == 0:
-                stringBuilder += line
-            else:
-                s = getRoleAndContentFromString(stringBuilder)
-                if s is not None:
-                    promptHistory = addToPrompt(
-                        promptHistory,
-                        s[0].lower(),
-                        s[1],
-                        chatFormat
-                    )
-                stringBuilder = line
+            if len(turn) > 0:
+                promptHistory = addTurnToPrompt(
+                    promptHistory,
+                    "".join(turn),
+                    chatFormat
+                )
+            turn = [line]
         else:
-            stringBuilder += line
-    s = getRoleAndContentFromString(stringBuilder)
+            turn.append(line)
+    return addTurnToPrompt(promptHistory, "".join(turn), chatFormat)
+
+
+def addTurnToPrompt(promptHistoryIn, turnIn, chatFormat):
+    s = getRoleAndContentFromString(turnIn)
     if s is not None:
-        promptHistory = addToPrompt(
-            promptHistory,
+        promptHistoryIn = addToPrompt(
+            promptHistoryIn,
             s[0].lower(),
             s[1],
             chatFormat
         )
-    return promptHistory
+    return promptHistoryIn
 
 
 def escapeJSONApostrophes(stringIn):
@@ -327,6 +332,7 @@ def removeApostrophesFromFileInput(stringIn):
 
 
 def getStringMatchPercentage(sourceStringIn, targetStringIn):
+    from difflib import SequenceMatcher  # only needed for fuzzy matching
     return SequenceMatcher(None, sourceStringIn, targetStringIn).ratio() * 100
 
 
@@ -357,33 +363,71 @@ def getDateTimeString():
     return datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
 
-def startTimer(timerNumber):
-    match timerNumber:
-        case 0:  # foreground process timer
-            global tic
-            tic = time.perf_counter()
-        case 1:  # tests timer
-            global tick
-            tick = time.perf_counter()
-        case _:
-            printError("\nUnknown start timer: " + str(timerNumber))
+def mapInOrder(functionIn, itemsIn, workersIn):
+    # yields results in input order, keeping at most 2 * workers in flight
+    workersIn = max(1, workersIn)
+    return mapStagesInOrder([[functionIn, workersIn]], itemsIn, workersIn * 2)
+
+
+def mapStagesInOrder(stagesIn, itemsIn, windowIn):
+    # stages are [function, workers] pairs, each with its own thread pool
+    # - the output of one stage is the input of the next, so item n + 1 can
+    # be in the first stage while item n is in the second
+    # - at most windowIn items are in flight across all stages; new items
+    # are only taken once the oldest result has been yielded (backpressure)
+    # - results are yielded in input order
+    executors = [
+        ThreadPoolExecutor(max_workers=max(1, workers))
+        for function, workers in stagesIn
+    ]
+    try:
+        pending = collections.deque()
+        for item in itemsIn:
+            pending.append(submitStages(stagesIn, executors, item))
+            if len(pending) >= max(1, windowIn):
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=True, cancel_futures=True)
     return
 
 
-def endTimer(timerNumber):
-    toc = time.perf_counter()
-    stringFormat = "\n"
-    match timerNumber:
-        case 0:
-            stringFormat += f"Prompt processing time: {toc - tic:0.3f}"
-        case 1:
-            stringFormat += f"Test time: {toc - tick:0.3f}"
-        case _:
-            printError("\nUnknown end timer: " + str(timerNumber))
+def submitStages(stagesIn, executorsIn, itemIn):
+    finalFuture = Future()
+    # stages of one item run one after another in the submitter's context,
+    # so spans opened in a stage keep the caller's span as their parent
+    context = contextvars.copy_context()
+
+    def runStage(index, value):
+        try:
+            future = executorsIn[index].submit(
+                context.run,
+                stagesIn[index][0],
+                value
+            )
+        except RuntimeError as e:  # executor shut down
+            finalFuture.set_exception(e)
             return
-    stringFormat += " seconds"
-    printDebug(stringFormat)
-    return
+        future.add_done_callback(
+            lambda doneFuture: onStageDone(index, doneFuture)
+        )
+        return
+
+    def onStageDone(index, future):
+        if future.cancelled():
+            finalFuture.cancel()
+        elif future.exception() is not None:
+            finalFuture.set_exception(future.exception())
+        elif index + 1 == len(stagesIn):
+            finalFuture.set_result(future.result())
+        else:
+            runStage(index + 1, future.result())
+        return
+
+    runStage(0, itemIn)
+    return finalFuture
 
 
 ######################
@@ -396,20 +440,24 @@ def sendCurlCommand(
     dataIn=None,
     fileIn=None,
     returnResult=False,
-    returnJson=True
+    returnJson=True,
+    addressIn=None
 ):
-    theAddress = getConfig("address").replace("/v1", "/")
+    # addressIn picks the server, otherwise the best one for the model is
     try:
+        model = None
         if dataIn is not None and dataIn.get("model") is not None:
-            if not findModelFromServer(dataIn["model"]):
+            model = dataIn["model"]
+            if not findModelFromServer(model):
                 printError("\nRequested model does not exist - aborting.")
                 return None
-        if dataIn is not None:
-            result = requests.post(theAddress + endpointIn, json=dataIn)
-        elif fileIn is not None:
-            result = requests.post(theAddress + endpointIn, files=fileIn)
-        else:
-            result = requests.get(theAddress + endpointIn)
+        result = sendBackendRequest(
+            endpointIn,
+            modelIn=model,
+            addressIn=addressIn,
+            dataIn=dataIn,
+            fileIn=fileIn
+        )
 
         plainResult = str(result)
 
@@ -417,7 +465,10 @@ def sendCurlCommand(
             if returnJson:
                 resultJson = result.json()
                 if "error" in resultJson is not None:
-                    printError("\nError: " + resultJson["error"]["message"])
+                    errorMessage = resultJson["error"]["message"]
+                    if isModelNotFoundError(errorMessage):
+                        invalidateModelCatalog()
+                    printError("\nError: " + errorMessage)
                     return
                 elif returnResult:
                     return resultJson
@@ -426,19 +477,8 @@ def sendCurlCommand(
                     return json.loads(str(result.content, "utf-8"))
             else:
                 return result.content
-        elif plainResult == "<Response [404]>":
-            printError(
-                "\nResource cannot be found on the server - "
-                "check the endpoint address.\n"
-            )
         else:
-            printError("\nError: " + plainResult)
-            jsonError = json.loads(str(result.content, "utf-8"))
-            if jsonError.get("error").get("message") is not None:
-                errorMessage = jsonError["error"]["message"]
-                printError("\n" + errorMessage)
-            else:
-                printError("\nResponse: " + str(jsonError))
+            printServerError(result)
     except Exception as e:
         printError(str(e))
         printError(
@@ -447,111 +487,302 @@ def sendCurlCommand(
     return
 
 
-def createImageToTextRequest(promptIn, filePathIn):
-    if len(getConfig("default_image_to_text_model")) == 0:
+def printServerError(resultIn):
+    plainResult = str(resultIn)
+    if plainResult == "<Response [404]>":
+        # also returned for a missing endpoint, which says nothing about
+        # the models on the server
+        if isModelNotFoundError(str(resultIn.content, "utf-8", "replace")):
+            invalidateModelCatalog()
         printError(
-            "\nImg2Text is disabled because the Img2Text model is not set.\n"
+            "\nResource cannot be found on the server - "
+            "check the endpoint address.\n"
         )
-        return None
+    else:
+        printError("\nError: " + plainResult)
+        jsonError = json.loads(str(resultIn.content, "utf-8"))
+        if jsonError.get("error").get("message") is not None:
+            errorMessage = jsonError["error"]["message"]
+            if isModelNotFoundError(errorMessage):
+                invalidateModelCatalog()
+            printError("\n" + errorMessage)
+        else:
+            printError("\nResponse: " + str(jsonError))
+    return
 
-    if fileExists(filePathIn):
-        convertExt = ["jpg", "jpeg"]
-        fileExtension = filePathIn.split(".")
-        fileExtension = fileExtension[len(fileExtension) - 1]
-        converted = False
-        if fileExtension in convertExt:
-            printDebug("Converting image to PNG.")
-            newFilePath = filePathIn.replace(fileExtension,"png")
-            im = Image.open(filePathIn)
-            width, height = im.size
-            factor = width / 512
-            new_height = height / factor
-            im = im.resize((512, int(new_height)), Image.ANTIALIAS)
-            im.save(newFilePath, optimize=True, quality=75)
-            filePathIn = filePathIn.replace(fileExtension,"png")
-            fileExtension = "png"
-            converted = True
-        systemMessageBody = {
-            "role": "USER"
-        }
-        with open(filePathIn, "rb") as f:
-            systemMessageBody["content"] = [
-                {
-                    "type": "text",
-                    "text": __imagetotextSystemPromptNew
-                },
+
+def sendStreamingCurlCommand(endpointIn, dataIn):
+    # returns the same shape as a non-streamed chat completion
+    try:
+        if dataIn.get("model") is not None:
+            if not findModelFromServer(dataIn["model"]):
+                printError("\nRequested model does not exist - aborting.")
+                return None
+        timeStart = time.perf_counter()
+        result = sendBackendRequest(
+            endpointIn,
+            modelIn=dataIn.get("model"),
+            dataIn=dataIn | {"stream": True},
+            streamIn=True
+        )
+        with result:
+            if str(result) != "<Response [200]>":
+                printServerError(result)
+                return None
+            timeFirstToken = None
+            tokens = 0
+            usageTokens = None
+            content = []
+            # text/event-stream is always UTF-8, but without a charset in
+            # the content type requests would decode it as ISO-8859-1
+            result.encoding = "utf-8"
+            for line in result.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                line = line[5:].strip()
+                if line == "[DONE]":
+                    break
+                chunk = json.loads(line)
+                if chunk.get("error") is not None:
+                    errorMessage = chunk["error"]["message"]
+                    if isModelNotFoundError(errorMessage):
+                        invalidateModelCatalog()
+                    printError("\nError: " + errorMessage)
+                    return None
+                if chunk.get("usage") is not None:
+                    usageTokens = chunk["usage"].get("completion_tokens")
+                if len(chunk.get("choices", [])) == 0:
+                    continue
+                choice = chunk["choices"][0]
+                token = choice.get("delta", {}).get("content")
+                if token is None:
+                    token = choice.get("text")
+                if token:
+                    if timeFirstToken is None:
+                        timeFirstToken = time.perf_counter()
+                    tokens += 1
+                    content.append(token)
+                    printResponse(token, endIn="")
+            timeEnd = time.perf_counter()
+        printResponse("")
+        if usageTokens is not None:
+            tokens = usageTokens
+        addStreamingStats(
+            dataIn.get("model"),
+            tokens,
+            timeStart,
+            timeFirstToken,
+            timeEnd
+        )
+        return {
+            "choices": [
                 {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": "data:image/" + fileExtension + ";base64," + ""
-                        "" + base64.b64encode(f.read()).decode("utf-8")
+                    "message": {
+                        "role": "assistant",
+                        "content": "".join(content)
                     }
                 }
             ]
-        if converted:
-            printDebug("Delete converted PNG image.")
-            deleteFile(filePathIn)
-        dataIn = {
-            "grammar": __grammarStringNew,
-            "model": getConfig("default_image_to_text_model"),
-            "messages": [systemMessageBody],
         }
-
-        result = sendCurlCommand(
-            TEXT_ENDPOINT,
-            dataIn=dataIn,
-            returnResult=True
+    except Exception as e:
+        printError(str(e))
+        printError(
+            "\nCannot send command to the server - check your connection."
         )
-        if result is not None:
-            message = result["choices"][0]["message"]["content"]
-            message = cleanupString(message)
-            message = cleanupServerResponseTokens(message)
-            message = message.replace("The single main subject in the given image is ", "")
-            message = message.replace(".", "")
-            printDebug("Object: " + message)
-            
-            if ' ' in message:
-                message = message.replace(" ","_")
-            systemMessageBody = {"role":"USER","content":getTextToTextSystemPrompt(message)}
-            dataIn = {
-                "grammar": __grammarString,
-                "model": "text_to_text_nous-13b",
-                "messages": [systemMessageBody],
+    return
+
+
+def sendChatCompletion(dataIn):
+    if getConfig("stream_responses"):
+        return sendStreamingCurlCommand(TEXT_ENDPOINT, dataIn)
+    return sendCurlCommand(TEXT_ENDPOINT, dataIn=dataIn, returnResult=True)
+
+
+__streamingStats = {}  # model -> totals over all streamed requests
+__streamingStatsLock = threading.Lock()
+
+
+def addStreamingStats(modelIn, tokensIn, timeStartIn, timeFirstIn, timeEndIn):
+    if timeFirstIn is None:
+        printDebug("\nNo tokens were streamed from the server.")
+        return
+    firstTokenTime = timeFirstIn - timeStartIn
+    decodeTime = timeEndIn - timeFirstIn
+    printDebug(
+        f"\nTime to first token: {firstTokenTime:0.3f} seconds, "
+        f"{tokensIn} tokens at {getTokensPerSecond(tokensIn, decodeTime)}"
+        " tokens/second"
+    )
+    with __streamingStatsLock:
+        stats = __streamingStats.setdefault(str(modelIn), {
+            "requests": 0,
+            "tokens": 0,
+            "firstTokenSeconds": 0.0,
+            "decodeSeconds": 0.0
+        })
+        stats["requests"] += 1
+        stats["tokens"] += tokensIn
+        stats["firstTokenSeconds"] += firstTokenTime
+        stats["decodeSeconds"] += decodeTime
+    return
+
+
+def getTokensPerSecond(tokensIn, secondsIn):
+    if secondsIn <= 0:
+        return "-"
+    return f"{tokensIn / secondsIn:0.1f}"
+
+
+def getStreamingStats():
+    out = {}
+    with __streamingStatsLock:
+        for model, stats in __streamingStats.items():
+            out[model] = stats | {
+                "meanFirstTokenSeconds": (
+                    stats["firstTokenSeconds"] / stats["requests"]
+                ),
+                "tokensPerSecond": (
+                    stats["tokens"] / stats["decodeSeconds"]
+                    if stats["decodeSeconds"] > 0 else None
+                )
             }
-            result = sendCurlCommand(
-                TEXT_ENDPOINT,
-                dataIn=dataIn,
-                returnResult=True
-            )
-            if result is not None:
-                message = result["choices"][0]["message"]["content"]
-                message = cleanupString(message)
-                message = cleanupServerResponseTokens(message)
-                return message
-            else:
-                printError("\nNo text response from server!\n")
-        else:
-            printError("\nNo image response from server!\n")
-    else:
-        printError("\nFile does not exist!\n")
-    return None
+    return out
 
 
 def getModelsFromServer(silent):
-    result = sendCurlCommand(MODELS_ENDPOINT, returnResult=True)
+    result = getModelCatalog()
     if not silent:
-        printDump("\n" + str(result))
-    if result is not None and not checkEmptyString(result):
-        return result["data"]
+        printDump(lambda: "\n" + str(result))
+    if result is not None:
+        return result
     else:
         printError("\nError getting model list.")
     return
 
 
 def findModelFromServer(modelNameIn):
-    models = getModelsFromServer(True)
-    if models is not None:
-        for model in models:
-            if model["id"] == modelNameIn:
-                return True
+    lastRefresh = __modelCatalogTime
+    if getModelCatalog() is not None and modelNameIn in __modelCatalogIds:
+        countModelCatalogStat("hits")
+        return True
+    countModelCatalogStat("misses")
+    # the model may have been installed since the last refresh
+    if refreshModelCatalog(lastRefresh) is not None:
+        return modelNameIn in __modelCatalogIds
     return False
+
+
+###########################
+""" BEGIN MODEL CATALOG """
+###########################
+
+
+__modelCatalog = None  # list of model objects from the server
+__modelCatalogIds = set()
+__modelCatalogTime = 0.0
+__modelCatalogLock = threading.Lock()
+__modelCatalogRefreshLock = threading.Lock()  # one refresh at a time
+__modelCatalogRefreshing = False
+__modelCatalogStats = {
+    "hits": 0,
+    "misses": 0,
+    "refreshes": 0,
+    "invalidations": 0
+}
+
+
+def getModelCatalog():
+    global __modelCatalogRefreshing
+    if __modelCatalog is None:
+        return refreshModelCatalog(__modelCatalogTime)
+    if time.monotonic() - __modelCatalogTime > getConfig("model_catalog_ttl"):
+        with __modelCatalogLock:
+            if not __modelCatalogRefreshing:
+                __modelCatalogRefreshing = True
+                threading.Thread(
+                    target=refreshModelCatalog,
+                    daemon=True
+                ).start()
+    return __modelCatalog
+
+
+def refreshModelCatalog(lastRefreshIn=None):
+    # lastRefreshIn is the catalog time the caller saw - callers that waited
+    # for another refresh to finish use its catalog instead of asking again
+    with __modelCatalogRefreshLock:
+        if lastRefreshIn is not None and (
+            __modelCatalog is not None and __modelCatalogTime != lastRefreshIn
+        ):
+            return __modelCatalog
+        return refreshModelCatalogFromServers()
+
+
+def refreshModelCatalogFromServers():
+    global __modelCatalog, __modelCatalogIds, __modelCatalogTime
+    global __modelCatalogRefreshing
+    try:
+        # every server is asked, the catalog holds the models of all of them
+        addresses = getBackendAddresses()
+        models = None
+        for address, result in zip(addresses, mapInOrder(
+            getServerModels,
+            addresses,
+            len(addresses)
+        )):
+            if result is None:
+                continue
+            setBackendModels(address, [model["id"] for model in result])
+            if models is None:
+                models = {}
+            for model in result:
+                models.setdefault(model["id"], model)
+        if models is not None:
+            with __modelCatalogLock:
+                __modelCatalog = list(models.values())
+                __modelCatalogIds = set(models.keys())
+                __modelCatalogTime = time.monotonic()
+            countModelCatalogStat("refreshes")
+        return __modelCatalog
+    finally:
+        __modelCatalogRefreshing = False
+
+
+def getServerModels(addressIn):
+    result = sendCurlCommand(
+        MODELS_ENDPOINT,
+        returnResult=True,
+        addressIn=addressIn
+    )
+    if result is None or result.get("data") is None:
+        return None
+    return result["data"]
+
+
+def invalidateModelCatalog():
+    global __modelCatalog, __modelCatalogIds
+    with __modelCatalogLock:
+        __modelCatalog = None
+        __modelCatalogIds = set()
+    countModelCatalogStat("invalidations")
+    return
+
+
+def countModelCatalogStat(statIn):
+    with __modelCatalogLock:
+        __modelCatalogStats[statIn] += 1
+    return
+
+
+def isModelNotFoundError(errorMessageIn):
+    errorMessageIn = errorMessageIn.lower()
+    return "model" in errorMessageIn and "not found" in errorMessageIn
+
+
+def getModelCatalogStats():
+    return __modelCatalogStats | {
+        "models": len(__modelCatalogIds),
+        "age": (
+            time.monotonic() - __modelCatalogTime
+            if __modelCatalog is not None else None
+        )
+    }
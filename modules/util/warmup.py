@@ -0,0 +1,137 @@
+# this file holds the model warm-up at startup and the keep-warm pings
+
+
+import threading
+import time
+
+
+from modules.util.backend import getBackendsWithModel
+from modules.util.configuration import getConfig
+from modules.util.pipeline import getTextToTextModel
+from modules.util.session import untimedRequests
+from modules.util.strings.endpoints import TEXT_ENDPOINT
+from modules.util.util import printInfo, printError, printDebug
+from modules.util.util import sendCurlCommand, mapInOrder, getModelCatalog
+
+
+__keepWarmThread = None
+__keepWarmStop = None  # a new event per thread, see stopKeepWarm
+__keepWarmJoinSeconds = 1.0  # a ping in flight is not waited for
+
+
+def getWarmupModels():
+    models = []
+    for model in [
+        getConfig("default_image_to_text_model"),
+        getTextToTextModel() if getConfig("pipeline_mode") != "fused" else None
+    ]:
+        if model is not None and len(model) > 0 and model not in models:
+            models.append(model)
+    return models
+
+
+def getWarmupTargets():
+    # [address, model] for every configured model on every server with it
+    getModelCatalog()  # fills in which server has which model
+    return [
+        [address, model]
+        for model in getWarmupModels()
+        for address in getBackendsWithModel(model)
+    ]
+
+
+def sendWarmupRequest(targetIn):
+    # a one-token completion is enough for the server to load the model,
+    # returns the seconds it took or None when it failed - load times and
+    # one-token pings would skew the latencies used for routing/hedging
+    address, model = targetIn
+    timeStart = time.perf_counter()
+    with untimedRequests():
+        result = sendCurlCommand(
+            TEXT_ENDPOINT,
+            dataIn={
+                "model": model,
+                "messages": [{"role": "USER", "content": "Hi"}],
+                "max_tokens": 1
+            },
+            returnResult=True,
+            addressIn=address
+        )
+    if result is None:
+        return None
+    return time.perf_counter() - timeStart
+
+
+def warmUpModels():
+    # returns [address, model, seconds or None] for every target
+    targets = getWarmupTargets()
+    if len(targets) == 0:
+        return []
+    printInfo("\nWarming up " + str(len(targets)) + " model(s)...")
+    timeStart = time.perf_counter()
+    results = []
+    for target, seconds in zip(targets, mapInOrder(
+        sendWarmupRequest,
+        targets,
+        len(targets)
+    )):
+        address, model = target
+        if seconds is None:
+            printError("Cannot warm up " + model + " on " + address)
+        else:
+            printInfo(f"{model} on {address}: {seconds:0.2f} seconds")
+        results.append([address, model, seconds])
+    printInfo(
+        f"Warm-up done in {time.perf_counter() - timeStart:0.2f} seconds."
+    )
+    return results
+
+
+def startKeepWarm():
+    # pings every configured model each model_keep_warm_interval seconds so
+    # the server does not unload it
+    global __keepWarmThread, __keepWarmStop
+    interval = getConfig("model_keep_warm_interval")
+    if interval is None or interval <= 0 or __keepWarmThread is not None:
+        return
+    __keepWarmStop = threading.Event()
+    __keepWarmThread = threading.Thread(
+        target=keepWarm,
+        args=(interval, __keepWarmStop),
+        daemon=True
+    )
+    __keepWarmThread.start()
+    return
+
+
+def stopKeepWarm():
+    # a thread still waiting on a ping is left to finish on its own, it
+    # stops after that ping as its event stays set
+    global __keepWarmThread
+    if __keepWarmThread is not None:
+        __keepWarmStop.set()
+        __keepWarmThread.join(__keepWarmJoinSeconds)
+        __keepWarmThread = None
+    return
+
+
+def keepWarm(intervalIn, stopIn):
+    while not stopIn.wait(intervalIn):
+        for target in getWarmupTargets():
+            if stopIn.is_set():
+                break
+            seconds = sendWarmupRequest(target)
+            if seconds is not None:
+                printDebug(
+                    f"\nKeep-warm {target[1]} on {target[0]}: "
+                    f"{seconds:0.2f} seconds"
+                )
+    return
+
+
+def startWarmup():
+    # the startup phase after loadConfig(), as configured
+    if getConfig("model_warmup"):
+        warmUpModels()
+    startKeepWarm()
+    return
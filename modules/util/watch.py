@@ -0,0 +1,232 @@
+# this file holds the folder watching and the ledger of processed files
+# used by "batch.py --watch"
+
+
+import json
+import os
+import select
+import time
+
+
+from modules.file.reader import isImageFile
+from modules.util.configuration import getConfig
+from modules.util.util import printDebug, getDateTimeString
+
+
+# the ledger is a JSONL file with one entry per processed file version,
+# appended (and synced) as soon as its result is known:
+#
+#     {"file": absolute path, "mtime_ns": ..., "size": ..., "status": ...,
+#      "object": ..., "result": ..., "error": ..., "time": ...}
+#
+# the last entry of a file wins - a file is processed again when its mtime
+# or size no longer match, and failed files are retried after a restart
+__ledgerCompactRatio = 2  # lines per entry above which it is rewritten
+
+
+# inotify is only used to wake up early, the folders are always scanned
+__inotify = None  # [libc, fd], None when unavailable
+__inotifyMask = 0x8 | 0x80 | 0x100  # IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+
+##########################
+""" BEGIN WATCH LEDGER """
+##########################
+
+
+def loadLedger(ledgerPathIn):
+    # returns absolute path -> entry for the files that were processed
+    ledger = {}
+    lines = 0
+    broken = False
+    if os.path.isfile(ledgerPathIn):
+        with open(ledgerPathIn, "r") as f:
+            for line in f:
+                try:
+                    if not line.endswith("\n"):
+                        raise ValueError
+                    entry = json.loads(line)
+                except ValueError:
+                    # cut short by a crash while writing - rewritten, so the
+                    # next entry is not appended to the broken line
+                    broken = True
+                    continue
+                ledger[entry["file"]] = entry
+                lines += 1
+    failed = [k for k, v in ledger.items() if v["status"] != "ok"]
+    for filePath in failed:
+        del ledger[filePath]
+    if broken or len(failed) > 0 or (
+        lines > len(ledger) * __ledgerCompactRatio
+    ):
+        saveLedger(ledgerPathIn, ledger)
+    return ledger
+
+
+def openLedger(ledgerPathIn):
+    # for appending entries with writeLedgerEntry
+    createLedgerFolder(ledgerPathIn)
+    return open(ledgerPathIn, "a")
+
+
+def createLedgerFolder(ledgerPathIn):
+    folder = os.path.dirname(ledgerPathIn)
+    if len(folder) > 0:
+        os.makedirs(folder, exist_ok=True)
+    return
+
+
+def saveLedger(ledgerPathIn, ledgerIn):
+    createLedgerFolder(ledgerPathIn)
+    tempFilePath = ledgerPathIn + ".tmp"
+    with open(tempFilePath, "w") as f:
+        for entry in ledgerIn.values():
+            f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tempFilePath, ledgerPathIn)
+    return
+
+
+def writeLedgerEntry(ledgerFileIn, ledgerIn, statIn, recordIn):
+    # statIn is the [mtime_ns, size] the file was picked up with
+    entry = {
+        "file": os.path.abspath(recordIn["file"]),
+        "mtime_ns": statIn[0],
+        "size": statIn[1],
+        "status": recordIn["status"],
+        "object": recordIn["object"],
+        "result": recordIn["result"],
+        "error": recordIn["error"],
+        "time": getDateTimeString()
+    }
+    ledgerFileIn.write(json.dumps(entry) + "\n")
+    ledgerFileIn.flush()
+    os.fsync(ledgerFileIn.fileno())
+    ledgerIn[entry["file"]] = entry
+    return
+
+
+def isInLedger(ledgerIn, filePathIn, statIn):
+    entry = ledgerIn.get(filePathIn)
+    return entry is not None and (
+        entry["mtime_ns"] == statIn[0] and entry["size"] == statIn[1]
+    )
+
+
+############################
+""" BEGIN FOLDER WATCHING """
+############################
+
+
+def scanFolder(folderIn, filesIn, foldersIn):
+    # fills absolute path -> [mtime_ns, size] for every image file, and the
+    # list of folders, without reading any file
+    try:
+        entries = sorted(os.scandir(folderIn), key=lambda e: e.name)
+    except OSError:
+        return  # removed while scanning
+    foldersIn.append(folderIn)
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                scanFolder(entry.path, filesIn, foldersIn)
+            elif entry.is_file() and isImageFile(entry.path):
+                stat = entry.stat()
+                filesIn[entry.path] = [stat.st_mtime_ns, stat.st_size]
+        except OSError:
+            continue
+    return
+
+
+def iterateFolderChanges(foldersIn, ledgerIn):
+    # yields lists of [absolute path, [mtime_ns, size]] for the files that
+    # are not in the ledger, forever - a file is only picked up once it was
+    # left alone for watch_settle_seconds, so half-written files are skipped
+    settleNs = int(getConfig("watch_settle_seconds") * 1e9)
+    while True:
+        files = {}
+        folders = []
+        for folder in foldersIn:
+            scanFolder(os.path.abspath(folder), files, folders)
+        addInotifyWatches(folders)
+        now = time.time_ns()
+        ready = []
+        settling = []
+        for filePath, stat in files.items():
+            if isInLedger(ledgerIn, filePath, stat):
+                continue
+            if now - stat[0] >= settleNs:
+                ready.append([filePath, stat])
+            else:
+                settling.append(settleNs - (now - stat[0]))
+        if len(ready) > 0:
+            printDebug(
+                "\nFound " + str(len(ready)) + " new or changed file(s)."
+            )
+            yield ready
+            continue  # more may have arrived while these were processed
+        timeout = getConfig("watch_poll_interval")
+        if len(settling) > 0:
+            timeout = min(timeout, min(settling) / 1e9)
+        waitForChanges(timeout)
+    return
+
+
+def waitForChanges(timeoutIn):
+    if __inotify is None:
+        time.sleep(timeoutIn)
+        return
+    fd = __inotify[1]
+    readable = select.select([fd], [], [], timeoutIn)[0]
+    if len(readable) > 0:
+        time.sleep(0.05)  # let a burst of events arrive before the rescan
+        try:
+            while len(os.read(fd, 65536)) > 0:
+                continue
+        except BlockingIOError:
+            pass
+    return
+
+
+def openInotify():
+    # returns True when inotify is available (Linux), polling is used
+    # otherwise
+    global __inotify
+    if __inotify is not None:
+        return True
+    if not getConfig("watch_inotify"):
+        return False
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(
+            ctypes.util.find_library("c") or "libc.so.6",
+            use_errno=True
+        )
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return False
+    if fd < 0:
+        return False
+    __inotify = [libc, fd]
+    return True
+
+
+def addInotifyWatches(foldersIn):
+    if __inotify is None:
+        return
+    # adding a folder that is already watched only updates its mask, so
+    # folders created (or recreated) since the last scan are picked up too
+    libc, fd = __inotify
+    for folder in foldersIn:
+        libc.inotify_add_watch(fd, os.fsencode(folder), __inotifyMask)
+    return
+
+
+def closeInotify():
+    global __inotify
+    if __inotify is not None:
+        os.close(__inotify[1])
+        __inotify = None
+    return
@@ -0,0 +1,108 @@
+import argparse
+import datetime
+import json
+import sys
+
+
+from modules.util.store import loadResultColumns, getResultMask
+from modules.util.store import getResultAggregates
+
+
+EXIT_SUCCESS = 0
+EXIT_USAGE = 2
+
+
+def getArguments():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Per-object mean and median size/weight of the results in the "
+            "columnar store (output/results/)."
+        )
+    )
+    parser.add_argument(
+        "-o", "--object",
+        help="only objects whose name contains this text"
+    )
+    parser.add_argument("--min-weight", type=float, help="grams")
+    parser.add_argument("--max-weight", type=float, help="grams")
+    parser.add_argument(
+        "-s", "--since",
+        help="only results from this date/time on (YYYY-MM-DD[ HH:MM])"
+    )
+    parser.add_argument(
+        "-f", "--fresh",
+        action="store_true",
+        help="leave out results reused from the caches"
+    )
+    parser.add_argument(
+        "-j", "--json",
+        action="store_true",
+        help="print the aggregates as JSON"
+    )
+    return parser.parse_args()
+
+
+def printAggregates(aggregatesIn, rowsIn):
+    print(
+        f"{'object':<32} {'count':>7} "
+        f"{'length':>15} {'width':>15} {'height':>15} {'weight g':>19}"
+    )
+    print(
+        f"{'':<32} {'':>7} "
+        + f"{'mean / median':>15} " * 3
+        + f"{'mean / median':>19}"
+    )
+    for objectName, aggregate in aggregatesIn.items():
+        print(
+            f"{objectName[0:32]:<32} {aggregate['count']:>7} "
+            "" + " ".join(
+                formatMeanMedian(aggregate, name, 15)
+                for name in ["length", "width", "height"]
+            ) + " " + formatMeanMedian(aggregate, "weight", 19)
+        )
+    print(
+        "\n" + str(sum(a["count"] for a in aggregatesIn.values())) + " of "
+        "" + str(rowsIn) + " result(s), " + str(len(aggregatesIn)) + " "
+        "object(s)"
+    )
+    return
+
+
+def formatMeanMedian(aggregateIn, nameIn, widthIn):
+    text = (
+        f"{aggregateIn['mean'][nameIn]:0.1f} / "
+        f"{aggregateIn['median'][nameIn]:0.1f}"
+    )
+    return f"{text:>{widthIn}}"
+
+
+def main():
+    arguments = getArguments()
+    since = None
+    if arguments.since is not None:
+        try:
+            since = datetime.datetime.fromisoformat(arguments.since)
+        except ValueError:
+            print("Invalid date: " + arguments.since, file=sys.stderr)
+            return EXIT_USAGE
+        since = since.timestamp()
+    columns, objects = loadResultColumns()
+    mask = getResultMask(
+        columns,
+        objects,
+        objectIn=arguments.object,
+        minWeightIn=arguments.min_weight,
+        maxWeightIn=arguments.max_weight,
+        sinceIn=since,
+        freshOnlyIn=arguments.fresh
+    )
+    aggregates = getResultAggregates(columns, objects, mask)
+    if arguments.json:
+        print(json.dumps(aggregates, indent=4))
+    else:
+        printAggregates(aggregates, len(columns["object"]))
+    return EXIT_SUCCESS
+
+
+if __name__ == "__main__":
+    sys.exit(main())
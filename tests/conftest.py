@@ -0,0 +1,33 @@
+# the tests run against the configuration in config/, from the repository
+# root so the relative paths in modules/util/strings/paths.py resolve, and
+# with everything that would write to output/ turned off
+
+
+import os
+import sys
+
+
+import pytest
+
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_PATH)
+
+
+from modules.util.configuration import loadConfiguration  # noqa: E402
+from modules.util.configuration import loadModelConfiguration  # noqa: E402
+from modules.util.configuration import setConfig  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def configuration(monkeypatch):
+    monkeypatch.chdir(ROOT_PATH)
+    loadModelConfiguration()
+    loadConfiguration()
+    setConfig("debug_level", 0)
+    setConfig("result_cache_enabled", False)
+    setConfig("object_cache_enabled", False)
+    setConfig("result_store_enabled", False)
+    setConfig("span_tracing", False)
+    yield
+    return
@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+
+
+import pytest
+
+
+from modules.util import backend
+from modules.util.backend import sendBackendRequest
+from modules.util.configuration import setConfig
+from modules.util.strings.endpoints import TEXT_ENDPOINT
+
+
+__addresses = ["http://a:8080/v1", "http://b:8080/v1"]
+
+
+@pytest.fixture(autouse=True)
+def servers():
+    setConfig("addresses", __addresses)
+    setConfig("request_deadline", 10)
+    return
+
+
+def failWith(monkeypatch, errorsIn):
+    # the first len(errorsIn) sends raise the given errors, later ones
+    # answer 200 - returns the [url, deadline] of every send
+    sends = []
+
+    def sendRequest(urlIn, deadlineIn=None, **kwargs):
+        sends.append([urlIn, deadlineIn])
+        if len(sends) <= len(errorsIn):
+            raise errorsIn[len(sends) - 1]
+        return SimpleNamespace(status_code=200, close=lambda: None)
+
+    monkeypatch.setattr(backend, "sendRequest", sendRequest)
+    return sends
+
+
+def testFailoverSharesOneDeadline(monkeypatch):
+    sends = failWith(monkeypatch, [ConnectionError("refused")])
+    response = sendBackendRequest(TEXT_ENDPOINT, dataIn={})
+    assert response.status_code == 200
+    assert len(sends) == 2 and sends[0][0] != sends[1][0]
+    assert sends[0][1] is not None and sends[0][1] == sends[1][1]
+    return
+
+
+def testNoFailoverOnceTheDeadlinePassed(monkeypatch):
+    sends = failWith(monkeypatch, [TimeoutError("Request deadline exceeded")])
+    with pytest.raises(TimeoutError):
+        sendBackendRequest(TEXT_ENDPOINT, dataIn={})
+    assert len(sends) == 1
+    return
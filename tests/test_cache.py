@@ -0,0 +1,58 @@
+import pytest
+
+
+from modules.util.cache import getCacheKey
+from modules.util.configuration import setConfig
+from modules.util.pipeline import getImageToTextCacheKey
+from modules.util.pipeline import getImageToTextContextKey
+
+
+def testCacheKeyIsStable():
+    assert getCacheKey(["a", b"b"]) == getCacheKey(["a", b"b"])
+    assert getCacheKey(["a"]) == getCacheKey([b"a"])
+    return
+
+
+def testCacheKeyPartsAreSeparated():
+    assert getCacheKey(["ab", "c"]) != getCacheKey(["a", "bc"])
+    assert getCacheKey(["a", ""]) != getCacheKey(["a"])
+    return
+
+
+def testImageCacheKeyDependsOnImageAndPrompt():
+    key = getImageToTextCacheKey("", b"image", "two_stage")
+    assert key != getImageToTextCacheKey("", b"other image", "two_stage")
+    assert key != getImageToTextCacheKey("prompt", b"image", "two_stage")
+    assert key != getImageToTextCacheKey("", b"image", "fused")
+    return
+
+
+def testImageCacheKeyDependsOnModel():
+    key = getImageToTextCacheKey("", b"image", "two_stage")
+    setConfig("default_image_to_text_model", "image_to_text_llava-34b")
+    assert key != getImageToTextCacheKey("", b"image", "two_stage")
+    return
+
+
+@pytest.mark.parametrize("mode", ["two_stage", "fused"])
+@pytest.mark.parametrize("name, value", [
+    ["image_codec", "webp"],
+    ["image_quality", 50],
+    ["image_max_long_edge", 512],
+    ["image_max_pixels", 1000],
+    ["image_target_bytes", 1000],
+    ["image_resample_filter", "nearest"]
+])
+def testContextKeyDependsOnImagePolicy(mode, name, value):
+    key = getImageToTextContextKey("", mode)
+    setConfig(name, value)
+    assert key != getImageToTextContextKey("", mode)
+    return
+
+
+def testContextKeyIgnoresEquivalentCodecNames():
+    setConfig("image_codec", "jpeg")
+    key = getImageToTextContextKey("", "two_stage")
+    setConfig("image_codec", "JPG")
+    assert key == getImageToTextContextKey("", "two_stage")
+    return
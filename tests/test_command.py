@@ -0,0 +1,56 @@
+import json
+
+
+import pytest
+
+
+from modules.util import command, configuration
+from modules.util.configuration import setConfig, getConfig
+from modules.util.strings.paths import CONFIGS_FILE_NAME
+
+
+def setPipelineModeInFile(monkeypatch, modeIn):
+    # config.json as read from now on, with pipeline_mode set to modeIn
+    readFile = configuration.readFile
+
+    def readConfigFile(fileNameIn, splitterIn):
+        contents = readFile(fileNameIn, splitterIn)
+        if fileNameIn.endswith(CONFIGS_FILE_NAME):
+            contents = json.loads(contents)
+            contents["pipeline_mode"] = modeIn
+            contents = json.dumps(contents)
+        return contents
+
+    monkeypatch.setattr(configuration, "readFile", readConfigFile)
+    return
+
+
+def testUnknownPipelineModeIsRejected(monkeypatch):
+    setPipelineModeInFile(monkeypatch, "fussed")
+    setConfig("pipeline_mode", "fused")
+    with pytest.raises(ValueError, match="fussed"):
+        command.loadConfig()
+    # nothing of the bad file was applied
+    assert getConfig("pipeline_mode") == "fused"
+    assert getConfig("debug_level") == 0
+    return
+
+
+def testReloadKeepsConfigurationOnError(monkeypatch):
+    setPipelineModeInFile(monkeypatch, "fussed")
+    setConfig("pipeline_mode", "fused")
+    errors = []
+    monkeypatch.setattr(command, "printError", errors.append)
+    command.submenuConfigReload()
+    assert len(errors) == 1 and "fussed" in errors[0]
+    assert getConfig("pipeline_mode") == "fused"
+    return
+
+
+def testReloadAppliesValidConfiguration(monkeypatch):
+    setPipelineModeInFile(monkeypatch, "fused")
+    setConfig("pipeline_mode", "two_stage")
+    monkeypatch.setattr(command, "invalidateModelCatalog", lambda: None)
+    command.submenuConfigReload()
+    assert getConfig("pipeline_mode") == "fused"
+    return
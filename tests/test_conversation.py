@@ -0,0 +1,248 @@
+import json
+import os
+import random
+
+
+import pytest
+
+
+from modules.util import conversation
+from modules.util.conversation import writeConversation, setConversation
+from modules.util.conversation import getConversationTurns
+from modules.util.conversation import getConversationTurn
+from modules.util.conversation import getConversationTurnCount
+from modules.util.conversation import getConversationFilePath
+from modules.util.conversation import getConversationIndexFilePath
+from modules.util.conversation import getConversationCatalog
+from modules.util.conversation import searchConversations
+from modules.util.conversation import deleteEmptyConversations
+
+
+__roles = ["SYSTEM", "USER", "ASSISTANT"]
+
+
+@pytest.fixture(autouse=True)
+def conversations(monkeypatch, tmp_path):
+    folderPath = str(tmp_path) + "/"
+    monkeypatch.setattr(conversation, "CONVERSATIONS_FILE_PATH", folderPath)
+    monkeypatch.setattr(
+        conversation,
+        "CONVERSATIONS_CATALOG_FILE_PATH",
+        folderPath + "catalog.json"
+    )
+    monkeypatch.setattr(conversation, "__catalog", None)
+    monkeypatch.setattr(conversation, "__catalogDirty", False)
+    return folderPath
+
+
+def parseTurns(textIn):
+    # the reference - [role, lines] of every turn from a full parse
+    turns = []
+    for line in textIn.split("\n")[0:-1]:
+        role = line.split(": ", 1)[0] if ": " in line else None
+        if role in __roles:
+            turns.append([role, [line]])
+        elif len(turns) == 0:
+            turns.append([None, [line]])
+        else:
+            turns[-1][1].append(line)
+    return turns
+
+
+def readTurns(convoNameIn):
+    with open(
+        getConversationFilePath(convoNameIn),
+        "r",
+        encoding="utf-8",
+        errors="replace"
+    ) as f:
+        return parseTurns(f.read())
+
+
+def writeTurns(convoNameIn, countIn, seedIn):
+    generator = random.Random(seedIn)
+    for i in range(countIn):
+        lines = [
+            "line " + str(i) + "." + str(j) + " " + "é" * generator.randint(
+                0,
+                3
+            )
+            for j in range(generator.randint(0, 3))
+        ]
+        writeConversation(
+            convoNameIn,
+            "\n".join([generator.choice(__roles) + ": turn " + str(i)] + lines)
+        )
+    return
+
+
+def assertMatchesFullParse(convoNameIn):
+    turns = readTurns(convoNameIn)
+    count = len(turns)
+    assert getConversationTurnCount(convoNameIn) == count
+    for start in range(-count - 1, count + 1):
+        for end in [None] + list(range(-count - 1, count + 1)):
+            assert getConversationTurns(convoNameIn, start, end) == [
+                line for role, lines in turns[start:end] for line in lines
+            ]
+    for i in range(-count, count):
+        assert getConversationTurn(convoNameIn, i) == turns[i]
+    assert getConversationTurn(convoNameIn, count) is None
+    return
+
+
+def testTurnsMatchFullParse():
+    writeTurns("talk", 12, 1)
+    assertMatchesFullParse("talk")
+    assert getConversationTurns("talk", -3) == [
+        line for role, lines in readTurns("talk")[-3:] for line in lines
+    ]
+    return
+
+
+def testTextBeforeTheFirstRoleIsATurn():
+    writeConversation("talk", "no role here\nstill none")
+    writeTurns("talk", 2, 2)
+    assert getConversationTurn("talk", 0) == [
+        None,
+        ["no role here", "still none"]
+    ]
+    assertMatchesFullParse("talk")
+    return
+
+
+def testIndexFollowsAppends():
+    writeTurns("talk", 3, 3)
+    assertMatchesFullParse("talk")
+    with open(getConversationFilePath("talk"), "a") as f:
+        f.write("USER: written elsewhere\nmore\n")
+    assertMatchesFullParse("talk")
+    return
+
+
+def testIndexRebuiltAfterEdit():
+    writeTurns("talk", 8, 4)
+    assertMatchesFullParse("talk")
+    with open(getConversationFilePath("talk"), "w") as f:
+        f.write("ASSISTANT: rewritten\nUSER: shorter\n")
+    assertMatchesFullParse("talk")
+    assert getConversationTurnCount("talk") == 2
+    return
+
+
+def testIndexRebuiltAfterTruncation():
+    writeTurns("talk", 8, 5)
+    convoPath = getConversationFilePath("talk")
+    with open(convoPath, "r+b") as f:
+        f.truncate(os.path.getsize(convoPath) // 2)
+    # the cut-off last line only counts once it is complete
+    with open(convoPath, "a") as f:
+        f.write("\n")
+    assertMatchesFullParse("talk")
+    return
+
+
+@pytest.mark.parametrize("cutBytes", [1, 5, 9])
+def testIndexTruncatedMidRecord(cutBytes):
+    writeTurns("talk", 6, 6)
+    indexPath = getConversationIndexFilePath("talk")
+    with open(indexPath, "r+b") as f:
+        f.truncate(os.path.getsize(indexPath) - cutBytes)
+    assertMatchesFullParse("talk")
+    return
+
+
+def testIndexWithUnknownHeader():
+    writeTurns("talk", 4, 7)
+    with open(getConversationIndexFilePath("talk"), "r+b") as f:
+        f.write(b"XXXX")
+    assertMatchesFullParse("talk")
+    return
+
+
+def testRecordsPastTheHeaderAreDropped():
+    # an update interrupted before its header was written
+    writeTurns("talk", 4, 8)
+    with open(getConversationIndexFilePath("talk"), "ab") as f:
+        f.write(b"\xff" * 13)
+    assertMatchesFullParse("talk")
+    return
+
+
+def testCatalogUpdatedOnWrite(conversations):
+    writeConversation("talk", "USER: hello\nthere")
+    entry = getConversationCatalog()["talk"]
+    assert entry["turns"] == 1 and entry["preview"] == "USER: hello there"
+    assert not entry["empty"]
+    writeConversation("talk", "ASSISTANT: hi")
+    entry = conversation.__catalog["talk"]  # updated without a scan
+    assert entry["turns"] == 2 and entry["preview"] == "ASSISTANT: hi"
+    assert entry["size"] == os.path.getsize(getConversationFilePath("talk"))
+    getConversationCatalog()
+    with open(conversations + "catalog.json") as f:
+        assert json.load(f)["talk"] == entry
+    return
+
+
+def testCatalogScanOnlyRereadsChangedFiles(monkeypatch):
+    writeTurns("talk", 3, 9)
+    writeTurns("other", 2, 10)
+    getConversationCatalog()
+    # a fresh start reads catalog.json instead of the files
+    monkeypatch.setattr(conversation, "__catalog", None)
+    updates = []
+    updateCatalogEntry = conversation.updateCatalogEntry
+
+    def recordUpdate(convoNameIn, turnsIn):
+        updates.append(convoNameIn)
+        return updateCatalogEntry(convoNameIn, turnsIn)
+
+    monkeypatch.setattr(conversation, "updateCatalogEntry", recordUpdate)
+    getConversationCatalog()
+    assert updates == []
+    with open(getConversationFilePath("talk"), "a") as f:
+        f.write("USER: written elsewhere\n")
+    catalog = getConversationCatalog()
+    assert updates == ["talk"]
+    assert catalog["talk"]["turns"] == 4
+    assert catalog["talk"]["preview"] == "USER: written elsewhere"
+    assert catalog["other"]["turns"] == 2
+    return
+
+
+def testCatalogFollowsFilesAddedAndRemoved():
+    writeTurns("talk", 2, 11)
+    getConversationCatalog()
+    with open(getConversationFilePath("added"), "w") as f:
+        f.write("USER: new\n")
+    os.remove(getConversationFilePath("talk"))
+    catalog = getConversationCatalog()
+    assert list(catalog) == ["added"]
+    assert catalog["added"]["turns"] == 1
+    return
+
+
+def testDeleteEmptyConversations():
+    setConversation("blank")  # an empty file
+    with open(getConversationFilePath("spaces"), "w") as f:
+        f.write("  \n\n")
+    writeConversation("norole", "just text")
+    writeTurns("talk", 2, 12)
+    assert sorted(deleteEmptyConversations()) == ["blank", "spaces"]
+    assert sorted(getConversationCatalog()) == ["norole", "talk"]
+    assert not os.path.exists(getConversationFilePath("blank"))
+    assert not os.path.exists(getConversationIndexFilePath("spaces"))
+    return
+
+
+def testSearchConversations():
+    for convoName in ["apple", "apple pie", "pineapple", "pear"]:
+        writeConversation(convoName, "USER: " + convoName)
+    assert searchConversations("apple")[0] == "apple"
+    assert sorted(searchConversations("apple")) == [
+        "apple",
+        "apple pie",
+        "pineapple"
+    ]
+    assert searchConversations("plum") == []
+    return
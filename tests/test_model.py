@@ -0,0 +1,134 @@
+import pytest
+
+
+from modules.util.configuration import resetModelConfig, setModelConfig
+from modules.util.model import getModelByNameAndType, getModelsWithType
+from modules.util.util import getStringMatchPercentage
+
+
+__models = {
+    "image_to_text_llava-13b": "image_to_text",
+    "image_to_text_llava-34b": "image_to_text",
+    "image_to_text_bakllava": "image_to_text",
+    "ab": "image_to_text",
+    "text_to_text_nous-13b": "text_to_text",
+    "text_to_text_mistral-7b": "text_to_text",
+    "text_to_text_mistral-7b-instruct": "text_to_text",
+    "LLaVA-Upper": "image_to_text"
+}
+
+
+@pytest.fixture(autouse=True)
+def models():
+    resetModelConfig()
+    for name, modelType in __models.items():
+        setModelConfig(name, {"model_type": modelType})
+    yield
+    return
+
+
+def getReferenceMatch(nameIn, typeIn):
+    # the lookup before the index: every model of the type is scored, the
+    # first of the best scores wins
+    name = nameIn.lower()
+    parts = name.split(" ")
+    best = None
+    bestScore = -1.0
+    for model, modelType in __models.items():
+        m = model.lower()
+        if modelType != typeIn:
+            continue
+        if len(parts) > 1:
+            if not all(part in m for part in parts):
+                continue
+        elif name not in m and m not in name:
+            continue
+        score = getStringMatchPercentage(m, name)
+        if score > bestScore:
+            best = model
+            bestScore = score
+    return best
+
+
+@pytest.mark.parametrize("name, modelType", [
+    ["image_to_text_llava-13b", "image_to_text"],
+    ["IMAGE_TO_TEXT_LLAVA-13B", "image_to_text"],
+    ["llava", "image_to_text"],
+    ["llava-34", "image_to_text"],
+    ["llava 34b", "image_to_text"],
+    ["bakllava", "image_to_text"],
+    ["13b", "image_to_text"],
+    ["13b", "text_to_text"],
+    ["mistral", "text_to_text"],
+    ["mistral 7b instruct", "text_to_text"],
+    ["text_to_text_mistral-7b-instruct-v2", "text_to_text"],
+    ["ab", "image_to_text"],
+    ["a", "image_to_text"],
+    ["b", "text_to_text"],
+    ["upper", "image_to_text"],
+    ["nous", "image_to_text"],
+    ["zzz", "text_to_text"],
+    ["x y", "text_to_text"]
+])
+def testFuzzyLookupMatchesFullScan(name, modelType):
+    assert getModelByNameAndType(
+        name,
+        modelType,
+        True,
+        False,
+        True
+    ) == getReferenceMatch(name, modelType)
+    return
+
+
+def testStrictLookupOnlyTakesExactNames():
+    assert getModelByNameAndType(
+        "Image_To_Text_LLaVA-13b",
+        "image_to_text",
+        True,
+        True,
+        True
+    ) == "image_to_text_llava-13b"
+    assert getModelByNameAndType(
+        "llava",
+        "image_to_text",
+        True,
+        True,
+        True
+    ) is None
+    return
+
+
+def testLookupReturnsModelData():
+    assert getModelByNameAndType(
+        "nous",
+        "text_to_text",
+        False,
+        False,
+        True
+    ) == {"text_to_text_nous-13b": {"model_type": "text_to_text"}}
+    return
+
+
+def testIndexFollowsConfigurationChanges():
+    setModelConfig("image_to_text_moondream", {"model_type": "image_to_text"})
+    assert getModelByNameAndType(
+        "moondream",
+        "image_to_text",
+        True,
+        False,
+        True
+    ) == "image_to_text_moondream"
+    return
+
+
+def testModelsWithTypeIsACopy():
+    models = getModelsWithType("text_to_text")
+    assert list(models) == [
+        "text_to_text_nous-13b",
+        "text_to_text_mistral-7b",
+        "text_to_text_mistral-7b-instruct"
+    ]
+    models.clear()
+    assert len(getModelsWithType("text_to_text")) == 3
+    return
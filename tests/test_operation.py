@@ -0,0 +1,28 @@
+import os
+
+
+from modules.file.operation import getPathTree, iteratePathTree
+
+
+def testIteratePathTreeMatchesGetPathTree(tmp_path):
+    for filePath in [
+        "a.png",
+        ".hidden.png",
+        "sub/b.jpg",
+        "sub/.c.jpg",
+        ".git/d.png",
+        "sub/deeper/e.txt",
+        "sub/.cache/f.png"
+    ]:
+        os.makedirs(os.path.dirname(tmp_path / filePath), exist_ok=True)
+        (tmp_path / filePath).write_bytes(b"")
+    os.makedirs(tmp_path / "empty")
+    os.symlink(tmp_path / "missing.png", tmp_path / "broken.png")
+    files = list(iteratePathTree(str(tmp_path)))
+    assert sorted(files) == sorted(getPathTree(str(tmp_path)))
+    assert [os.path.relpath(f, tmp_path) for f in files] == [
+        "a.png",
+        "sub/b.jpg",
+        "sub/deeper/e.txt"
+    ]
+    return
@@ -0,0 +1,130 @@
+import pytest
+
+
+from modules.util import pipeline
+from modules.util.configuration import setConfig
+from modules.util.pipeline import normalizeObjectName, newImageToTextRecord
+from modules.util.pipeline import estimateObjectSize
+
+
+__estimate = "Size: 8.0cm by 8.0cm by 7.5cm, weight: 180g"
+
+
+def newRecord(filePathIn, objectIn):
+    # a record as stage 1 leaves it
+    record = newImageToTextRecord(filePathIn)
+    record["object"] = objectIn
+    record["cacheKey"] = filePathIn
+    return record
+
+
+@pytest.mark.parametrize("objectName, normalized", [
+    ["apple", "apple"],
+    ["A_Red  Apples", "red apple"],
+    ["the_cherries", "cherry"],
+    ["some boxes", "box"],
+    ["glasses", "glass"],
+    ["a", "a"],
+    ["bus", "bus"],
+    ["cactus", "cactus"],
+    ["", ""],
+    ["  _ ", ""]
+])
+def testNormalizeObjectName(objectName, normalized):
+    assert normalizeObjectName(objectName) == normalized
+    return
+
+
+def testEstimatesAreMemoizedByNormalizedName(monkeypatch):
+    memo = {}
+    requests = []
+    mockEstimates(monkeypatch, memo, requests)
+    for objectName in ["Red_Apples", "a red apple"]:
+        record = newRecord("apple.png", objectName)
+        estimateObjectSize(record)
+        assert record["result"] == __estimate
+    assert len(requests) == 1
+    assert len(memo) == 1
+    return
+
+
+def testEmptyObjectNameIsNotMemoized(monkeypatch):
+    memo = {}
+    requests = []
+    mockEstimates(monkeypatch, memo, requests)
+    for i in range(2):
+        estimateObjectSize(newRecord("unknown.png", ""))
+    assert len(requests) == 2
+    assert len(memo) == 0
+    return
+
+
+def mockEstimates(monkeypatch, memoIn, requestsIn):
+    # object_estimate cache in memoIn, the server requests in requestsIn
+    setConfig("object_cache_enabled", True)
+
+    def getCachedResult(namespaceIn, keyIn):
+        if namespaceIn == "object_estimate":
+            return memoIn.get(keyIn)
+        return None
+
+    def setCachedResult(namespaceIn, keyIn, resultIn):
+        if namespaceIn == "object_estimate":
+            memoIn[keyIn] = resultIn
+        return
+
+    def sendChatCompletion(dataIn):
+        requestsIn.append(dataIn)
+        return {"choices": [{"message": {"content": __estimate}}]}
+
+    monkeypatch.setattr(pipeline, "getCachedResult", getCachedResult)
+    monkeypatch.setattr(pipeline, "setCachedResult", setCachedResult)
+    monkeypatch.setattr(pipeline, "sendChatCompletion", sendChatCompletion)
+    return
+
+
+def identifyFused(monkeypatch, tmp_path, responseIn):
+    # stage 1 in fused mode on a tiny image, the server answering responseIn
+    from PIL import Image
+    filePath = str(tmp_path / "apple.png")
+    Image.new("RGB", [8, 8], "red").save(filePath)
+    setConfig("default_image_to_text_model", "image_to_text_model")
+    requests = []
+
+    def sendChatCompletion(dataIn):
+        requests.append(dataIn)
+        return {"choices": [{"message": {"content": responseIn}}]}
+
+    monkeypatch.setattr(pipeline, "sendChatCompletion", sendChatCompletion)
+    record = pipeline.identifyImageSubject(
+        "",
+        newImageToTextRecord(filePath, "fused")
+    )
+    assert len(requests) == 1
+    return record
+
+
+def testFusedResponseIsSplit(monkeypatch, tmp_path):
+    record = identifyFused(
+        monkeypatch,
+        tmp_path,
+        "The single main subject in the given image is red apple. "
+        "" + __estimate
+    )
+    assert record["error"] is None
+    assert record["object"] == "red_apple"
+    assert record["result"] == __estimate
+    return
+
+
+def testFusedResponseWithoutSize(monkeypatch, tmp_path):
+    record = identifyFused(
+        monkeypatch,
+        tmp_path,
+        "The single main subject in the given image is red apple."
+    )
+    assert record["object"] == "red_apple"
+    assert record["result"] is None
+    assert record["error"] == "No size/weight in the image response!"
+    return
+
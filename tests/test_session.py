@@ -0,0 +1,353 @@
+import threading
+import time
+
+
+from types import SimpleNamespace
+
+
+import pytest
+
+
+from modules.util import session
+from modules.util.configuration import setConfig
+from modules.util.session import sendRequest, isCircuitOpen, checkCircuit
+from modules.util.session import getLatencyKey, getHedgeDelay, addLatency
+from modules.util.session import resetSessions, untimedRequests
+from modules.util.session import getRetryDelay, getRequestStats
+from modules.util.session import getRequestDeadline
+
+
+__url = "http://127.0.0.1:1/v1/chat/completions"
+__cooldown = 0.05
+
+
+@pytest.fixture(autouse=True)
+def circuits(monkeypatch):
+    # two failures in a row open the circuit, no retries or hedging, and
+    # the attempts are answered by the test instead of a server
+    setConfig("circuit_breaker_failures", 2)
+    setConfig("circuit_breaker_cooldown", __cooldown)
+    setConfig("request_retries", 0)
+    setConfig("request_deadline", None)
+    setConfig("request_hedging", False)
+    resetSessions()
+    yield
+    resetSessions()
+    return
+
+
+def answerAttempts(monkeypatchIn, answerIn):
+    # answerIn is a status code, or an exception to raise - or a list of
+    # those answering the attempts in turn, the last one repeated
+    attempts = []
+    answers = answerIn if isinstance(answerIn, list) else [answerIn]
+
+    def sendAttempt(urlIn, dataIn, fileIn, streamIn, deadlineIn):
+        attempts.append(urlIn)
+        answer = answers[min(len(attempts), len(answers)) - 1]
+        if isinstance(answer, BaseException):
+            raise answer
+        return SimpleNamespace(status_code=answer, close=lambda: None)
+
+    monkeypatchIn.setattr(session, "sendAttempt", sendAttempt)
+    return attempts
+
+
+def openCircuit(monkeypatchIn):
+    answerAttempts(monkeypatchIn, ConnectionError("refused"))
+    for i in range(2):
+        with pytest.raises(ConnectionError):
+            sendRequest(__url)
+    return
+
+
+def testCircuitOpensAfterFailuresInARow(monkeypatch):
+    answerAttempts(monkeypatch, ConnectionError("refused"))
+    with pytest.raises(ConnectionError):
+        sendRequest(__url)
+    assert not isCircuitOpen(__url)
+    answerAttempts(monkeypatch, 200)
+    sendRequest(__url)  # resets the failures in a row
+    openCircuit(monkeypatch)
+    assert isCircuitOpen(__url)
+    return
+
+
+def testServerErrorsCountAsFailures(monkeypatch):
+    answerAttempts(monkeypatch, 503)
+    for i in range(2):
+        assert sendRequest(__url).status_code == 503
+    assert isCircuitOpen(__url)
+    return
+
+
+def testOpenCircuitRejectsWithoutSending(monkeypatch):
+    openCircuit(monkeypatch)
+    attempts = answerAttempts(monkeypatch, 200)
+    with pytest.raises(ConnectionError):
+        sendRequest(__url)
+    assert len(attempts) == 0
+    return
+
+
+def testHalfOpenLetsOneTrialThrough(monkeypatch):
+    openCircuit(monkeypatch)
+    time.sleep(__cooldown * 1.5)
+    assert checkCircuit("http://127.0.0.1:1")
+    assert isCircuitOpen(__url)
+    with pytest.raises(ConnectionError):
+        checkCircuit("http://127.0.0.1:1")  # the trial is still running
+    return
+
+
+def testSuccessfulTrialClosesCircuit(monkeypatch):
+    openCircuit(monkeypatch)
+    time.sleep(__cooldown * 1.5)
+    answerAttempts(monkeypatch, 200)
+    sendRequest(__url)
+    assert not isCircuitOpen(__url)
+    answerAttempts(monkeypatch, ConnectionError("refused"))
+    with pytest.raises(ConnectionError):
+        sendRequest(__url)
+    assert not isCircuitOpen(__url)  # one failure in a row again
+    return
+
+
+def testFailedTrialReopensCircuit(monkeypatch):
+    openCircuit(monkeypatch)
+    time.sleep(__cooldown * 1.5)
+    with pytest.raises(ConnectionError):
+        sendRequest(__url)
+    assert isCircuitOpen(__url)
+    attempts = answerAttempts(monkeypatch, 200)
+    with pytest.raises(ConnectionError):
+        sendRequest(__url)
+    assert len(attempts) == 0
+    return
+
+
+def testTrialEndsOnAnyError(monkeypatch):
+    openCircuit(monkeypatch)
+    time.sleep(__cooldown * 1.5)
+    answerAttempts(monkeypatch, ValueError("cannot decode"))
+    with pytest.raises(ValueError):
+        sendRequest(__url)
+    assert not isCircuitOpen(__url)
+    answerAttempts(monkeypatch, 200)
+    sendRequest(__url)
+    assert not isCircuitOpen(__url)
+    return
+
+
+def testCircuitThresholdZeroNeverOpens(monkeypatch):
+    setConfig("circuit_breaker_failures", 0)
+    answerAttempts(monkeypatch, ConnectionError("refused"))
+    for i in range(5):
+        with pytest.raises(ConnectionError):
+            sendRequest(__url)
+    assert not isCircuitOpen(__url)
+    return
+
+
+def testLatencyKeyIncludesModel():
+    llava = getLatencyKey(__url, {"model": "image_to_text_llava-13b"})
+    nous = getLatencyKey(__url, {"model": "text_to_text_nous-13b"})
+    assert llava != nous
+    assert getLatencyKey(__url, None) == getLatencyKey(__url, {})
+    return
+
+
+def testHedgeDelayIsPerModel():
+    setConfig("request_hedging_min_samples", 10)
+    llava = getLatencyKey(__url, {"model": "image_to_text_llava-13b"})
+    nous = getLatencyKey(__url, {"model": "text_to_text_nous-13b"})
+    for i in range(100):
+        addLatency(llava, 1.0 + i / 100)
+        addLatency(nous, 0.1)
+    assert getHedgeDelay(llava) == pytest.approx(1.95)
+    assert getHedgeDelay(nous) == pytest.approx(0.1)
+    return
+
+
+@pytest.mark.parametrize("deadline", [None, 10])
+def testUntimedRequestsAreNotRecorded(monkeypatch, deadline):
+    # with a deadline the attempts are sent from worker threads
+    latencies = []
+    setConfig("request_deadline", deadline)
+    monkeypatch.setattr(session, "getSession", lambda urlIn: SimpleNamespace(
+        post=lambda *args, **kwargs: SimpleNamespace(status_code=200)
+    ))
+    monkeypatch.setattr(
+        session,
+        "addLatency",
+        lambda keyIn, secondsIn: latencies.append(keyIn)
+    )
+    dataIn = {"model": "text_to_text_nous-13b"}
+    with untimedRequests():
+        sendRequest(__url, dataIn=dataIn)
+    assert len(latencies) == 0
+    sendRequest(__url, dataIn=dataIn)
+    assert latencies == [getLatencyKey(__url, dataIn)]
+    return
+
+
+def recordSleeps(monkeypatchIn):
+    sleeps = []
+    monkeypatchIn.setattr(session.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def testRetriesUntilSuccess(monkeypatch):
+    setConfig("circuit_breaker_failures", 0)
+    setConfig("request_retries", 2)
+    sleeps = recordSleeps(monkeypatch)
+    attempts = answerAttempts(
+        monkeypatch,
+        [503, ConnectionError("reset"), 200]
+    )
+    assert sendRequest(__url).status_code == 200
+    assert len(attempts) == 3 and len(sleeps) == 2
+    return
+
+
+def testLastServerErrorIsReturned(monkeypatch):
+    setConfig("circuit_breaker_failures", 0)
+    setConfig("request_retries", 2)
+    recordSleeps(monkeypatch)
+    attempts = answerAttempts(monkeypatch, 502)
+    assert sendRequest(__url).status_code == 502
+    assert len(attempts) == 3
+    return
+
+
+def testUploadsAreNotRetried(monkeypatch):
+    setConfig("circuit_breaker_failures", 0)
+    setConfig("request_retries", 2)
+    attempts = answerAttempts(monkeypatch, ConnectionError("reset"))
+    with pytest.raises(ConnectionError):
+        sendRequest(__url, fileIn={"file": b""})
+    assert len(attempts) == 1
+    return
+
+
+def testRetryBackoffDoublesUpToMax(monkeypatch):
+    setConfig("request_retry_backoff", 0.5)
+    setConfig("request_retry_backoff_max", 3)
+    # the upper end of the full jitter
+    monkeypatch.setattr(session.random, "uniform", lambda a, b: b)
+    assert [getRetryDelay(i) for i in range(4)] == [0.5, 1.0, 2.0, 3.0]
+    monkeypatch.setattr(session.random, "uniform", lambda a, b: a)
+    assert getRetryDelay(3) == 0
+    return
+
+
+def testDeadlineStopsSlowAttempt(monkeypatch):
+    setConfig("request_deadline", 0.1)
+    release = threading.Event()
+
+    def sendAttempt(urlIn, dataIn, fileIn, streamIn, deadlineIn):
+        release.wait(5)
+        return SimpleNamespace(status_code=200, close=lambda: None)
+
+    monkeypatch.setattr(session, "sendAttempt", sendAttempt)
+    deadlinesExceeded = getRequestStats()["deadlinesExceeded"]
+    timeStart = time.monotonic()
+    try:
+        with pytest.raises(TimeoutError):
+            sendRequest(__url, dataIn={})
+    finally:
+        release.set()
+    assert time.monotonic() - timeStart < 1
+    assert getRequestStats()["deadlinesExceeded"] == deadlinesExceeded + 1
+    return
+
+
+def testNoRetryPastTheDeadline(monkeypatch):
+    setConfig("circuit_breaker_failures", 0)
+    setConfig("request_retries", 2)
+    setConfig("request_deadline", 0.5)
+    setConfig("request_retry_backoff", 10)
+    setConfig("request_retry_backoff_max", 10)
+    monkeypatch.setattr(session.random, "uniform", lambda a, b: b)
+    sleeps = recordSleeps(monkeypatch)
+    attempts = answerAttempts(monkeypatch, ConnectionError("reset"))
+    with pytest.raises(TimeoutError):
+        sendRequest(__url, dataIn={})
+    assert len(attempts) == 1 and sleeps == []
+    return
+
+
+def testSpentDeadlineSendsNothing(monkeypatch):
+    setConfig("request_deadline", 0.01)
+    deadline = getRequestDeadline()
+    time.sleep(0.02)
+    attempts = answerAttempts(monkeypatch, 200)
+    with pytest.raises(TimeoutError):
+        sendRequest(__url, dataIn={}, deadlineIn=deadline)
+    assert len(attempts) == 0
+    return
+
+
+def answerAfter(monkeypatchIn, secondsIn):
+    # attempt n is answered after secondsIn[n] seconds, returns the closed
+    # responses
+    attempts = []
+    closed = []
+
+    def sendAttempt(urlIn, dataIn, fileIn, streamIn, deadlineIn):
+        attempt = len(attempts)
+        attempts.append(attempt)
+        time.sleep(secondsIn[attempt])
+        return SimpleNamespace(
+            status_code=200,
+            attempt=attempt,
+            close=lambda: closed.append(attempt)
+        )
+
+    monkeypatchIn.setattr(session, "sendAttempt", sendAttempt)
+    return closed
+
+
+def fillLatencies(dataIn, secondsIn):
+    setConfig("request_hedging", True)
+    setConfig("request_hedging_min_samples", 10)
+    for i in range(20):
+        addLatency(getLatencyKey(__url, dataIn), secondsIn)
+    return
+
+
+def testHedgeWinsOverSlowAttempt(monkeypatch):
+    dataIn = {"model": "hedged-fast"}
+    fillLatencies(dataIn, 0.02)
+    closed = answerAfter(monkeypatch, [0.5, 0.0])
+    stats = getRequestStats()
+    response = sendRequest(__url, dataIn=dataIn)
+    assert response.attempt == 1
+    assert getRequestStats()["hedges"] == stats["hedges"] + 1
+    assert getRequestStats()["hedgeWins"] == stats["hedgeWins"] + 1
+    # the slow attempt is closed once it arrives
+    time.sleep(0.7)
+    assert closed == [0]
+    return
+
+
+def testNoHedgeForFastAttempt(monkeypatch):
+    dataIn = {"model": "hedged-slow"}
+    fillLatencies(dataIn, 0.5)
+    answerAfter(monkeypatch, [0.0, 0.0])
+    stats = getRequestStats()
+    assert sendRequest(__url, dataIn=dataIn).attempt == 0
+    assert getRequestStats()["hedges"] == stats["hedges"]
+    return
+
+
+def testNoHedgeWithoutEnoughSamples(monkeypatch):
+    dataIn = {"model": "hedged-new"}
+    setConfig("request_hedging", True)
+    setConfig("request_hedging_min_samples", 10)
+    assert getHedgeDelay(getLatencyKey(__url, dataIn)) is None
+    answerAfter(monkeypatch, [0.1, 0.0])
+    stats = getRequestStats()
+    assert sendRequest(__url, dataIn=dataIn).attempt == 0
+    assert getRequestStats()["hedges"] == stats["hedges"]
+    return
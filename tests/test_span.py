@@ -0,0 +1,41 @@
+import json
+
+
+import pytest
+
+
+from modules.util import span as spans
+from modules.util.span import span, exportSpans, getSpans, setSpansEnabled
+
+
+@pytest.fixture(autouse=True)
+def traces(monkeypatch, tmp_path):
+    monkeypatch.setattr(spans, "TRACES_FILE_PATH", str(tmp_path) + "/")
+    exportSpans("jsonl")  # spans left over from other tests
+    setSpansEnabled(True)
+    yield
+    setSpansEnabled(False)
+    exportSpans("jsonl")
+    return
+
+
+def testExportOnlyTakesTheGivenRoot():
+    # the second prompt is still running when the first one is exported
+    with span("prompt") as first:
+        with span("read"):
+            pass
+    with span("prompt") as second:
+        with span("read"):
+            pass
+        filePath = exportSpans("chrome", first["id"])
+        assert [s["root"] for s in getSpans()] == [second["id"]]
+    with open(filePath) as f:
+        events = json.load(f)["traceEvents"]
+    assert sorted(e["args"]["id"] for e in events) == [
+        first["id"],
+        first["id"] + 1
+    ]
+    assert len(getSpans(second["id"])) == 2
+    exportSpans("jsonl", second["id"])
+    assert getSpans() == []
+    return
@@ -0,0 +1,88 @@
+import threading
+import time
+
+
+import pytest
+
+
+from modules.util.util import mapStagesInOrder
+
+
+def testResultsKeepInputOrder():
+    # later items finish their stages first
+    def first(item):
+        time.sleep(0.002 * (10 - item))
+        return item * 10
+
+    def second(item):
+        time.sleep(0.001 * (item % 3))
+        return item + 1
+
+    results = list(mapStagesInOrder(
+        [[first, 4], [second, 2]],
+        range(10),
+        6
+    ))
+    assert results == [i * 10 + 1 for i in range(10)]
+    return
+
+
+def testWindowBoundsItemsInFlight():
+    lock = threading.Lock()
+    inFlight = [0, 0]  # now, most
+
+    def start(item):
+        with lock:
+            inFlight[0] += 1
+            inFlight[1] = max(inFlight[1], inFlight[0])
+        time.sleep(0.005)
+        return item
+
+    def finish(item):
+        time.sleep(0.005)
+        with lock:
+            inFlight[0] -= 1
+        return item
+
+    results = list(mapStagesInOrder(
+        [[start, 8], [finish, 8]],
+        range(20),
+        3
+    ))
+    assert results == list(range(20))
+    assert inFlight[1] <= 3
+    return
+
+
+def testItemsAreTakenLazily():
+    taken = []
+
+    def iterateItems():
+        for i in range(100):
+            taken.append(i)
+            yield i
+        return
+
+    results = mapStagesInOrder([[lambda item: item, 1]], iterateItems(), 2)
+    assert next(results) == 0
+    assert len(taken) <= 3
+    results.close()
+    return
+
+
+def testStageErrorIsRaisedInOrder():
+    def fail(item):
+        if item == 2:
+            raise ValueError("item 2")
+        return item
+
+    results = mapStagesInOrder(
+        [[fail, 2], [lambda item: item, 2]],
+        range(5),
+        4
+    )
+    assert next(results) == 0
+    assert next(results) == 1
+    with pytest.raises(ValueError):
+        next(results)
+    return
@@ -0,0 +1,90 @@
+import random
+import statistics
+
+
+import pytest
+
+
+from modules.util.store import parseSizeWeight, getResultMask
+from modules.util.store import getResultAggregates
+
+
+@pytest.mark.parametrize("result, measures", [
+    ["Size: 8.0cm by 8.0cm by 7.5cm, weight: 180g", [8.0, 8.0, 7.5, 180.0]],
+    ["Size: 8.0cm by 8.0cm by 7.5cm, weight: 1.5kg", [8.0, 8.0, 7.5, 1500.0]],
+    ["Size: 1cm by 2.cm by 3.25cm, weight: 500mg", [1.0, 2.0, 3.25, 0.5]],
+    ["Apple. Size: 8cm by 8cm by 7cm, weight: 2g", [8.0, 8.0, 7.0, 2.0]],
+    ["Size: 8cm by 8cm, weight: 2g", None],
+    ["Size: 8cm by 8cm by 7cm, weight: 2lb", None],
+    ["", None],
+    [None, None]
+])
+def testParseSizeWeight(result, measures):
+    assert parseSizeWeight(result) == measures
+    return
+
+
+def getColumns(rowsIn):
+    # rows of [object id, length, width, height, weight, time, cached]
+    import numpy
+    names = ["object", "length", "width", "height", "weight", "time", "cached"]
+    return {
+        name: numpy.array([row[i] for row in rowsIn])
+        for i, name in enumerate(names)
+    }
+
+
+def testAggregatesMatchStatistics():
+    pytest.importorskip("numpy")
+    generator = random.Random(1)
+    objects = ["apple", "red apple", "chair", "unused"]
+    rows = [
+        [
+            generator.choice([0, 0, 0, 1, 2]),
+            generator.uniform(1, 10),
+            generator.uniform(1, 10),
+            generator.uniform(1, 10),
+            generator.uniform(1, 5000),
+            float(i),
+            generator.choice([0, 1])
+        ]
+        for i in range(500)
+    ]
+    columns = getColumns(rows)
+    mask = getResultMask(columns, objects, minWeightIn=100, freshOnlyIn=True)
+    kept = [row for row in rows if row[4] >= 100 and row[6] == 0]
+    aggregates = getResultAggregates(columns, objects, mask)
+    # most results first, objects without any are left out
+    counts = [aggregate["count"] for aggregate in aggregates.values()]
+    assert counts == sorted(counts, reverse=True)
+    assert sorted(aggregates) == ["apple", "chair", "red apple"]
+    for objectId, objectName in enumerate(objects[0:3]):
+        groupRows = [row for row in kept if row[0] == objectId]
+        aggregate = aggregates[objectName]
+        assert aggregate["count"] == len(groupRows)
+        for i, name in enumerate(["length", "width", "height", "weight"]):
+            values = [row[i + 1] for row in groupRows]
+            assert aggregate["mean"][name] == pytest.approx(
+                statistics.mean(values)
+            )
+            assert aggregate["median"][name] == pytest.approx(
+                statistics.median(values)
+            )
+    return
+
+
+def testObjectAndTimeFilters():
+    pytest.importorskip("numpy")
+    objects = ["apple", "red apple", "chair"]
+    columns = getColumns([
+        [0, 1.0, 1.0, 1.0, 10.0, 100.0, 0],
+        [1, 2.0, 2.0, 2.0, 20.0, 200.0, 1],
+        [2, 3.0, 3.0, 3.0, 30.0, 300.0, 0]
+    ])
+    mask = getResultMask(columns, objects, objectIn="apple")
+    assert list(mask) == [True, True, False]
+    mask = getResultMask(columns, objects, sinceIn=200.0, maxWeightIn=25.0)
+    assert list(mask) == [False, True, False]
+    mask = getResultMask(columns, objects, objectIn="table")
+    assert getResultAggregates(columns, objects, mask) == {}
+    return
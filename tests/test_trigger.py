@@ -0,0 +1,35 @@
+from modules.util import trigger
+from modules.util.configuration import setConfig
+from modules.util.trigger import triggerOpenFile
+
+
+def testUndecodableImageIsReported(monkeypatch, tmp_path):
+    filePath = tmp_path / "bad.png"
+    filePath.write_bytes(b"not an image")
+    setConfig("default_image_to_text_model", "image_to_text_model")
+    errors = []
+    monkeypatch.setattr(trigger, "printError", errors.append)
+    result = triggerOpenFile("describe '" + str(filePath) + "'", 0)
+    assert result.startswith("bad.png: Cannot get file contents: ")
+    assert len(errors) == 1
+    return
+
+
+def testFilesAreLabelledWithTheirName(monkeypatch, tmp_path):
+    folderPath = tmp_path / "folder"
+    folderPath.mkdir()
+    (folderPath / "a.txt").write_text("first")
+    (tmp_path / "b.txt").write_text("second")
+    (tmp_path / "c.png").write_bytes(b"not an image")
+    setConfig("default_image_to_text_model", "image_to_text_model")
+    monkeypatch.setattr(trigger, "printError", lambda *args: None)
+    result = triggerOpenFile(
+        "read '" + str(folderPath) + "' '" + str(tmp_path / "b.txt") + "' "
+        "'" + str(tmp_path / "c.png") + "'",
+        0
+    )
+    results = result.split("\n\n")
+    assert results[0:2] == ["a.txt: first", "b.txt: second"]
+    assert results[2].startswith("c.png: Cannot get file contents: ")
+    assert len(results) == 3
+    return